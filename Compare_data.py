@@ -1,49 +1,2580 @@
+import numpy as np
 import pandas as pd
 import argparse
+import ast
+import datetime
 import os
 import sys
+import hashlib
 import html
+import codecs
+import contextlib
+import csv
+import io
+import itertools
+import json
+import logging
+import math
+import mmap
+import pickle
+import queue
+import shutil
+import sqlite3
+import statistics
+import tempfile
+import threading
+import time
+from collections import deque
+from urllib.parse import unquote
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 
-def compare_csv(file1, file2, output_file, key_cols=None, report_type="full", compare_cols=None, delimiter=',', start_line=1, end_line=None):
+try:
+    import pyarrow as pa
+    import pyarrow.compute as pc
+except ImportError:
+    pa = None
+
+
+# Decisions worth knowing about but not part of the result, such as the pairing strategy chosen; the command line
+# shows them on stderr
+logger = logging.getLogger(__name__)
+
+# States after which no further update follows; every other state (running, loading, partitioning) is throttled
+TERMINAL_STATES = ("finished", "failed")
+
+
+class ProgressReporter:
+    # Tracks bytes consumed against the input sizes and publishes throughput/ETA
+    # snapshots to a callback, a throttled status file and/or a console line.
+    def __init__(self, total_bytes, callback=None, status_file=None, interval=1.0, show=False):
+        self.total_bytes = total_bytes
+        self.callback = callback
+        self.status_file = status_file
+        self.interval = interval
+        self.show = show
+        self.start_time = time.monotonic()
+        self.last_publish = None
+        self.bytes_done = 0
+        self.rows = 0
+        self.plan = None
+
+    def set_plan(self, plan):
+        # The chosen strategy travels with every snapshot
+        self.plan = describe_plan(plan)
+
+    def snapshot(self, bytes_done, rows, mismatches, state="running"):
+        elapsed = time.monotonic() - self.start_time
+        bytes_done = min(bytes_done, self.total_bytes)
+        # A keyed run counts rows read into partitions before it counts rows paired; the count never goes back
+        rows = self.rows = max(int(rows), self.rows)
+        rate = bytes_done / elapsed if elapsed > 0 else 0.0
+        eta = (self.total_bytes - bytes_done) / rate if rate > 0 else None
+        status = {
+            'state': state,
+            'bytes_done': bytes_done,
+            'total_bytes': self.total_bytes,
+            'percent': round(100.0 * bytes_done / self.total_bytes, 2) if self.total_bytes else 100.0,
+            'rows': int(rows),
+            'mismatches': int(mismatches),
+            'elapsed_seconds': round(elapsed, 3),
+            'rows_per_second': round(rows / elapsed, 1) if elapsed > 0 else 0.0,
+            'mb_per_second': round(rate / (1024 * 1024), 3),
+            'eta_seconds': round(eta, 1) if eta is not None and state not in TERMINAL_STATES else 0.0,
+        }
+        if self.plan:
+            status['plan'] = self.plan
+        return status
+
+    def update(self, bytes_done, rows, mismatches, state="running"):
+        self.bytes_done = bytes_done
+        status = self.snapshot(bytes_done, rows, mismatches, state)
+        if self.callback:
+            self.callback(status)
+        now = time.monotonic()
+        final = state in TERMINAL_STATES
+        if final or self.last_publish is None or now - self.last_publish >= self.interval:
+            self.last_publish = now
+            if self.status_file:
+                write_status_file(self.status_file, status)
+            if self.show:
+                print_progress_line(status, final=final)
+        return status
+
+
+def write_status_file(path, status):
+    # Write to a temporary file and rename so pollers never see a partial document
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as sf:
+        json.dump(status, sf)
+    os.replace(tmp_path, path)
+
+
+def format_duration(seconds):
+    seconds = int(seconds)
+    return '{:d}:{:02d}:{:02d}'.format(seconds // 3600, seconds % 3600 // 60, seconds % 60)
+
+
+def print_progress_line(status, final=False):
+    line = '{:6.2f}% | {:,} rows | {:,.0f} rows/s | {:.2f} MB/s | {:,} mismatches | ETA {}'.format(
+        status['percent'], status['rows'], status['rows_per_second'], status['mb_per_second'],
+        status['mismatches'], format_duration(status['eta_seconds']))
+    sys.stderr.write('\r' + line + ('\n' if final else ''))
+    sys.stderr.flush()
+
+
+EXIT_MATCH = 0
+EXIT_ERROR = 1
+EXIT_DIFFERENT = 3
+EXIT_BUDGET_EXCEEDED = 4
+
+
+HTML_REPORT_HEAD = '''
+    <html>
+    <head>
+    <style>
+        td {padding: 5px;} 
+        .diff {background-color: red;} 
+        .same {background-color: white;} 
+        .match {background-color: green;}
+        table {border-collapse: collapse;}
+        th, td {border: 1px solid black;}
+    </style>
+    </head>
+    <body>
+    '''
+
+
+def write_report_head(f, title, sources):
+    # Every HTML report opens the same way: the shared styles, a title and the inputs that were compared
+    f.write(HTML_REPORT_HEAD)
+    f.write('<h2>{}</h2>'.format(html.escape(title)))
+    for label, path in sources:
+        f.write('<p>{}: {}</p>'.format(html.escape(label), html.escape(path)))
+
+
+def record_counts(summary):
+    return ["Total records: {}".format(summary['total']), "Same records: {}".format(summary['same']),
+            "Mismatched records: {}".format(summary['different'])]
+
+
+def write_report_summary(f, lines):
+    f.write('<p>{}</p>'.format('<br>'.join(lines)))
+
+
+def fill_report_summary(f, lines):
+    # Streaming writers only know their totals at close, so the placeholder written with the head is filled in by script
+    f.write('<script>document.getElementById("summary").innerHTML = "{}";</script>'.format('<br>'.join(lines)))
+
+
+class HtmlReportWriter:
+    def __init__(self, output_file, file1, file2, report_type="full"):
+        self.output_file = output_file
+        self.report_type = report_type
+        self.headers_written = False
+        self.column_count = 0
+        self.pending_skipped = []
+        self.f = open(output_file, 'w')
+        write_report_head(self.f, "Comparison Summary", [("File 1", file1), ("File 2", file2)])
+        self.f.write('<p id="summary"></p>')
+
+        self.f.write('<table id="comparisonTable">')
+
+    def write_headers(self, headers, column_count):
+        self.f.write('<tr>' + ''.join(f'<th>{html.escape(col)}</th>' for col in headers) + '</tr>')
+        self.headers_written = True
+        self.column_count = column_count
+        for first_line, last_line in self.pending_skipped:
+            self.write_skipped(first_line, last_line)
+        self.pending_skipped = []
+
+    def write_chunk(self, comparison, rows):
+        if not len(rows):
+            return
+        all_columns = comparison.columns
+        if not self.headers_written:
+            headers = ['line_number']
+            for col in all_columns:
+                headers.extend([f"{col}_file1", f"{col}_file2", f"{col}_diff"])
+            self.write_headers(headers, 3 * len(all_columns))
+
+        # Render straight from the chunk's columns; only the selected rows are ever materialised
+        line_numbers = comparison.line_numbers[rows]
+        escaped1 = [[html.escape(str(v)) for v in values] for values in comparison.values1(rows)]
+        escaped2 = [[html.escape(str(v)) for v in values] for values in comparison.values2(rows)]
+        matrix = comparison.matrix[rows]
+        for i in range(len(rows)):
+            row_html = '<tr>'
+            row_html += f'<td>{line_numbers[i]}</td>'
+            for j in range(len(all_columns)):
+                row_html += f'<td class="same">{escaped1[j][i]}</td>'
+                row_html += f'<td class="same">{escaped2[j][i]}</td>'
+                row_html += '<td class="diff">Different</td>' if matrix[i, j] else '<td class="match">Same</td>'
+            row_html += '</tr>'
+            self.f.write(row_html)
+
+    def write_mismatches(self, mismatches):
+        if not len(mismatches):
+            return
+        if not self.headers_written:
+            self.write_headers(['line_number', 'column', 'file1', 'file2'], 3)
+        for line_number, col, value1, value2 in mismatches.iter_cells():
+            self.f.write('<tr><td>{}</td><td>{}</td><td class="diff">{}</td><td class="diff">{}</td></tr>'.format(
+                line_number, html.escape(col), html.escape(str(value1)), html.escape(str(value2))))
+
+    def write_comparison(self, comparison):
+        if self.report_type == "cells":
+            self.write_mismatches(comparison.mismatches())
+        else:
+            self.write_chunk(comparison, report_rows(comparison, self.report_type))
+
+    def write_skipped(self, first_line, last_line):
+        if self.report_type in ("difference", "cells"):
+            return
+        # Rows before the header row would render oddly, so hold them until the header is known
+        if not self.headers_written:
+            self.pending_skipped.append((first_line, last_line))
+            return
+        self.f.write('<tr><td>{}-{}</td><td colspan="{}" class="match">Identical block, not re-compared</td></tr>'.format(
+            first_line, last_line, max(self.column_count, 1)))
+
+    def close(self, summary):
+        if self.pending_skipped:
+            self.f.write('<tr><th>line_number</th><th>comparison</th></tr>')
+            self.headers_written = True
+            for first_line, last_line in self.pending_skipped:
+                self.write_skipped(first_line, last_line)
+        self.f.write('</table>')
+
+        lines = record_counts(summary)
+        if summary['stopped_early']:
+            lines.append("Comparison stopped early: {}".format(summary['status']))
+        if 'only_in_file1' in summary:
+            bound = "at least " if summary.get('only_in_lower_bound') else ""
+            lines += ["Only in file 1: {}{}".format(bound if summary['only_in_file1'] else "", summary['only_in_file1']),
+                      "Only in file 2: {}{}".format(bound if summary['only_in_file2'] else "", summary['only_in_file2'])]
+        for name, found in summary.get('duplicate_keys', {}).items():
+            lines.append("Duplicate keys in {}: {} ({} rows)".format(name.replace('file', 'file '), found['keys'], found['rows']))
+        if 'sample' in summary:
+            sample = summary['sample']
+            lines.append(("Sampled by {by} at rate {rate} (seed {seed}): estimated mismatch rate {estimated_mismatch_rate:.4%}"
+                          " ({confidence:.0%} CI {ci_low:.4%} - {ci_high:.4%}), about {estimated_mismatched_rows} of"
+                          " {estimated_population} records").format(**sample))
+        fill_report_summary(self.f, lines)
+        self.f.write('</body></html>')
+        self.f.close()
+
+    def abort(self):
+        self.f.close()
+
+
+class LayerReportWriter:
+    # One report for an N-layer comparison: agreeing cells show their value once, diverging cells show every
+    # layer's value and the layer where the value first diverged from the source
+    def __init__(self, output_file, files, layer_names, report_type="full"):
+        self.output_file = output_file
+        self.layer_names = layer_names
+        self.report_type = report_type
+        self.headers_written = False
+        self.f = open(output_file, 'w')
+        write_report_head(self.f, "Comparison Summary", zip(layer_names, files))
+        self.f.write('<p id="summary"></p>')
+
+        self.f.write('<table id="comparisonTable">')
+
+    def write_comparison(self, comparison):
+        rows = report_rows(comparison, self.report_type)
+        if not len(rows):
+            return
+        if not self.headers_written:
+            headers = ['line_number', 'first_diverged_at'] + comparison.columns
+            self.f.write('<tr>' + ''.join(f'<th>{html.escape(col)}</th>' for col in headers) + '</tr>')
+            self.headers_written = True
+
+        line_numbers = comparison.line_numbers[rows]
+        row_divergence = comparison.row_divergence()[rows]
+        diverged_at = comparison.diverged_at[rows]
+        layers = [[[html.escape(str(v)) for v in values] for values in comparison.values(layer, rows)]
+                  for layer in range(len(self.layer_names))]
+        names = [html.escape(name) for name in self.layer_names]
+        for i in range(len(rows)):
+            row_html = f'<tr><td>{line_numbers[i]}</td>'
+            if row_divergence[i]:
+                row_html += f'<td class="diff">{names[row_divergence[i]]}</td>'
+            else:
+                row_html += '<td class="match">Same</td>'
+            for j in range(len(comparison.columns)):
+                if diverged_at[i, j]:
+                    cell = '<br>'.join(f'{names[layer]}: {layers[layer][j][i]}' for layer in range(len(names)))
+                    row_html += f'<td class="diff">{cell}<br>diverged at {names[diverged_at[i, j]]}</td>'
+                else:
+                    row_html += f'<td class="same">{layers[0][j][i]}</td>'
+            row_html += '</tr>'
+            self.f.write(row_html)
+
+    def close(self, summary):
+        self.f.write('</table>')
+        lines = record_counts(summary)
+        lines += ["First diverged at {}: {}".format(html.escape(name), count) for name, count in summary['first_divergence'].items()]
+        lines += ["Unpaired records in {}: {}".format(html.escape(name), count) for name, count in summary.get('unpaired_records', {}).items()]
+        fill_report_summary(self.f, lines)
+        self.f.write('</body></html>')
+        self.f.close()
+
+    def abort(self):
+        self.f.close()
+
+
+WIDE_TABLE_COLUMNS = 256
+
+
+def is_arrow_backed(values):
+    dtype = values.dtype
+    return pa is not None and (isinstance(dtype, pd.ArrowDtype) or getattr(dtype, 'storage', None) == 'pyarrow')
+
+
+def column_diff(values1, values2):
+    # Arrow compute kernels release the GIL, which is what lets the column pool use several cores;
+    # object arrays fall back to numpy's element-wise comparison
+    if is_arrow_backed(values1) and is_arrow_backed(values2):
+        array1, array2 = pa.array(values1), pa.array(values2)
+        diff = pc.not_equal(array1, array2)
+        if diff.null_count:
+            diff = pc.if_else(pc.is_null(diff), pc.not_equal(pc.is_null(array1), pc.is_null(array2)), diff)
+        return diff.to_numpy(zero_copy_only=False)
+    return values1.to_numpy() != values2.to_numpy()
+
+
+def column_diff_batch(chunk1, chunk2, columns):
+    return [column_diff(chunk1[col], chunk2[col]) for col in columns]
+
+
+def diff_matrix(chunk1, chunk2, all_columns, executor=None, threads=1):
+    # One boolean column per compared column; row-level results come from a single reduction over it
+    all_columns = list(all_columns)
+    if executor is None or threads <= 1 or len(all_columns) < 2:
+        masks = column_diff_batch(chunk1, chunk2, all_columns)
+    else:
+        batch_size = max(1, -(-len(all_columns) // (threads * 4)))
+        batches = [all_columns[i:i + batch_size] for i in range(0, len(all_columns), batch_size)]
+        masks = [mask for batch in executor.map(lambda batch: column_diff_batch(chunk1, chunk2, batch), batches) for mask in batch]
+    if not masks:
+        return np.zeros((len(chunk1), 0), dtype=bool)
+    return np.column_stack(masks)
+
+
+class PandasBackend:
+    # Reference implementation of the chunk operations the comparison loop relies on: reading, projecting,
+    # comparing and filtering chunks, plus the conversions the report sinks need
+    name = 'pandas'
+
+    def open_reader(self, path, handle, chunk_size, delimiter, skiprows, **options):
+        return open_chunk_reader(path, handle, chunk_size, delimiter, skiprows, **options)
+
+    def project(self, frame, columns):
+        return frame[list(columns)]
+
+    def compare(self, frame1, frame2, columns, executor=None, threads=1):
+        return diff_matrix(frame1, frame2, columns, executor, threads)
+
+    def filter(self, frame, mask):
+        return frame[mask]
+
+    def head(self, frame, rows):
+        return frame.head(rows)
+
+    def drop_head(self, frame, rows):
+        return frame.iloc[rows:]
+
+    def with_line_numbers(self, frame, line_numbers):
+        return frame.assign(line_number=line_numbers)
+
+    def column(self, frame, col):
+        return frame[col].to_numpy()
+
+    def take(self, frame, columns, rows):
+        return [frame[col].iloc[rows].to_numpy() for col in columns]
+
+    def to_pandas(self, frame):
+        return frame
+
+
+class PolarsChunkReader:
+    # Polars' streaming CSV scan, parsed by its own thread pool; every column is read as a string like read_csv(dtype=str)
+    def __init__(self, path, chunk_size, delimiter, skip_lines=0):
+        import polars as pl
+
+        self.size = os.path.getsize(path)
+        # Empty fields arrive as nulls; read_csv(keep_default_na=False) gives '' and so must this
+        self.scan = pl.scan_csv(path, separator=delimiter, infer_schema=False, skip_rows_after_header=skip_lines).fill_null('')
+        self.chunk_size = chunk_size
+        self.rows_read = skip_lines
+        with open(path, 'rb') as f:
+            sample = f.read(1 << 16)
+        self.row_bytes = len(sample) / max(sample.count(b'\n'), 1)
+
+    def bytes_consumed(self):
+        # The scan exposes no byte offset, so estimate it from the rows delivered and the sampled row width
+        return int(min(self.rows_read * self.row_bytes, self.size))
+
+    def __iter__(self):
+        for batch in self.scan.collect_batches(chunk_size=self.chunk_size, maintain_order=True):
+            self.rows_read += batch.height
+            yield batch
+
+
+class PolarsBackend:
+    # Columnar backend: chunks are polars DataFrames, and all columns of a chunk are compared by one
+    # multithreaded select instead of a Python loop over columns
+    name = 'polars'
+
+    def __init__(self):
+        import polars as pl
+
+        self.pl = pl
+
+    def open_reader(self, path, handle, chunk_size, delimiter, skiprows, **options):
+        if is_excel_file(path) or is_json_file(path) or is_parquet_file(path) or options.get('fixed_width_layout'):
+            raise ValueError("The polars backend reads delimited text files only")
+        if not isinstance(skiprows, range):
+            raise ValueError("The polars backend cannot sample rows by line")
+        return PolarsChunkReader(path, chunk_size, delimiter, max(skiprows.stop - 1, 0))
+
+    def project(self, frame, columns):
+        return frame.select(list(columns))
+
+    def compare(self, frame1, frame2, columns, executor=None, threads=1):
+        pl = self.pl
+        columns = list(columns)
+        if not columns:
+            return np.zeros((frame1.height, 0), dtype=bool)
+        frame2 = frame2.select(columns).rename({col: f'{i}_file2' for i, col in enumerate(columns)})
+        combined = pl.concat([frame1.select(columns), frame2], how='horizontal')
+        diff = combined.select([pl.col(col).ne_missing(pl.col(f'{i}_file2')).alias(str(i)) for i, col in enumerate(columns)])
+        return diff.to_numpy()
+
+    def filter(self, frame, mask):
+        return frame.filter(self.pl.Series(np.asarray(mask, dtype=bool)))
+
+    def head(self, frame, rows):
+        return frame.head(rows)
+
+    def drop_head(self, frame, rows):
+        return frame.slice(rows)
+
+    def with_line_numbers(self, frame, line_numbers):
+        return frame.with_columns(self.pl.Series('line_number', np.asarray(line_numbers, dtype=np.int64)))
+
+    def column(self, frame, col):
+        return frame.get_column(col).to_numpy()
+
+    def take(self, frame, columns, rows):
+        rows = np.asarray(rows, dtype=np.int64)
+        return [frame.get_column(col).gather(rows).to_numpy() for col in columns]
+
+    def to_pandas(self, frame):
+        return frame.to_pandas()
+
+
+PANDAS_BACKEND = PandasBackend()
+BACKENDS = {'pandas': PandasBackend, 'polars': PolarsBackend}
+
+
+def get_backend(name):
+    if name is None or name == 'pandas':
+        return PANDAS_BACKEND
+    if name not in BACKENDS:
+        raise ValueError(f"Unknown backend: {name}")
+    return BACKENDS[name]()
+
+
+class SparseMismatches:
+    # Differing cells in coordinate form: parallel arrays of line number, column id, file1 value and
+    # file2 value, so memory grows with the number of differing cells rather than rows x columns
+    def __init__(self, columns, rows, line_numbers, column_ids, values1, values2):
+        self.columns = columns
+        self.rows = rows
+        self.line_numbers = line_numbers
+        self.column_ids = column_ids
+        self.values1 = values1
+        self.values2 = values2
+
+    def __len__(self):
+        return len(self.line_numbers)
+
+    def iter_cells(self):
+        columns = self.columns
+        for line_number, column_id, value1, value2 in zip(self.line_numbers.tolist(), self.column_ids.tolist(), self.values1, self.values2):
+            yield line_number, columns[column_id], value1, value2
+
+
+class ChunkComparison:
+    def __init__(self, chunk1, chunk2, all_columns, executor=None, threads=1, backend=None):
+        self.backend = backend or PANDAS_BACKEND
+        self.frame1 = chunk1
+        self.frame2 = chunk2
+        self.columns = list(all_columns)
+        self.matrix = self.backend.compare(chunk1, chunk2, self.columns, executor, threads)
+        self.row_diff = self.matrix.any(axis=1)
+        self.line_numbers = self.backend.column(chunk1, 'line_number')
+        self._mismatches = None
+        self._chunks = None
+
+    @property
+    def chunk1(self):
+        return self.pandas_chunks()[0]
+
+    @property
+    def chunk2(self):
+        return self.pandas_chunks()[1]
+
+    def pandas_chunks(self):
+        # Sinks that need whole rows (keys) get pandas frames; other backends convert only on that request
+        if self._chunks is None:
+            self._chunks = (self.backend.to_pandas(self.frame1), self.backend.to_pandas(self.frame2))
+        return self._chunks
+
+    def values1(self, rows):
+        return self.backend.take(self.frame1, self.columns, rows)
+
+    def values2(self, rows):
+        return self.backend.take(self.frame2, self.columns, rows)
+
+    def mismatches(self):
+        if self._mismatches is None:
+            # Row-major nonzero keeps the cells of a line together and in column order
+            rows, column_ids = np.nonzero(self.matrix)
+            values1 = np.empty(len(rows), dtype=object)
+            values2 = np.empty(len(rows), dtype=object)
+            for column_id in np.unique(column_ids):
+                at = column_ids == column_id
+                col = self.columns[column_id]
+                values1[at] = self.backend.take(self.frame1, [col], rows[at])[0]
+                values2[at] = self.backend.take(self.frame2, [col], rows[at])[0]
+            self._mismatches = SparseMismatches(self.columns, rows, self.line_numbers[rows], column_ids.astype(np.int32), values1, values2)
+        return self._mismatches
+
+
+class LayerComparison:
+    # Compares N aligned layers (source, staging, target, ...) in one pass. diverged_at holds, per cell, the index
+    # of the first layer whose value differs from the source, or 0 where every layer agrees
+    def __init__(self, chunks, all_columns, executor=None, threads=1):
+        self.chunks = chunks
+        self.columns = list(all_columns)
+        self.diverged_at = np.zeros((len(chunks[0]), len(self.columns)), dtype=np.int8)
+        for layer in range(len(chunks) - 1, 0, -1):
+            matrix = diff_matrix(chunks[0], chunks[layer], self.columns, executor, threads)
+            self.diverged_at[matrix] = layer
+        self.matrix = self.diverged_at > 0
+        self.row_diff = self.matrix.any(axis=1)
+        self.line_numbers = chunks[0]['line_number'].to_numpy()
+
+    def row_divergence(self):
+        # Earliest diverging layer of each row, 0 for rows that agree everywhere
+        masked = np.where(self.matrix, self.diverged_at, np.iinfo(np.int8).max)
+        first = masked.min(axis=1) if self.columns else np.zeros(len(masked), dtype=np.int8)
+        return np.where(self.row_diff, first, 0)
+
+    def values(self, layer, rows):
+        return [self.chunks[layer][col].iloc[rows].to_numpy() for col in self.columns]
+
+
+class FingerprintSink:
+    # Collects a 64-bit fingerprint of every mismatched cell, hashed from (key or line number, column, value1,
+    # value2), and saves them sorted with their cell details, so the next run can diff against this one with
+    # set operations on integers
+    def __init__(self, path, key_cols=None):
+        self.path = path
+        self.key_cols = list(key_cols or [])
+        self.parts = []
+        self.cells = None
+
+    def write_comparison(self, comparison):
+        mismatches = comparison.mismatches()
+        if not len(mismatches):
+            return
+        if self.key_cols:
+            key_frame = comparison.chunk1[self.key_cols].iloc[mismatches.rows].astype(str)
+            identities = key_frame[self.key_cols[0]].str.cat([key_frame[col] for col in self.key_cols[1:]], sep='|').to_numpy()
+        else:
+            identities = mismatches.line_numbers.astype(str)
+        cells = pd.DataFrame({
+            'identity': np.asarray(identities, dtype=str),
+            'column': np.asarray(mismatches.columns, dtype=str)[mismatches.column_ids],
+            'value1': mismatches.values1.astype(str),
+            'value2': mismatches.values2.astype(str),
+        })
+        cells['fingerprint'] = pd.util.hash_pandas_object(cells, index=False).to_numpy()
+        self.parts.append(cells)
+
+    def write_skipped(self, first_line, last_line):
+        pass
+
+    def close(self, summary):
+        cells = pd.concat(self.parts, ignore_index=True) if self.parts else pd.DataFrame(
+            {'identity': [], 'column': [], 'value1': [], 'value2': [], 'fingerprint': np.array([], dtype=np.uint64)})
+        self.cells = cells.sort_values('fingerprint', kind='stable').drop_duplicates('fingerprint').reset_index(drop=True)
+        if self.path:
+            save_fingerprints(self.path, self.cells)
+
+    def abort(self):
+        self.parts = []
+
+
+def save_fingerprints(path, cells):
+    with open(path, 'wb') as f:
+        np.savez_compressed(f, fingerprint=cells['fingerprint'].to_numpy(dtype=np.uint64),
+                            **{col: cells[col].to_numpy(dtype=str) for col in ('identity', 'column', 'value1', 'value2')})
+
+
+def load_fingerprints(path):
+    with np.load(path) as data:
+        return pd.DataFrame({col: data[col] for col in ('fingerprint', 'identity', 'column', 'value1', 'value2')})
+
+
+def diff_fingerprints(previous, current):
+    # Both sets are sorted and unique, so membership is a binary search per fingerprint
+    in_previous = np.isin(current['fingerprint'].to_numpy(), previous['fingerprint'].to_numpy(), assume_unique=True)
+    in_current = np.isin(previous['fingerprint'].to_numpy(), current['fingerprint'].to_numpy(), assume_unique=True)
+    return {
+        'new': current[~in_previous],
+        'resolved': previous[~in_current],
+        'persisting': current[in_previous],
+    }
+
+
+def write_delta_report(path, delta, file1, file2):
+    with open(path, 'w') as f:
+        write_report_head(f, "Mismatch Delta", [("File 1", file1), ("File 2", file2)])
+        write_report_summary(f, ["New mismatches: {}".format(len(delta['new'])), "Resolved mismatches: {}".format(len(delta['resolved'])),
+                                 "Persisting mismatches: {}".format(len(delta['persisting']))])
+        for title, name, css in (('New mismatches', 'new', 'diff'), ('Resolved mismatches', 'resolved', 'match')):
+            f.write(f'<h3>{title}</h3><table><tr><th>record</th><th>column</th><th>file1</th><th>file2</th></tr>')
+            for identity, col, value1, value2 in delta[name][['identity', 'column', 'value1', 'value2']].itertuples(index=False):
+                f.write('<tr><td>{}</td><td>{}</td><td class="{css}">{}</td><td class="{css}">{}</td></tr>'.format(
+                    html.escape(identity), html.escape(col), html.escape(value1), html.escape(value2), css=css))
+            f.write('</table>')
+        f.write('</body></html>')
+
+
+EXCEL_MAX_ROWS = 1048576
+
+
+class XlsxReportWriter:
+    # Write-only (streaming) workbook laid out like comparison_Summary/Comparison_Result.xls: a Summary sheet, then
+    # 'removed' and 'added' sheets for records found only in file 1 or only in file 2 (keyed mode) and 'changed'
+    # sheets where differing cells read 'file1 ---> file2'. A full sheet rolls over to the next of its kind
+    def __init__(self, path, file1, file2, max_sheet_rows=None):
+        from openpyxl import Workbook
+        from openpyxl.cell.cell import ILLEGAL_CHARACTERS_RE
+
+        self.path = path
+        self.file1 = file1
+        self.file2 = file2
+        self.max_sheet_rows = max_sheet_rows or EXCEL_MAX_ROWS
+        self.illegal_characters = ILLEGAL_CHARACTERS_RE
+        self.workbook = Workbook(write_only=True)
+        self.summary_sheet = self.workbook.create_sheet('Summary')
+        self.sheets = {kind: {'sheet': self.workbook.create_sheet(kind), 'rows': 0, 'count': 1} for kind in ('removed', 'added', 'changed')}
+        self.headers = None
+        self.column_mismatches = {}
+
+    def clean(self, value):
+        return self.illegal_characters.sub('', value) if isinstance(value, str) else value
+
+    def append(self, kind, cells):
+        current = self.sheets[kind]
+        if current['rows'] >= self.max_sheet_rows:
+            current['count'] += 1
+            current['sheet'] = self.workbook.create_sheet('{} {}'.format(kind, current['count']))
+            current['rows'] = 0
+        if not current['rows']:
+            current['sheet'].append(self.headers)
+            current['rows'] = 1
+        current['sheet'].append(cells)
+        current['rows'] += 1
+
+    def write_comparison(self, comparison):
+        rows = np.flatnonzero(comparison.row_diff)
+        if not len(rows):
+            return
+        columns = [col for col in comparison.columns if col != RECORD_COLUMN]
+        if self.headers is None:
+            self.headers = ['line_number'] + [self.clean(col) for col in columns]
+        line_numbers = comparison.line_numbers[rows].tolist()
+        values1 = comparison.backend.take(comparison.frame1, columns, rows)
+        values2 = comparison.backend.take(comparison.frame2, columns, rows)
+        matrix = comparison.matrix[rows][:, [comparison.columns.index(col) for col in columns]]
+        kinds = np.full(len(rows), 'changed', dtype=object)
+        if RECORD_COLUMN in comparison.columns:
+            record1 = comparison.backend.take(comparison.frame1, [RECORD_COLUMN], rows)[0]
+            record2 = comparison.backend.take(comparison.frame2, [RECORD_COLUMN], rows)[0]
+            kinds[record2 == 'missing'] = 'removed'
+            kinds[record1 == 'missing'] = 'added'
+        changed = kinds == 'changed'
+        for col, count in zip(columns, matrix[changed].sum(axis=0).tolist()):
+            if count:
+                self.column_mismatches[col] = self.column_mismatches.get(col, 0) + count
+        for i, line_number in enumerate(line_numbers):
+            kind = kinds[i]
+            if kind == 'changed':
+                cells = [line_number]
+                for j in range(len(columns)):
+                    value1 = self.clean(str(values1[j][i]))
+                    cells.append('{} ---> {}'.format(value1, self.clean(str(values2[j][i]))) if matrix[i, j] else value1)
+            else:
+                # The record only exists on one side, so its values are listed as they are
+                values = values1 if kind == 'removed' else values2
+                cells = [line_number] + [self.clean(str(values[j][i])) for j in range(len(columns))]
+            self.append(kind, cells)
+
+    def write_skipped(self, first_line, last_line):
+        pass
+
+    def close(self, summary):
+        self.headers = self.headers or ['line_number']
+        for current in self.sheets.values():
+            if not current['rows']:
+                current['sheet'].append(self.headers)
+        self.summary_sheet.append(['Comparison Summary'])
+        self.summary_sheet.append(['File 1', self.clean(self.file1)])
+        self.summary_sheet.append(['File 2', self.clean(self.file2)])
+        self.summary_sheet.append(['Total records', summary['total']])
+        self.summary_sheet.append(['Same records', summary['same']])
+        self.summary_sheet.append(['Mismatched records', summary['different']])
+        if 'only_in_file1' in summary:
+            self.summary_sheet.append(['Only in file 1', summary['only_in_file1']])
+            self.summary_sheet.append(['Only in file 2', summary['only_in_file2']])
+        self.summary_sheet.append(['Status', summary['status']])
+        self.summary_sheet.append(['Mismatch sheets', sum(current['count'] for current in self.sheets.values())])
+        self.summary_sheet.append([])
+        self.summary_sheet.append(['Column', 'Mismatches'])
+        for col, count in self.column_mismatches.items():
+            self.summary_sheet.append([self.clean(col), count])
+        self.workbook.save(self.path)
+
+    def abort(self):
+        self.workbook = None
+
+
+def report_rows(comparison, report_type):
+    if report_type == "difference":
+        return np.flatnonzero(comparison.row_diff)
+    if report_type == "matched":
+        return np.flatnonzero(~comparison.row_diff)
+    return np.arange(len(comparison.row_diff))
+
+
+class SqliteResultStore:
+    # Queryable sink: bulk-inserts mismatch records and per-column stats into one indexed SQLite file,
+    # so follow-up questions are answered from the database instead of rerunning the comparison
+    def __init__(self, path, file1, file2, key_cols=None, batch_size=50000):
+        self.path = path
+        self.key_cols = list(key_cols or [])
+        self.batch_size = batch_size
+        self.pending = []
+        self.column_mismatches = {}
+        # With pipelining the writer thread inserts batches and the caller's thread closes the store after the
+        # writer has finished, so the connection is used by one thread at a time but not always the one that opened it
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=OFF')
+        with self.conn:
+            self.conn.executescript('''
+                CREATE TABLE IF NOT EXISTS runs (
+                    run_id INTEGER PRIMARY KEY, started_at TEXT, file1 TEXT, file2 TEXT, key_cols TEXT,
+                    total INTEGER, same INTEGER, different INTEGER, status TEXT);
+                CREATE TABLE IF NOT EXISTS mismatches (
+                    run_id INTEGER, line_number INTEGER, key TEXT, column_name TEXT, value1 TEXT, value2 TEXT);
+                CREATE TABLE IF NOT EXISTS column_stats (
+                    run_id INTEGER, column_name TEXT, mismatches INTEGER, PRIMARY KEY (run_id, column_name));
+            ''')
+            cursor = self.conn.execute('INSERT INTO runs (started_at, file1, file2, key_cols, status) VALUES (?, ?, ?, ?, ?)',
+                                       (time.strftime('%Y-%m-%dT%H:%M:%S'), file1, file2, ','.join(self.key_cols), 'running'))
+        self.run_id = cursor.lastrowid
+
+    def write_comparison(self, comparison):
+        mismatches = comparison.mismatches()
+        if not len(mismatches):
+            return
+        if self.key_cols:
+            key_frame = comparison.chunk1[self.key_cols].iloc[mismatches.rows].astype(str)
+            keys = key_frame[self.key_cols[0]].str.cat([key_frame[col] for col in self.key_cols[1:]], sep='|').tolist()
+        else:
+            keys = [None] * len(mismatches)
+        counts = np.bincount(mismatches.column_ids, minlength=len(mismatches.columns))
+        for column_id in np.flatnonzero(counts):
+            col = mismatches.columns[column_id]
+            self.column_mismatches[col] = self.column_mismatches.get(col, 0) + int(counts[column_id])
+        run_id = self.run_id
+        for (line_number, col, value1, value2), key in zip(mismatches.iter_cells(), keys):
+            self.pending.append((run_id, line_number, key, col, value1, value2))
+        if len(self.pending) >= self.batch_size:
+            self.flush()
+
+    def write_skipped(self, first_line, last_line):
+        pass
+
+    def flush(self):
+        if self.pending:
+            with self.conn:
+                self.conn.executemany('INSERT INTO mismatches VALUES (?, ?, ?, ?, ?, ?)', self.pending)
+            self.pending = []
+
+    def close(self, summary):
+        self.flush()
+        with self.conn:
+            self.conn.executemany('INSERT INTO column_stats VALUES (?, ?, ?)',
+                                  [(self.run_id, col, count) for col, count in self.column_mismatches.items()])
+            self.conn.execute('UPDATE runs SET total = ?, same = ?, different = ?, status = ? WHERE run_id = ?',
+                              (summary['total'], summary['same'], summary['different'], summary['status'], self.run_id))
+            # Indexes are built once after the bulk load, which is much cheaper than maintaining them per insert
+            self.conn.executescript('''
+                CREATE INDEX IF NOT EXISTS idx_mismatches_column_key ON mismatches (run_id, column_name, key);
+                CREATE INDEX IF NOT EXISTS idx_mismatches_key ON mismatches (run_id, key);
+                CREATE INDEX IF NOT EXISTS idx_mismatches_line ON mismatches (run_id, line_number);
+            ''')
+        self.conn.close()
+
+    def abort(self):
+        self.pending = []
+        with self.conn:
+            self.conn.execute("UPDATE runs SET status = 'failed' WHERE run_id = ?", (self.run_id,))
+        self.conn.close()
+
+
+def resolve_threads(threads, column_count):
+    if threads:
+        return threads
+    # Narrow tables are cheaper to compare serially than to hand to a pool
+    return min(os.cpu_count() or 1, 32) if column_count >= WIDE_TABLE_COLUMNS else 1
+
+
+MASK64 = (1 << 64) - 1
+
+
+def sample_threshold(sample_rate):
+    return min(int(sample_rate * (1 << 64)), MASK64)
+
+
+def line_is_sampled(line_index, seed, threshold):
+    # splitmix64 finaliser: a cheap, well-mixed hash of the physical line index
+    z = (line_index + seed * 0x9E3779B97F4A7C15) * 0x9E3779B97F4A7C15 & MASK64
+    z = (z ^ (z >> 30)) * 0xBF58476D1CE4E5B9 & MASK64
+    z = (z ^ (z >> 27)) * 0x94D049BB133111EB & MASK64
+    return (z ^ (z >> 31)) < threshold
+
+
+def sampled_key_mask(chunk, key_cols, seed, threshold):
+    # Both files hash the same key to the same value, so they select the same keys without coordination
+    hash_key = '{:016d}'.format(seed % 10 ** 16)
+    hashes = pd.util.hash_pandas_object(chunk[key_cols], index=False, hash_key=hash_key).to_numpy()
+    return hashes < np.uint64(threshold)
+
+
+class KeySample:
+    # Row filter (for FilteredReader) keeping the rows whose key is in the sample
+    def __init__(self, key_cols, seed, threshold):
+        self.key_cols = list(key_cols)
+        self.seed = seed
+        self.threshold = threshold
+
+    def mask(self, chunk):
+        return sampled_key_mask(chunk, self.key_cols, self.seed, self.threshold)
+
+
+def wilson_interval(successes, trials, confidence=0.95):
+    if trials == 0:
+        return 0.0, 1.0
+    z = statistics.NormalDist().inv_cdf(0.5 + confidence / 2)
+    p = successes / trials
+    denominator = 1 + z * z / trials
+    centre = (p + z * z / (2 * trials)) / denominator
+    margin = z * math.sqrt(p * (1 - p) / trials + z * z / (4 * trials * trials)) / denominator
+    return max(0.0, centre - margin), min(1.0, centre + margin)
+
+
+RECORD_COLUMN = '_record'
+
+
+def align_on_keys(frame1, frame2, key_cols, value_cols=None):
+    # Pair two frames by key with an outer join. Each side gets a _record column ('present'/'missing'),
+    # so a key found on one side only always counts as a mismatch
+    key_cols = list(key_cols)
+    if value_cols is None:
+        value_cols = [col for col in frame1.columns if col not in key_cols and col != 'line_number']
+    value_cols = [col for col in value_cols if col not in key_cols and col != RECORD_COLUMN]
+    columns = key_cols + value_cols + ['line_number']
+    merged = frame1[columns].merge(frame2[columns], on=key_cols, how='outer', suffixes=('_left', '_right'), indicator=True)
+    line_numbers = merged['line_number_left'].fillna(merged['line_number_right']).astype('int64').to_numpy()
+    order = np.argsort(line_numbers, kind='stable')
+    merged = merged.iloc[order].reset_index(drop=True)
+    in_left = merged['_merge'].to_numpy() != 'right_only'
+    in_right = merged['_merge'].to_numpy() != 'left_only'
+    aligned1 = merged[key_cols].copy()
+    aligned2 = merged[key_cols].copy()
+    for col in value_cols:
+        aligned1[col] = merged[col + '_left'].fillna('')
+        aligned2[col] = merged[col + '_right'].fillna('')
+    aligned1[RECORD_COLUMN] = np.where(in_left, 'present', 'missing')
+    aligned2[RECORD_COLUMN] = np.where(in_right, 'present', 'missing')
+    aligned1['line_number'] = line_numbers[order]
+    aligned2['line_number'] = line_numbers[order]
+    return aligned1, aligned2
+
+
+KEYED_PARTITION_BYTES = 64 * 1024 * 1024
+MAX_KEYED_PARTITIONS = 256
+
+
+def key_partitions(total_bytes):
+    # Enough hash partitions that one partition pair fits comfortably in memory
+    return int(min(max(1, math.ceil(total_bytes / KEYED_PARTITION_BYTES)), MAX_KEYED_PARTITIONS))
+
+
+def partition_of(frame, key_cols, partitions):
+    if partitions == 1:
+        return np.zeros(len(frame), dtype=np.int64)
+    hashes = pd.util.hash_pandas_object(frame[list(key_cols)], index=False).to_numpy()
+    return (hashes % np.uint64(partitions)).astype(np.int64)
+
+
+def spill_by_key(chunks, key_cols, partitions, directory, prefix, start_line=1, end_line=None, on_chunk=None, file_format='pickle'):
+    # One pass over the input, appending each chunk's rows to the pickle stream (or CSV file, for partitions that
+    # are shipped elsewhere) of their key's hash partition
+    paths = [os.path.join(directory, '{}{}.{}'.format(prefix, p, 'csv' if file_format == 'csv' else 'pkl')) for p in range(partitions)]
+    handles = [open(path, 'wb') for path in paths]
+    header_written = [False] * partitions
+    try:
+        line = start_line
+        for chunk in chunks:
+            if 'line_number' not in chunk.columns:
+                # Filtered readers number their rows (and stop at end_line) themselves
+                if end_line and line + len(chunk) - 1 > end_line:
+                    chunk = chunk.head(end_line - line + 1)
+                chunk = chunk.assign(line_number=np.arange(line, line + len(chunk)))
+                line += len(chunk)
+            ids = partition_of(chunk, key_cols, partitions)
+            order = np.argsort(ids, kind='stable')
+            for part in np.split(order, np.flatnonzero(np.diff(ids[order])) + 1):
+                if not len(part):
+                    continue
+                partition = ids[part[0]]
+                if file_format == 'csv':
+                    chunk.iloc[part].to_csv(handles[partition], index=False, header=not header_written[partition])
+                    header_written[partition] = True
+                else:
+                    pickle.dump(chunk.iloc[part], handles[partition], protocol=pickle.HIGHEST_PROTOCOL)
+            if on_chunk:
+                on_chunk(len(chunk))
+            if end_line and line > end_line:
+                break
+    finally:
+        for handle in handles:
+            handle.close()
+    return paths
+
+
+def load_spilled(path):
+    frames = []
+    with open(path, 'rb') as handle:
+        while True:
+            try:
+                frames.append(pickle.load(handle))
+            except EOFError:
+                break
+    os.remove(path)
+    return pd.concat(frames) if frames else None
+
+
+def align_layers_on_keys(frames, key_cols):
+    # N-way version of align_on_keys: every key seen in any layer, ordered by the line it first appears on
+    key_cols = list(key_cols)
+    value_cols = [col for col in frames[0].columns if col not in key_cols and col != 'line_number']
+    keys = pd.concat([frame[key_cols + ['line_number']] for frame in frames])
+    keys = keys.sort_values('line_number', kind='stable').drop_duplicates(key_cols).reset_index(drop=True)
+    aligned = []
+    for frame in frames:
+        merged = keys.merge(frame[key_cols + value_cols], on=key_cols, how='left', indicator=True)
+        layer = merged[key_cols].copy()
+        for col in value_cols:
+            layer[col] = merged[col].fillna('')
+        layer[RECORD_COLUMN] = np.where(merged['_merge'].to_numpy() == 'both', 'present', 'missing')
+        layer['line_number'] = keys['line_number'].to_numpy()
+        aligned.append(layer)
+    return aligned
+
+
+MAX_DUPLICATE_KEYS_LISTED = 1000
+
+
+def find_duplicate_keys(frame, key_cols):
+    # 64-bit key hashes (8 bytes a row) find the candidate rows; only those are grouped by their actual key values
+    key_cols = list(key_cols)
+    hashes = pd.util.hash_pandas_object(frame[key_cols], index=False).to_numpy()
+    ordered = np.sort(hashes)
+    repeated = ordered[1:][ordered[1:] == ordered[:-1]]
+    if not len(repeated):
+        return []
+    candidates = frame[np.isin(hashes, repeated)]
+    found = []
+    for key, lines in candidates.groupby(key_cols, sort=False)['line_number']:
+        if len(lines) > 1:
+            found.append((key if isinstance(key, tuple) else (key,), len(lines), sorted(int(line) for line in lines)))
+    return found
+
+
+class DuplicateKeys:
+    # Duplicate keys of one input: all of them are counted, the first MAX_DUPLICATE_KEYS_LISTED keep their line numbers
+    def __init__(self):
+        self.keys = 0
+        self.rows = 0
+        self.listed = []
+
+    def add(self, found):
+        for key, count, lines in found:
+            self.keys += 1
+            self.rows += count
+            if len(self.listed) < MAX_DUPLICATE_KEYS_LISTED:
+                self.listed.append((key, count, lines))
+
+
+def write_duplicate_keys_report(path, key_cols, duplicates, names):
+    with open(path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['file'] + list(key_cols) + ['count', 'line_numbers'])
+        for name, found in zip(names, duplicates):
+            for key, count, lines in sorted(found.listed, key=lambda entry: entry[2][0]):
+                writer.writerow([name] + list(key) + [count, ';'.join(str(line) for line in lines)])
+
+
+def note_duplicate_keys(summary, duplicates, names, key_cols, report_path=None):
+    # Duplicated keys pair every copy with every copy on the other side, so the pairing itself is suspect
+    found = {name: {'keys': d.keys, 'rows': d.rows} for name, d in zip(names, duplicates) if d.keys}
+    if not found and not report_path:
+        return
+    summary['duplicate_keys'] = found
+    for name, d in zip(names, duplicates):
+        if d.keys:
+            examples = ', '.join('{} x{} (lines {})'.format('|'.join(str(v) for v in key), count, ','.join(str(line) for line in lines[:5]))
+                                 for key, count, lines in sorted(d.listed, key=lambda entry: entry[2][0])[:5])
+            print(f"Warning: {d.keys} duplicate keys ({d.rows} rows) in {name}: {examples}")
+    if report_path:
+        write_duplicate_keys_report(report_path, key_cols, duplicates, names)
+        print(f"Duplicate key report generated: {report_path}")
+
+
+def keyed_chunk_groups(chunk_iters, key_cols, chunk_size, partitions, spill_dir=None, start_line=1, end_line=None, on_chunk=None, align=None,
+                       duplicates=None):
+    # Out-of-core hash join: every input is partitioned by key hash on disk, then each set of partitions is
+    # joined in memory, so memory is bounded by the largest partition rather than the input size. A key's rows all
+    # land in one partition, so duplicates are found there while it is loaded, without another read of the input
+    align = align or (lambda frames: align_layers_on_keys(frames, key_cols))
+    directory = tempfile.mkdtemp(prefix='compare_spill_', dir=spill_dir)
+    try:
+        spilled = [spill_by_key(chunks, key_cols, partitions, directory, 'file{}_'.format(i + 1), start_line, end_line, on_chunk)
+                   for i, chunks in enumerate(chunk_iters)]
+        for paths in zip(*spilled):
+            frames = [load_spilled(path) for path in paths]
+            if duplicates is not None:
+                for found, frame in zip(duplicates, frames):
+                    if frame is not None:
+                        found.add(find_duplicate_keys(frame, key_cols))
+            present = [frame for frame in frames if frame is not None]
+            if not present:
+                continue
+            frames = [present[0].iloc[:0] if frame is None else frame for frame in frames]
+            if any(set(frame.columns) != set(frames[0].columns) for frame in frames):
+                raise ValueError("CSV files have different columns")
+            aligned = align(frames)
+            for start in range(0, len(aligned[0]), chunk_size):
+                yield [layer.iloc[start:start + chunk_size] for layer in aligned]
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+def keyed_chunk_pairs(chunks1, chunks2, key_cols, chunk_size, partitions, spill_dir=None, start_line=1, end_line=None, on_chunk=None,
+                      duplicates=None):
+    groups = keyed_chunk_groups([chunks1, chunks2], key_cols, chunk_size, partitions, spill_dir, start_line, end_line, on_chunk,
+                                align=lambda frames: align_on_keys(frames[0], frames[1], key_cols), duplicates=duplicates)
+    for chunk1, chunk2 in groups:
+        yield chunk1, chunk2, None
+
+
+def numbered_chunks(chunks, start_line=1, end_line=None):
+    line = start_line
+    for chunk in chunks:
+        if 'line_number' not in chunk.columns:
+            # Filtered readers number their rows (and stop at end_line) themselves
+            if end_line and line + len(chunk) - 1 > end_line:
+                chunk = chunk.head(end_line - line + 1)
+            chunk = chunk.assign(line_number=np.arange(line, line + len(chunk)))
+            line += len(chunk)
+        yield chunk
+        if end_line and line > end_line:
+            break
+
+
+def aligned_slices(frame1, frame2, key_cols, chunk_size, duplicates=None):
+    if duplicates is not None:
+        duplicates[0].add(find_duplicate_keys(frame1, key_cols))
+        duplicates[1].add(find_duplicate_keys(frame2, key_cols))
+    if set(frame1.columns) != set(frame2.columns):
+        raise ValueError("CSV files have different columns")
+    aligned1, aligned2 = align_on_keys(frame1, frame2, key_cols)
+    for start in range(0, len(aligned1), chunk_size):
+        yield aligned1.iloc[start:start + chunk_size], aligned2.iloc[start:start + chunk_size], None
+
+
+def hash_join_pairs(chunks1, chunks2, key_cols, chunk_size, start_line=1, end_line=None, on_chunk=None, duplicates=None):
+    # In-memory hash join: both inputs are loaded and joined at once, with no spill files; only chosen when
+    # both fit comfortably in memory
+    frames = []
+    for chunks in (chunks1, chunks2):
+        loaded = []
+        for chunk in numbered_chunks(chunks, start_line, end_line):
+            loaded.append(chunk)
+            if on_chunk:
+                on_chunk(len(chunk))
+        frames.append(pd.concat(loaded) if loaded else None)
+    frame1, frame2 = frames
+    if frame1 is None and frame2 is None:
+        return
+    frame1 = frame1 if frame1 is not None else frame2.iloc[:0]
+    frame2 = frame2 if frame2 is not None else frame1.iloc[:0]
+    yield from aligned_slices(frame1, frame2, list(key_cols), chunk_size, duplicates)
+
+
+def merge_keys(frame, key_cols, key_order):
+    # Sort keys as one comparable array: numbers for a numeric key, otherwise the key columns joined with NUL,
+    # which orders like the tuple of key values
+    if key_order == 'numeric':
+        return pd.to_numeric(frame[key_cols[0]], errors='coerce').to_numpy(dtype=float)
+    keys = frame[key_cols[0]].astype(str)
+    for col in key_cols[1:]:
+        keys = keys.str.cat(frame[col].astype(str), sep='\x00')
+    return keys.to_numpy(dtype=object)
+
+
+class UnsortedKeysError(ValueError):
+    pass
+
+
+def sorted_merge_pairs(chunks1, chunks2, key_cols, chunk_size, start_line=1, end_line=None, on_chunk=None, duplicates=None, key_order='text'):
+    # Sorted merge join: both inputs are consumed in key order and every key below the smaller of the two
+    # buffered maxima is joined and released, so memory holds about one chunk per side however large the inputs
+    key_cols = list(key_cols)
+    iterators = [iter(numbered_chunks(chunks, start_line, end_line)) for chunks in (chunks1, chunks2)]
+    buffers = [None, None]
+    keys = [None, None]
+    exhausted = [False, False]
+
+    def fill(side):
+        chunk = next(iterators[side], None)
+        if chunk is None:
+            exhausted[side] = True
+            return
+        if on_chunk:
+            on_chunk(len(chunk))
+        chunk_keys = merge_keys(chunk, key_cols, key_order)
+        if key_order == 'numeric' and np.isnan(chunk_keys).any():
+            raise ValueError(f"file{side + 1} has a non-numeric key near line {int(chunk['line_number'].iloc[0])}")
+        previous = keys[side][-1:] if keys[side] is not None and len(keys[side]) else chunk_keys[:0]
+        ordered = np.concatenate([previous, chunk_keys])
+        unsorted = np.flatnonzero(ordered[1:] < ordered[:-1])
+        if len(unsorted):
+            line = int(chunk['line_number'].iloc[unsorted[0] + 1 - len(previous)])
+            raise UnsortedKeysError(f"file{side + 1} is not sorted by key at line {line}")
+        buffers[side] = chunk if buffers[side] is None else pd.concat([buffers[side], chunk])
+        keys[side] = chunk_keys if keys[side] is None else np.concatenate([keys[side], chunk_keys])
+
+    while True:
+        for side in (0, 1):
+            while not exhausted[side] and (buffers[side] is None or len(buffers[side]) < chunk_size):
+                fill(side)
+        open_sides = [side for side in (0, 1) if not exhausted[side] and len(keys[side])]
+        if not open_sides and all(buffer is None or not len(buffer) for buffer in buffers):
+            return
+        if open_sides:
+            # Rows equal to the bound may continue in the next chunk, so only keys strictly below it are final
+            bound = min(keys[side][-1] for side in open_sides)
+            cuts = [int(np.searchsorted(keys[side], bound, side='left')) if keys[side] is not None else 0 for side in (0, 1)]
+        else:
+            cuts = [len(keys[side]) if keys[side] is not None else 0 for side in (0, 1)]
+        if not any(cuts):
+            # Every buffered row shares the bound key; read on until it is complete
+            for side in open_sides:
+                if keys[side][-1] == bound:
+                    fill(side)
+            continue
+        taken = []
+        for side in (0, 1):
+            buffer = buffers[side] if buffers[side] is not None else buffers[1 - side].iloc[:0]
+            taken.append(buffer.iloc[:cuts[side]])
+            if buffers[side] is not None:
+                buffers[side], keys[side] = buffers[side].iloc[cuts[side]:], keys[side][cuts[side]:]
+        yield from aligned_slices(taken[0], taken[1], key_cols, chunk_size, duplicates)
+
+
+STRATEGIES = ('auto', 'position', 'merge', 'hash', 'partition')
+KEYED_STRATEGIES = ('merge', 'hash', 'partition')
+PLAN_SAMPLE_ROWS = 10000
+# Per-unit costs in seconds, measured on one core with pandas 3 (narrow CSV); only their ratios drive the choice
+PLAN_COSTS = {
+    'parse_byte': 4.5e-8,
+    'compare_cell': 1e-8,
+    'join_row': 1.9e-6,
+    'sort_row': 5e-8,
+    'spill_row': 6e-7,
+    'spill_byte': 5e-9,
+}
+# A full in-memory join holds both inputs plus the joined copy and its sort order
+JOIN_MEMORY_FACTOR = 3
+PIPELINE_MIN_BYTES = 64 * 1024 * 1024
+
+
+def available_memory():
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    try:
+        return os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+    except (ValueError, OSError, AttributeError):
+        return None
+
+
+def sample_input(path, delimiter=',', sheet=None, header_row=1, json_columns=None, fixed_width_layout=None, fixed_width_encoding='utf-8',
+                 normalizer=None):
+    with open_input(path) as handle:
+        reader = open_chunk_reader(path, handle, PLAN_SAMPLE_ROWS, delimiter, None, sheet, header_row, json_columns, fixed_width_layout,
+                                   fixed_width_encoding)
+        iterator = iter(reader)
+        try:
+            sample = next(iterator, None)
+        finally:
+            close = getattr(iterator, 'close', None)
+            if close:
+                close()
+    if sample is not None and normalizer:
+        sample = normalizer.apply(sample)
+    return sample
+
+
+def key_order_of(sample, key_cols):
+    # 'numeric' or 'text' when the sampled keys are non-decreasing in that order, else None
+    if sample is None or not len(sample):
+        return 'text'
+    if len(key_cols) == 1:
+        numbers = pd.to_numeric(sample[key_cols[0]], errors='coerce').to_numpy(dtype=float)
+        if not np.isnan(numbers).any():
+            return 'numeric' if np.all(numbers[1:] >= numbers[:-1]) else None
+    keys = merge_keys(sample, key_cols, 'text')
+    return 'text' if np.all(keys[1:] >= keys[:-1]) else None
+
+
+def plan_comparison(file1, file2, key_cols=None, match_by=None, compare_cols=None, delimiter=',', threads=None, pipeline_depth=None,
+                    memory=None, sheet1=None, sheet2=None, **sample_options):
+    # Samples the head of both inputs for row width, row count, key order and key cardinality, prices every
+    # strategy that is correct for them and picks the cheapest; also settles threads and pipelining when not given
+    sizes = [input_size(file1), input_size(file2)]
+    samples = [sample_input(file1, delimiter, sheet1, **sample_options), sample_input(file2, delimiter, sheet2, **sample_options)]
+    rows, memory_per_row = [], []
+    for size, sample in zip(sizes, samples):
+        count = len(sample) if sample is not None else 0
+        if count < PLAN_SAMPLE_ROWS:
+            rows.append(count)
+        else:
+            text_bytes = len(sample.to_csv(index=False).encode()) / count
+            rows.append(int(size / max(text_bytes, 1)))
+        memory_per_row.append(sample.memory_usage(deep=True, index=False).sum() / count if count else 0)
+    columns = len(compare_cols) if compare_cols else max((len(sample.columns) for sample in samples if sample is not None), default=0)
+    total_rows = sum(rows)
+    total_memory = sum(r * m for r, m in zip(rows, memory_per_row))
+    key_cols = list(key_cols or [])
+    orders = [key_order_of(sample, key_cols) for sample in samples] if key_cols else [None, None]
+    if key_cols and all(sample is not None for sample in samples):
+        distinct = [sample[key_cols].drop_duplicates().shape[0] / len(sample) if len(sample) else 1.0 for sample in samples]
+    else:
+        distinct = [1.0, 1.0]
+
+    # Repeated keys multiply out in a join: every copy pairs with every copy on the other side
+    fan_out = 1 / max(min(distinct), 1e-6)
+    base = PLAN_COSTS['parse_byte'] * sum(sizes) + PLAN_COSTS['compare_cell'] * max(rows) * columns
+    join = PLAN_COSTS['join_row'] * total_rows * fan_out
+    costs = {}
+    reasons = {}
+    memory = memory if memory is not None else available_memory()
+    if not key_cols or match_by == 'position':
+        costs['position'] = base
+        reasons['position'] = 'no key columns' if not key_cols else 'matching by position was requested'
+    else:
+        # Keys lining up in the sampled heads say nothing about the rest of the files, so with key columns
+        # position is never chosen unless asked for
+        if orders[0] and orders[0] == orders[1]:
+            costs['merge'] = base + join
+            reasons['merge'] = f'both samples sorted by key, {orders[0]} order'
+        budget = memory / 2 if memory else None
+        if budget is None or total_memory * JOIN_MEMORY_FACTOR * fan_out <= budget:
+            costs['hash'] = base + join + PLAN_COSTS['sort_row'] * total_rows * math.log2(max(total_rows, 2))
+            reasons['hash'] = 'both inputs fit in memory'
+        costs['partition'] = (base + join + PLAN_COSTS['spill_row'] * total_rows + 2 * PLAN_COSTS['spill_byte'] * total_memory
+                              + PLAN_COSTS['sort_row'] * total_rows * math.log2(max(total_rows / key_partitions(sum(sizes)), 2)))
+        reasons['partition'] = 'out-of-core hash partitions fit any input'
+    strategy = min(costs, key=lambda name: (costs[name], STRATEGIES.index(name)))
+    if threads is None:
+        threads = resolve_threads(None, columns)
+    if pipeline_depth is None:
+        # Overlapping reads with comparison pays once there is more than one core and enough data to hide
+        pipeline_depth = 2 if (os.cpu_count() or 1) > 1 and sum(sizes) >= PIPELINE_MIN_BYTES else 0
+    return {
+        'strategy': strategy,
+        'reason': reasons[strategy],
+        'estimated_seconds': costs[strategy],
+        'costs': costs,
+        'rows': rows,
+        'key_order': orders[0] if strategy == 'merge' else None,
+        'key_distinct_ratio': distinct,
+        'threads': threads,
+        'pipeline_depth': pipeline_depth,
+    }
+
+
+def describe_plan(plan):
+    others = ', '.join(f'{name} {cost:.2f}s' for name, cost in plan['costs'].items() if name != plan['strategy'])
+    return ("Strategy: {} ({}); estimated cost {:.2f}s{}; about {} + {} rows; threads {}, pipeline depth {}".format(
+        plan['strategy'], plan['reason'], plan['estimated_seconds'], f' (vs {others})' if others else '', plan['rows'][0], plan['rows'][1],
+        plan['threads'], plan['pipeline_depth']))
+
+
+JSON_EXTENSIONS = ('.json', '.jsonl', '.ndjson')
+JSON_READ_SIZE = 1024 * 1024
+JSON_SCHEMA_SAMPLE = 10000
+JSON_PLAN_CACHE_SIZE = 10000
+
+
+def is_json_file(path):
+    return path.lower().endswith(JSON_EXTENSIONS)
+
+
+def iter_json_records(handle, read_size=None):
+    # Incremental decoder for a top-level array, JSON Lines or concatenated documents: only the record
+    # being decoded (plus one read buffer) is ever held in memory
+    read_size = read_size or JSON_READ_SIZE
+    decoder = json.JSONDecoder()
+    text_decoder = codecs.getincrementaldecoder('utf-8-sig')()
+    buf, pos, eof, in_array = '', 0, False, None
+    while True:
+        while True:
+            while pos < len(buf) and (buf[pos].isspace() or (in_array and buf[pos] == ',')):
+                pos += 1
+            if pos < len(buf) or eof:
+                break
+            data = handle.read(read_size)
+            eof = not data
+            buf, pos = text_decoder.decode(data, final=eof), 0
+        if pos >= len(buf):
+            return
+        if in_array is None:
+            in_array = buf[pos] == '['
+            if in_array:
+                pos += 1
+                continue
+        if in_array and buf[pos] == ']':
+            return
+        try:
+            record, end = decoder.raw_decode(buf, pos)
+            complete = end < len(buf) or eof
+        except json.JSONDecodeError:
+            if eof:
+                raise
+            complete = False
+        if not complete:
+            data = handle.read(read_size)
+            eof = not data
+            buf, pos = buf[pos:] + text_decoder.decode(data, final=eof), 0
+            continue
+        yield record
+        pos = end
+
+
+def json_text(value):
+    if value is None:
+        return ''
+    if isinstance(value, str):
+        return value
+    if isinstance(value, bool):
+        return 'true' if value else 'false'
+    if isinstance(value, (list, dict)):
+        return json.dumps(value, separators=(',', ':'), sort_keys=True)
+    return json.dumps(value)
+
+
+class JsonFlattener:
+    # Flattens nested objects into dotted paths (as JSONComparator.java does); arrays stay whole as JSON text.
+    # The path plan is cached per object shape, so records sharing a layout skip the key/path string work
+    def __init__(self):
+        self.plans = {}
+
+    def flatten(self, record, prefix='', out=None):
+        if out is None:
+            out = {}
+            if not isinstance(record, dict):
+                out['value'] = json_text(record)
+                return out
+        plan_key = (prefix, tuple(record))
+        plan = self.plans.get(plan_key)
+        if plan is None:
+            if len(self.plans) >= JSON_PLAN_CACHE_SIZE:
+                self.plans.clear()
+            plan = [(key, prefix + '.' + key if prefix else key) for key in record]
+            self.plans[plan_key] = plan
+        for key, path in plan:
+            value = record[key]
+            if isinstance(value, dict) and value:
+                self.flatten(value, path, out)
+            else:
+                out[path] = json_text(value)
+        return out
+
+
+def discover_json_schema(paths, sample_records=JSON_SCHEMA_SAMPLE):
+    # The column set is fixed up front from the first records of each file so every chunk has the same shape
+    flattener = JsonFlattener()
+    columns = {}
+    for path in paths:
+        with open_input(path) as handle:
+            for i, record in enumerate(iter_json_records(handle)):
+                if i >= sample_records:
+                    break
+                for column in flattener.flatten(record):
+                    columns.setdefault(column)
+    return list(columns)
+
+
+class JsonChunkReader:
+    def __init__(self, handle, chunk_size, columns, skiprows=None):
+        self.handle = handle
+        self.chunk_size = chunk_size
+        self.columns = list(columns)
+        self.skiprows = skiprows
+        self.unmapped_paths = set()
+
+    def frame(self, records, first_index):
+        frame = pd.DataFrame.from_records(records, columns=self.columns, index=range(first_index, first_index + len(records)))
+        return frame.fillna('').astype(str)
+
+    def __iter__(self):
+        flattener = JsonFlattener()
+        known = set(self.columns)
+        buffer, first_index, line_index = [], 0, 0
+        for record in iter_json_records(self.handle):
+            line_index += 1
+            if row_skipped(self.skiprows, line_index):
+                continue
+            flat = flattener.flatten(record)
+            if len(known) < len(flat) or not known.issuperset(flat):
+                self.unmapped_paths.update(flat.keys() - known)
+            buffer.append(flat)
+            if len(buffer) == self.chunk_size:
+                yield self.frame(buffer, first_index)
+                first_index += len(buffer)
+                buffer = []
+        if buffer:
+            yield self.frame(buffer, first_index)
+
+
+DEFAULT_BLOCK_LINES = 100000
+MANIFEST_READ_SIZE = 64 * 1024 * 1024
+
+
+def new_block_hasher():
+    return hashlib.blake2b(digest_size=16)
+
+
+def build_manifest(path, block_lines=DEFAULT_BLOCK_LINES):
+    # Hash the header and every run of block_lines physical lines; block i covers the same line range in
+    # any file built with the same block_lines, so two manifests line up block by block
+    blocks = []
+    with open(path, 'rb') as fh:
+        header = fh.readline()
+        offset = len(header)
+        block_offset, block_length, block_line_count, first_line = offset, 0, 0, 1
+        hasher = new_block_hasher()
+        last_byte = b''
+        while True:
+            buf = fh.read(MANIFEST_READ_SIZE)
+            if not buf:
+                break
+            view = memoryview(buf)
+            newlines = np.flatnonzero(np.frombuffer(buf, dtype=np.uint8) == 10)
+            pos, idx = 0, 0
+            while idx + (block_lines - block_line_count) <= len(newlines):
+                idx += block_lines - block_line_count
+                end = int(newlines[idx - 1]) + 1
+                hasher.update(view[pos:end])
+                block_length += end - pos
+                blocks.append([block_offset, block_length, first_line, block_lines, hasher.hexdigest()])
+                first_line += block_lines
+                block_offset += block_length
+                block_length, block_line_count, pos = 0, 0, end
+                hasher = new_block_hasher()
+            hasher.update(view[pos:])
+            block_length += len(buf) - pos
+            block_line_count += len(newlines) - idx
+            last_byte = buf[-1:]
+        if block_length:
+            if last_byte != b'\n':
+                block_line_count += 1
+            blocks.append([block_offset, block_length, first_line, block_line_count, hasher.hexdigest()])
+
+    header_hasher = new_block_hasher()
+    header_hasher.update(header)
+    return {
+        'version': 1,
+        'file': os.path.basename(path),
+        'size': os.path.getsize(path),
+        'block_lines': block_lines,
+        'algorithm': 'blake2b-128',
+        'header': {'length': len(header), 'digest': header_hasher.hexdigest()},
+        # offset, length, first_line, line_count, digest
+        'blocks': blocks,
+    }
+
+
+def write_manifest(manifest, path):
+    with open(path, 'w') as mf:
+        json.dump(manifest, mf, separators=(',', ':'))
+
+
+def load_manifest(path):
+    with open(path) as mf:
+        return json.load(mf)
+
+
+def diff_manifests(manifest1, manifest2):
+    if manifest1['block_lines'] != manifest2['block_lines']:
+        raise ValueError("Manifests were built with different block sizes ({} vs {} lines)".format(manifest1['block_lines'], manifest2['block_lines']))
+    blocks1, blocks2 = manifest1['blocks'], manifest2['blocks']
+    differing = [i for i in range(min(len(blocks1), len(blocks2))) if blocks1[i][4] != blocks2[i][4]]
+    return {
+        'header_match': manifest1['header']['digest'] == manifest2['header']['digest'],
+        'blocks1': len(blocks1),
+        'blocks2': len(blocks2),
+        'differing_blocks': differing,
+        # Blocks past the end of the shorter file have nothing to pair with positionally
+        'unpaired_blocks': list(range(min(len(blocks1), len(blocks2)), max(len(blocks1), len(blocks2)))),
+    }
+
+
+def extract_blocks(path, manifest, other_manifest, output_path):
+    # Copy the header plus only the blocks whose digest differs from the other side, and return a manifest
+    # whose offsets point into the extract, ready to be shipped and compared in place of the full file
+    block_ids = set(diff_manifests(manifest, other_manifest)['differing_blocks'])
+    extract_manifest = dict(manifest, file=os.path.basename(output_path), blocks=[])
+    with open(path, 'rb') as src, open(output_path, 'wb') as dst:
+        header = src.read(manifest['header']['length'])
+        dst.write(header)
+        offset = len(header)
+        for i, (block_offset, length, first_line, line_count, digest) in enumerate(manifest['blocks']):
+            if i in block_ids:
+                src.seek(block_offset)
+                dst.write(src.read(length))
+                extract_manifest['blocks'].append([offset, length, first_line, line_count, digest])
+                offset += length
+            else:
+                extract_manifest['blocks'].append([None, length, first_line, line_count, digest])
+    extract_manifest['size'] = offset
+    return extract_manifest
+
+
+def manifest_chunk_pairs(handle1, handle2, manifest1, manifest2, chunk_size, delimiter, surplus=None):
+    # Yields (chunk1, chunk2, first_line) for blocks whose digests differ and (None, None, (first_line, line_count))
+    # for identical blocks, which are never read or parsed. Records with nothing to pair with, in a block that
+    # is longer on one side or in blocks past the end of the shorter file, are counted per file in surplus
+    surplus = surplus if surplus is not None else [0, 0]
+    diff = diff_manifests(manifest1, manifest2)
+    differing = set(diff['differing_blocks'])
+    header1 = handle1.read(manifest1['header']['length'])
+    header2 = handle2.read(manifest2['header']['length'])
+    if not diff['header_match']:
+        # Line endings or quoting may differ, but the columns themselves must agree
+        columns1 = list(pd.read_csv(io.BytesIO(header1), nrows=0, delimiter=delimiter).columns)
+        columns2 = list(pd.read_csv(io.BytesIO(header2), nrows=0, delimiter=delimiter).columns)
+        if columns1 != columns2:
+            raise ValueError("CSV files have different columns")
+    for i in range(min(diff['blocks1'], diff['blocks2'])):
+        block1, block2 = manifest1['blocks'][i], manifest2['blocks'][i]
+        if i not in differing:
+            yield None, None, (block1[2], block1[3])
+            continue
+        if block1[0] is None or block2[0] is None:
+            raise ValueError("Block {} differs but is not present in the supplied file".format(i))
+        handle1.seek(block1[0])
+        handle2.seek(block2[0])
+        data1 = io.BytesIO(header1 + handle1.read(block1[1]))
+        data2 = io.BytesIO(header2 + handle2.read(block2[1]))
+        chunks1 = pd.read_csv(data1, chunksize=chunk_size, dtype=str, delimiter=delimiter, keep_default_na=False)
+        chunks2 = pd.read_csv(data2, chunksize=chunk_size, dtype=str, delimiter=delimiter, keep_default_na=False)
+        first_line = block1[2]
+        for chunk1, chunk2 in positional_groups([chunks1, chunks2], surplus):
+            yield chunk1, chunk2, first_line
+            first_line += len(chunk1)
+    # Unpaired blocks are never read: their line counts from the manifest are the records they hold
+    for i in diff['unpaired_blocks']:
+        if i < diff['blocks1']:
+            surplus[0] += manifest1['blocks'][i][3]
+        else:
+            surplus[1] += manifest2['blocks'][i][3]
+
+
+EXCEL_EXTENSIONS = ('.xlsx', '.xlsm')
+
+
+def is_excel_file(path):
+    return path.lower().endswith(EXCEL_EXTENSIONS)
+
+
+def excel_cell_text(value):
+    # Render cells the way they read in a CSV export so Excel and CSV inputs compare alike
+    if value is None:
+        return ''
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    if isinstance(value, datetime.datetime):
+        return value.date().isoformat() if value.time() == datetime.time() else value.isoformat(sep=' ')
+    if isinstance(value, (datetime.date, datetime.time)):
+        return value.isoformat()
+    return str(value)
+
+
+def row_skipped(skiprows, line_index):
+    # Applies pd.read_csv's skiprows semantics (a range or a callable over line indexes) to other readers
+    if skiprows is None:
+        return False
+    if callable(skiprows):
+        return skiprows(line_index)
+    return line_index in skiprows
+
+
+class XlsxChunkReader:
+    # Streams a worksheet in openpyxl's read-only mode one row at a time and yields DataFrame chunks
+    # shaped like pd.read_csv(chunksize=...) output, so memory stays flat however long the sheet is
+    def __init__(self, path, chunk_size, sheet=None, header_row=1, skiprows=None):
+        from openpyxl import load_workbook
+
+        self.workbook = load_workbook(path, read_only=True, data_only=True)
+        # A sheet may well be named "2024", so a number is only taken as an index when no sheet has that name
+        if sheet is None:
+            self.worksheet = self.workbook.worksheets[0]
+        elif str(sheet) in self.workbook.sheetnames:
+            self.worksheet = self.workbook[str(sheet)]
+        elif str(sheet).isdigit():
+            self.worksheet = self.workbook.worksheets[int(sheet)]
+        else:
+            self.worksheet = self.workbook[sheet]
+        self.chunk_size = chunk_size
+        self.header_row = header_row
+        self.skiprows = skiprows
+        self.size = os.path.getsize(path)
+        self.total_rows = self.worksheet.max_row or 0
+        self.rows_read = 0
+
+    def bytes_consumed(self):
+        # The zipped XML gives no byte offset, so estimate it from the sheet dimension
+        if not self.total_rows:
+            return 0
+        return int(self.size * min(self.rows_read / self.total_rows, 1.0))
+
+    def __iter__(self):
+        try:
+            rows = self.worksheet.iter_rows(min_row=self.header_row, values_only=True)
+            header = [excel_cell_text(v) for v in next(rows, ())]
+            while header and header[-1] == '':
+                header.pop()
+            width = len(header)
+            buffer, first_index = [], 0
+            line_index = 0
+            for row in rows:
+                self.rows_read += 1
+                values = [excel_cell_text(v) for v in row[:width]]
+                # Blank rows are dropped, as pd.read_csv drops blank lines
+                if not any(values):
+                    continue
+                line_index += 1
+                if row_skipped(self.skiprows, line_index):
+                    continue
+                values.extend([''] * (width - len(values)))
+                buffer.append(values)
+                if len(buffer) == self.chunk_size:
+                    yield pd.DataFrame(buffer, columns=header, dtype=str, index=range(first_index, first_index + len(buffer)))
+                    first_index += len(buffer)
+                    buffer = []
+            if buffer:
+                yield pd.DataFrame(buffer, columns=header, dtype=str, index=range(first_index, first_index + len(buffer)))
+        finally:
+            self.workbook.close()
+
+
+def load_fixed_width_layout(path):
+    # One field per line: name,start,length with a 1-based start column, as in a copybook listing.
+    # A header line and # comments are allowed
+    fields = []
+    with open(path, newline='') as f:
+        for row in csv.reader(f):
+            if not row or not row[0].strip() or row[0].strip().startswith('#'):
+                continue
+            name, start, length = (value.strip() for value in row[:3])
+            if not start.isdigit():
+                continue
+            if int(start) < 1 or int(length) < 1:
+                raise ValueError(f"Invalid layout entry for {name}: start and length must be positive")
+            fields.append((name, int(start) - 1, int(length)))
+    if not fields:
+        raise ValueError(f"No fields found in layout file {path}")
+    if len({name for name, _, _ in fields}) != len(fields):
+        raise ValueError(f"Duplicate field names in layout file {path}")
+    return fields
+
+
+class FixedWidthChunkReader:
+    # Slices fixed-width records straight out of a memory map with numpy: a chunk of records becomes a
+    # rows x record-width byte matrix (a zero-copy reshape when every record has the same length) and each
+    # field is one column slice of it, so no Python code runs per line or per field. Records of differing
+    # lengths are gathered one field at a time instead, so no matrix wider than a field is built
+    def __init__(self, handle, chunk_size, layout, skiprows=None, encoding='utf-8'):
+        self.handle = handle
+        self.chunk_size = chunk_size
+        self.layout = layout
+        self.skiprows = skiprows
+        self.encoding = encoding
+        self.width = max(start + length for _, start, length in layout)
+        self.size = os.fstat(handle.fileno()).st_size
+        self.offset = 0
+
+    def bytes_consumed(self):
+        return self.offset
+
+    def field_values(self, field, length):
+        raw = np.ascontiguousarray(field).view('S{}'.format(length)).ravel()
+        try:
+            values = raw.astype('U{}'.format(length))
+        except UnicodeDecodeError:
+            values = np.char.decode(raw, self.encoding)
+        return pd.Series(values, dtype=str).str.strip()
+
+    def kept(self, line_indexes):
+        if isinstance(self.skiprows, range):
+            return (line_indexes < self.skiprows.start) | (line_indexes >= self.skiprows.stop)
+        return np.array([not row_skipped(self.skiprows, i) for i in line_indexes], dtype=bool)
+
+    def ragged_field(self, buffer, starts, lengths, start, length):
+        # Bytes past the end of a short record read as spaces
+        columns = np.arange(start, start + length)
+        index = np.minimum(starts[:, None] + columns, len(buffer) - 1)
+        return np.where(columns < lengths[:, None], buffer[index], np.uint8(ord(' '))).astype(np.uint8)
+
+    def frame(self, field, line_indexes):
+        frame = pd.DataFrame({name: self.field_values(field(start, length), length) for name, start, length in self.layout})
+        frame.index = line_indexes - 1
+        return frame
+
+    def __iter__(self):
+        if self.size == 0:
+            return
+        data = mmap.mmap(self.handle.fileno(), 0, access=mmap.ACCESS_READ)
+        records = None
+        try:
+            buffer = np.frombuffer(data, dtype=np.uint8)
+            newline = ord('\n')
+            first_line = 1
+            while self.offset < self.size:
+                # Find the end of the next chunk_size records without scanning further than needed
+                window = min(self.size - self.offset, max(self.chunk_size * (self.width + 2), 1 << 20))
+                while True:
+                    ends = np.flatnonzero(buffer[self.offset:self.offset + window] == newline)
+                    if len(ends) >= self.chunk_size or self.offset + window >= self.size:
+                        break
+                    window = min(self.size - self.offset, window * 2)
+                ends = ends[:self.chunk_size] + self.offset
+                if len(ends) < self.chunk_size and (not len(ends) or ends[-1] + 1 < self.size):
+                    ends = np.append(ends, self.size)
+                starts = np.concatenate(([self.offset], ends[:-1] + 1))
+                lengths = ends - starts
+                lengths = lengths - ((lengths > 0) & (buffer[np.maximum(ends - 1, 0)] == ord('\r')))
+                line_indexes = np.arange(first_line, first_line + len(starts))
+                first_line += len(starts)
+                self.offset = int(ends[-1]) + 1
+                if not lengths.all():
+                    # Blank lines carry no record, as with read_csv
+                    starts, lengths, line_indexes = starts[lengths > 0], lengths[lengths > 0], line_indexes[lengths > 0]
+                    if not len(starts):
+                        continue
+                if self.skiprows is not None:
+                    keep = self.kept(line_indexes)
+                    starts, lengths, line_indexes = starts[keep], lengths[keep], line_indexes[keep]
+                    if not len(starts):
+                        continue
+                stride = int(starts[1] - starts[0]) if len(starts) > 1 else 0
+                if len(starts) > 1 and np.all(np.diff(starts) == stride) and np.all(lengths == lengths[0]):
+                    # Uniform records: view the chunk as a matrix without copying
+                    records = np.lib.stride_tricks.as_strided(buffer[starts[0]:], shape=(len(starts), int(lengths[0])),
+                                                              strides=(stride, 1), writeable=False)
+                    if records.shape[1] < self.width:
+                        records = np.pad(records, ((0, 0), (0, self.width - records.shape[1])), constant_values=ord(' '))
+                    frame = self.frame(lambda start, length: records[:, start:start + length], line_indexes)
+                else:
+                    frame = self.frame(lambda start, length: self.ragged_field(buffer, starts, lengths, start, length), line_indexes)
+                records = None
+                if len(frame):
+                    yield frame
+        finally:
+            # Views into the map must be gone before it can be closed
+            buffer = records = None
+            data.close()
+
+
+WHERE_COMPARISONS = {
+    ast.Eq: lambda values, value: values == value,
+    ast.NotEq: lambda values, value: values != value,
+    ast.Lt: lambda values, value: values < value,
+    ast.LtE: lambda values, value: values <= value,
+    ast.Gt: lambda values, value: values > value,
+    ast.GtE: lambda values, value: values >= value,
+}
+
+
+class RowFilter:
+    # Compiled --where expression such as
+    #   region == 'EMEA' and as_of_date >= '2024-01-01' and amount > 100 and status in ('open', 'held')
+    # Columns are bare names (or col('name with spaces')); a numeric literal compares the column as numbers
+    # (non-numbers never match), a string literal compares the text as read
+    def __init__(self, expression):
+        self.expression = expression
+        try:
+            tree = ast.parse(expression, mode='eval').body
+        except SyntaxError as e:
+            raise ValueError(f"Invalid --where expression: {expression}") from e
+        self.tree = self.compile(tree)
+        self.columns = sorted(self.collect_columns(self.tree))
+
+    def literal(self, node):
+        if isinstance(node, ast.UnaryOp) and isinstance(node.op, ast.USub) and isinstance(node.operand, ast.Constant):
+            return -self.literal(node.operand)
+        if isinstance(node, ast.Constant) and isinstance(node.value, (str, int, float)) and not isinstance(node.value, bool):
+            return node.value
+        raise ValueError(f"Unsupported value in --where expression: {ast.unparse(node)}")
+
+    def column(self, node):
+        if isinstance(node, ast.Name):
+            return node.id
+        if (isinstance(node, ast.Call) and isinstance(node.func, ast.Name) and node.func.id == 'col' and len(node.args) == 1
+                and not node.keywords and isinstance(node.args[0], ast.Constant) and isinstance(node.args[0].value, str)):
+            return node.args[0].value
+        raise ValueError(f"Expected a column in --where expression: {ast.unparse(node)}")
+
+    def compile(self, node):
+        # Nested tuples: ('and'|'or', [terms]), ('not', term), ('cmp', column, op, value), ('in', column, values, negated)
+        if isinstance(node, ast.BoolOp):
+            return ('and' if isinstance(node.op, ast.And) else 'or', [self.compile(value) for value in node.values])
+        if isinstance(node, ast.UnaryOp) and isinstance(node.op, ast.Not):
+            return ('not', self.compile(node.operand))
+        if isinstance(node, ast.Compare):
+            terms = []
+            left = node.left
+            for op, right in zip(node.ops, node.comparators):
+                if isinstance(op, (ast.In, ast.NotIn)):
+                    if not isinstance(right, (ast.Tuple, ast.List, ast.Set)):
+                        raise ValueError(f"'in' needs a list of values in --where expression: {ast.unparse(node)}")
+                    terms.append(('in', self.column(left), [self.literal(item) for item in right.elts], isinstance(op, ast.NotIn)))
+                elif type(op) in WHERE_COMPARISONS:
+                    if isinstance(left, (ast.Name, ast.Call)):
+                        terms.append(('cmp', self.column(left), type(op), self.literal(right)))
+                    else:
+                        # Literal on the left, e.g. '2024-01-01' <= as_of_date < '2024-02-01'
+                        flipped = {ast.Lt: ast.Gt, ast.LtE: ast.GtE, ast.Gt: ast.Lt, ast.GtE: ast.LtE}.get(type(op), type(op))
+                        terms.append(('cmp', self.column(right), flipped, self.literal(left)))
+                else:
+                    raise ValueError(f"Unsupported operator in --where expression: {ast.unparse(node)}")
+                left = right
+            return terms[0] if len(terms) == 1 else ('and', terms)
+        raise ValueError(f"Unsupported --where expression: {ast.unparse(node)}")
+
+    def collect_columns(self, term):
+        if term[0] in ('and', 'or'):
+            return set().union(*(self.collect_columns(t) for t in term[1]))
+        if term[0] == 'not':
+            return self.collect_columns(term[1])
+        return {term[1]}
+
+    def evaluate(self, term, frame, numbers):
+        kind = term[0]
+        if kind in ('and', 'or'):
+            masks = [self.evaluate(t, frame, numbers) for t in term[1]]
+            return np.logical_and.reduce(masks) if kind == 'and' else np.logical_or.reduce(masks)
+        if kind == 'not':
+            return ~self.evaluate(term[1], frame, numbers)
+        column = term[1]
+        if column not in frame.columns:
+            raise ValueError(f"--where names an unknown column: {column}")
+        if column not in numbers:
+            numbers[column] = None
+        if kind == 'in':
+            values = [str(value) for value in term[2]]
+            mask = frame[column].isin(values).to_numpy(dtype=bool)
+            return ~mask if term[3] else mask
+        op, value = term[2], term[3]
+        if isinstance(value, str):
+            values = frame[column].to_numpy(dtype=object)
+        else:
+            if numbers[column] is None:
+                numbers[column] = pd.to_numeric(frame[column], errors='coerce').to_numpy(dtype=float)
+            values = numbers[column]
+        with np.errstate(invalid='ignore'):
+            mask = np.asarray(WHERE_COMPARISONS[op](values, value), dtype=bool)
+        if not isinstance(value, str) and op is ast.NotEq:
+            mask &= ~np.isnan(values)
+        return mask
+
+    def mask(self, frame):
+        # Numeric conversions are shared by every term on the same column
+        return np.asarray(self.evaluate(self.tree, frame, {}), dtype=bool).reshape(len(frame))
+
+    def statistic(self, bound, value):
+        # Parquet min/max in a form comparable with the literal, or None when they cannot be compared
+        if isinstance(value, str):
+            if isinstance(bound, (datetime.date, datetime.datetime)):
+                return bound.isoformat(sep=' ') if isinstance(bound, datetime.datetime) else bound.isoformat()
+            return bound if isinstance(bound, str) else None
+        if isinstance(bound, (int, float)) and not isinstance(bound, bool):
+            return bound
+        return None
+
+    def term_may_match(self, term, statistics):
+        kind = term[0]
+        if kind == 'and':
+            return all(self.term_may_match(t, statistics) for t in term[1])
+        if kind == 'or':
+            return any(self.term_may_match(t, statistics) for t in term[1])
+        if kind == 'not' or term[1] not in statistics or (kind == 'in' and term[3]):
+            return True
+        low, high = statistics[term[1]]
+        values = term[2] if kind == 'in' else [term[3]]
+        op = ast.Eq if kind == 'in' else term[2]
+        for value in values:
+            minimum, maximum = self.statistic(low, value), self.statistic(high, value)
+            if minimum is None or maximum is None:
+                return True
+            if op is ast.Eq and minimum <= value <= maximum:
+                return True
+            if op is ast.NotEq and not (minimum == maximum == value):
+                return True
+            if (op is ast.Lt and minimum < value) or (op is ast.LtE and minimum <= value):
+                return True
+            if (op is ast.Gt and maximum > value) or (op is ast.GtE and maximum >= value):
+                return True
+        return False
+
+    def may_match(self, statistics):
+        # False only when a row group's {column: (min, max)} statistics rule every one of its rows out
+        return self.term_may_match(self.tree, statistics)
+
+
+PARQUET_EXTENSIONS = ('.parquet', '.pq')
+
+
+def is_parquet_file(path):
+    return path.lower().endswith(PARQUET_EXTENSIONS)
+
+
+class ParquetChunkReader:
+    # Reads a Parquet file one row group at a time and renders every column as text, like a CSV read with
+    # dtype=str. With a row filter, row groups whose min/max statistics rule the filter out are never read;
+    # rows then carry their line_number so the pruned row groups do not shift the numbering
+    def __init__(self, path, chunk_size, skiprows=None, row_filter=None):
+        if pa is None:
+            raise ValueError("Parquet input requires pyarrow")
+        import pyarrow.parquet as pq
+
+        self.file = pq.ParquetFile(path)
+        self.chunk_size = chunk_size
+        self.skiprows = skiprows
+        self.row_filter = row_filter
+        self.row_groups_pruned = 0
+
+    def row_group_statistics(self, index):
+        metadata = self.file.metadata.row_group(index)
+        statistics = {}
+        for i in range(metadata.num_columns):
+            column = metadata.column(i)
+            if column.statistics is not None and column.statistics.has_min_max:
+                statistics[column.path_in_schema] = (column.statistics.min, column.statistics.max)
+        return statistics
+
+    def frame(self, batch, line_indexes):
+        frame = pa.table({name: pc.fill_null(pc.cast(column, pa.string()), '') for name, column in zip(batch.schema.names, batch.columns)}).to_pandas()
+        frame.index = line_indexes - 1
+        if self.skiprows is not None:
+            if isinstance(self.skiprows, range):
+                keep = (line_indexes < self.skiprows.start) | (line_indexes >= self.skiprows.stop)
+            else:
+                keep = np.array([not row_skipped(self.skiprows, i) for i in line_indexes], dtype=bool)
+            frame = frame[keep]
+        if self.row_filter:
+            frame['line_number'] = frame.index + 1
+        return frame
+
+    def __iter__(self):
+        first_line = 1
+        for index in range(self.file.num_row_groups):
+            rows = self.file.metadata.row_group(index).num_rows
+            if self.row_filter and not self.row_filter.may_match(self.row_group_statistics(index)):
+                self.row_groups_pruned += 1
+                first_line += rows
+                continue
+            for batch in self.file.iter_batches(batch_size=self.chunk_size, row_groups=[index]):
+                frame = self.frame(batch, np.arange(first_line, first_line + batch.num_rows))
+                first_line += batch.num_rows
+                if len(frame):
+                    yield frame
+
+
+def open_chunk_reader(path, handle, chunk_size, delimiter, skiprows, sheet=None, header_row=1, json_columns=None, fixed_width_layout=None,
+                      fixed_width_encoding='utf-8', row_filter=None):
+    # row_filter is only used to prune Parquet row groups; callers still apply it to every chunk
+    if is_parquet_file(path):
+        return ParquetChunkReader(path, chunk_size, skiprows, row_filter)
+    if is_excel_file(path):
+        return XlsxChunkReader(path, chunk_size, sheet, header_row, skiprows)
+    if is_json_file(path):
+        return JsonChunkReader(handle, chunk_size, json_columns, skiprows)
+    if fixed_width_layout:
+        return FixedWidthChunkReader(handle, chunk_size, fixed_width_layout, skiprows, fixed_width_encoding)
+    return pd.read_csv(handle, chunksize=chunk_size, dtype=str, delimiter=delimiter, keep_default_na=False, skiprows=skiprows)
+
+
+def normalize_dates(values, formats, output):
+    # Values matching none of the formats are left as they are, so they still show up as differences
+    result = values.copy()
+    pending = values != ''
+    for fmt in formats:
+        if not pending.any():
+            break
+        parsed = pd.to_datetime(values[pending], format=fmt, errors='coerce')
+        parsed = parsed[parsed.notna()]
+        result[parsed.index] = parsed.dt.strftime(output)
+        pending[parsed.index] = False
+    return result
+
+
+def normalization_step(step):
+    if isinstance(step, dict):
+        if len(step) != 1:
+            raise ValueError(f"Normalization step must have exactly one name: {step}")
+        name, options = next(iter(step.items()))
+    else:
+        name, options = step, {}
+    if name == 'trim':
+        return lambda values: values.str.strip()
+    if name == 'lower':
+        return lambda values: values.str.lower()
+    if name == 'upper':
+        return lambda values: values.str.upper()
+    if name == 'collapse_spaces':
+        return lambda values: values.str.replace(r'\s+', ' ', regex=True)
+    if name == 'strip_leading_zeros':
+        # Keeps a lone zero and any sign: '-007' becomes '-7', '000' becomes '0'
+        return lambda values: values.str.replace(r'^([+-]?)0+(?=\d)', r'\1', regex=True)
+    if name == 'date':
+        # Checked here, when the spec is parsed, rather than when the first chunk is normalized
+        formats = options.get('formats') if isinstance(options, dict) else None
+        if isinstance(options, dict) and not formats and isinstance(options.get('format'), str):
+            formats = [options['format']]
+        if not isinstance(formats, list) or not formats or not all(isinstance(fmt, str) for fmt in formats):
+            raise ValueError(f'Normalization step "date" needs "formats", a list of date formats such as ["%d/%m/%Y"]: {step}')
+        output = options.get('output', '%Y-%m-%d')
+        return lambda values: normalize_dates(values, formats, output)
+    raise ValueError(f"Unknown normalization step: {name}")
+
+
+class Normalizer:
+    # Compiled form of a normalization spec such as
+    #   {"*": ["trim"], "name": ["upper"], "account": ["strip_leading_zeros"],
+    #    "opened": [{"date": {"formats": ["%d/%m/%Y", "%Y%m%d"], "output": "%Y-%m-%d"}}]}
+    # Steps are resolved once; apply() then runs one vectorised string operation per step and column
+    def __init__(self, spec):
+        self.spec = spec
+        self.default_steps = [normalization_step(step) for step in spec.get('*', [])]
+        self.column_steps = {col: [normalization_step(step) for step in steps] for col, steps in spec.items() if col != '*'}
+        self.plan = None
+        self.plan_columns = None
+
+    def __reduce__(self):
+        # Compiled steps are closures; worker processes recompile from the spec
+        return Normalizer, (self.spec,)
+
+    def compile_plan(self, columns):
+        missing = [col for col in self.column_steps if col not in columns]
+        if missing:
+            raise ValueError(f"Normalization spec names unknown columns: {', '.join(missing)}")
+        plan = []
+        for col in columns:
+            steps = self.default_steps + self.column_steps.get(col, [])
+            if steps and col != 'line_number':
+                plan.append((col, steps))
+        return plan
+
+    def apply(self, frame):
+        columns = list(frame.columns)
+        if columns != self.plan_columns:
+            self.plan, self.plan_columns = self.compile_plan(columns), columns
+        if not self.plan:
+            return frame
+        frame = frame.copy()
+        for col, steps in self.plan:
+            values = frame[col]
+            for step in steps:
+                values = step(values)
+            frame[col] = values
+        return frame
+
+
+def load_normalization(path):
+    with open(path) as f:
+        return Normalizer(json.load(f))
+
+
+class NormalizedReader:
+    # Applies the normalizer to every chunk as it leaves the reader, before pairing, spilling or comparison
+    def __init__(self, reader, normalizer):
+        self.reader = reader
+        self.normalizer = normalizer
+        self.unmapped_paths = getattr(reader, 'unmapped_paths', set())
+
+    def bytes_consumed(self):
+        if hasattr(self.reader, 'bytes_consumed'):
+            return self.reader.bytes_consumed()
+        return None
+
+    def __iter__(self):
+        for chunk in self.reader:
+            yield self.normalizer.apply(chunk)
+
+
+class FilteredReader:
+    # Keeps the rows of each chunk that pass the row filter. Rows are numbered first (readers that prune
+    # row groups number their own), so line numbers still refer to the input, and reading stops after end_line
+    def __init__(self, reader, row_filter, start_line=1, end_line=None):
+        self.reader = reader
+        self.row_filter = row_filter
+        self.start_line = start_line
+        self.end_line = end_line
+        self.rows_read = 0
+        self.unmapped_paths = getattr(reader, 'unmapped_paths', set())
+
+    def bytes_consumed(self):
+        if hasattr(self.reader, 'bytes_consumed'):
+            return self.reader.bytes_consumed()
+        return None
+
+    def __iter__(self):
+        line = self.start_line
+        for chunk in self.reader:
+            if 'line_number' not in chunk.columns:
+                chunk = chunk.assign(line_number=np.arange(line, line + len(chunk)))
+            line_numbers = chunk['line_number'].to_numpy()
+            if len(chunk):
+                line = int(line_numbers[-1]) + 1
+            keep = self.row_filter.mask(chunk)
+            if self.end_line:
+                keep &= line_numbers <= self.end_line
+            self.rows_read += int((line_numbers <= self.end_line).sum()) if self.end_line else len(chunk)
+            yield chunk[keep]
+            if self.end_line and line > self.end_line:
+                break
+
+
+def positional_groups(readers, surplus, backend=None, start_line=1, end_line=None, counted=None, stop_early=False):
+    # Pairs rows by position even where the readers cut their chunks at different rows. Rows past the end of the
+    # shortest input (up to end_line) have nothing to pair with; they are counted per input in surplus (only those
+    # passing counted, when given) rather than silently dropped. With stop_early the rest of a longer input is not
+    # read: only the rows already buffered are counted, so surplus is a lower bound
+    backend = backend or PANDAS_BACKEND
+    iterators = [iter(reader) for reader in readers]
+    buffers = [None] * len(readers)
+    line = start_line
+    while not end_line or line <= end_line:
+        for i in range(len(buffers)):
+            while buffers[i] is None or not len(buffers[i]):
+                buffers[i] = next(iterators[i], None)
+                if buffers[i] is None:
+                    break
+        if any(buffer is None for buffer in buffers):
+            break
+        rows = min(len(buffer) for buffer in buffers)
+        yield [backend.head(buffer, rows) for buffer in buffers]
+        buffers = [backend.drop_head(buffer, rows) for buffer in buffers]
+        line += rows
+    if end_line and line > end_line:
+        return
+    for i, buffer in enumerate(buffers):
+        if stop_early:
+            chunks = [] if buffer is None else [buffer]
+        else:
+            chunks = iterators[i] if buffer is None else itertools.chain([buffer], iterators[i])
+        remaining = end_line - line + 1 if end_line else None
+        for chunk in chunks:
+            if remaining is not None:
+                chunk = backend.head(chunk, remaining)
+                remaining -= len(chunk)
+            surplus[i] += int(counted(chunk).sum()) if counted else len(chunk)
+            if remaining is not None and remaining <= 0:
+                break
+
+
+def filtered_groups(readers, row_filter, start_line=1, end_line=None, surplus=None, stop_early=False):
+    # Positional pairing with a row filter: a row survives when it passes in any input, so a row that moved
+    # out of the subset on one side still shows up as a difference
+    line = start_line
+    surplus = surplus if surplus is not None else [0] * len(readers)
+    for chunks in positional_groups(readers, surplus, None, start_line, end_line, row_filter.mask, stop_early):
+        rows = len(chunks[0])
+        if end_line:
+            rows = min(rows, end_line - line + 1)
+        chunks = [chunk.head(rows).assign(line_number=np.arange(line, line + rows)) for chunk in chunks]
+        line += rows
+        keep = np.logical_or.reduce([row_filter.mask(chunk) for chunk in chunks])
+        if keep.any():
+            yield [chunk[keep] for chunk in chunks]
+        if end_line and line > end_line:
+            break
+
+
+PIPELINE_DONE = object()
+
+
+def prefetch(iterable, depth):
+    # Runs the producer (file reads and parsing) on a background thread, at most depth items ahead of the
+    # consumer; the bounded queue is the backpressure that keeps memory at depth chunk pairs
+    items = queue.Queue(maxsize=depth)
+    stop = threading.Event()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                items.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce():
+        try:
+            for item in iterable:
+                if not put(item):
+                    return
+            put(PIPELINE_DONE)
+        except BaseException as e:
+            put(e)
+        finally:
+            if hasattr(iterable, 'close'):
+                iterable.close()
+
+    thread = threading.Thread(target=produce, name='compare-prefetch', daemon=True)
+    thread.start()
+    try:
+        while True:
+            item = items.get()
+            if item is PIPELINE_DONE:
+                return
+            if isinstance(item, BaseException):
+                raise item
+            yield item
+    finally:
+        # Stopped early (fail fast, budget, error): release the producer before the files are closed
+        stop.set()
+        thread.join()
+
+
+class PipelinedSinks:
+    # Hands comparisons to a writer thread that renders and writes them to the real sinks while the next chunk
+    # pair is compared. The bounded queue blocks the comparison when the writer falls depth chunks behind
+    def __init__(self, sinks, depth):
+        self.sinks = sinks
+        self.items = queue.Queue(maxsize=depth)
+        self.error = None
+        self.thread = threading.Thread(target=self.drain, name='compare-writer', daemon=True)
+        self.thread.start()
+
+    def drain(self):
+        while True:
+            item = self.items.get()
+            if item is PIPELINE_DONE:
+                return
+            if self.error is not None:
+                continue
+            method, args = item
+            try:
+                for sink in self.sinks:
+                    getattr(sink, method)(*args)
+            except BaseException as e:
+                self.error = e
+
+    def put(self, method, *args):
+        if self.error is not None:
+            raise self.error
+        self.items.put((method, args))
+
+    def write_comparison(self, comparison):
+        self.put('write_comparison', comparison)
+
+    def write_skipped(self, first_line, last_line):
+        self.put('write_skipped', first_line, last_line)
+
+    def finish(self):
+        self.items.put(PIPELINE_DONE)
+        self.thread.join()
+
+    def close(self, summary):
+        self.finish()
+        if self.error is not None:
+            raise self.error
+        for sink in self.sinks:
+            sink.close(summary)
+
+    def abort(self):
+        self.finish()
+        for sink in self.sinks:
+            sink.abort()
+
+
+def bytes_consumed(handle, reader):
+    consumed = reader.bytes_consumed() if hasattr(reader, 'bytes_consumed') else None
+    return handle.tell() if consumed is None else consumed
+
+
+def compare_csv(file1, file2, output_file, key_cols=None, report_type="full", compare_cols=None, delimiter=',', start_line=1, end_line=None,
+                progress_callback=None, status_file=None, status_interval=1.0, show_progress=False,
+                fail_fast=False, max_mismatches=None, sample_rate=None, sample_seed=0, confidence=0.95,
+                block_manifests=None, threads=None, db_file=None, sheet1=None, sheet2=None, header_row=1,
+                xlsx_report=None, match_by=None, partitions=None, spill_dir=None, json_schema_sample=JSON_SCHEMA_SAMPLE,
+                fixed_width_layout=None, fixed_width_encoding='utf-8', normalizer=None, fingerprint_file=None,
+                previous_fingerprints=None, delta_report=None, pipeline_depth=None, backend=None, duplicate_keys_report=None,
+                where=None, strategy='auto'):
+    # Kept so that a planned merge whose inputs turn out not to be sorted can be run again as a partitioned join
+    arguments = dict(locals())
     chunk_size = 100000  # Adjust based on available memory and performance
     same_count = 0
     diff_count = 0
     total_count = 0
+    status = "match"
+
+    if block_manifests and (sample_rate or start_line != 1 or end_line):
+        raise ValueError("Block manifests cannot be combined with sampling or start/end lines")
+    if block_manifests and (is_excel_file(file1) or is_excel_file(file2)):
+        raise ValueError("Block manifests are only supported for delimited text files")
+    json_input = is_json_file(file1) or is_json_file(file2)
+    if block_manifests and (json_input or fixed_width_layout or is_parquet_file(file1) or is_parquet_file(file2)):
+        raise ValueError("Block manifests are only supported for delimited text files")
+    if (previous_fingerprints or delta_report) and (sample_rate or fail_fast or max_mismatches is not None):
+        raise ValueError("A mismatch delta needs a complete run and cannot be combined with sampling or early stopping")
+    if delta_report and not previous_fingerprints:
+        raise ValueError("A delta report needs the previous run's fingerprints")
+    if strategy not in STRATEGIES:
+        raise ValueError(f"Unknown strategy: {strategy}")
+    if strategy in KEYED_STRATEGIES:
+        if match_by == 'position':
+            raise ValueError(f"The {strategy} strategy pairs records by key")
+        match_by = 'key'
+    elif strategy == 'position':
+        if match_by == 'key':
+            raise ValueError("The position strategy cannot match by key")
+        match_by = 'position'
+    backend = get_backend(backend)
+    # The planner settles position versus key itself when key columns come without an explicit match_by
+    plan_needed = strategy == 'auto' and not sample_rate and not block_manifests and backend is PANDAS_BACKEND
+    if match_by is None and (not (plan_needed and key_cols) or json_input):
+        # JSON records carry no meaningful position, so a key path pairs them by default
+        match_by = 'key' if key_cols and json_input else 'position'
+    if match_by == 'key' and not key_cols:
+        raise ValueError("Matching by key requires key columns")
+    if match_by == 'key' and block_manifests:
+        raise ValueError("Block manifests pair blocks by position and cannot be combined with matching by key")
+    if where and (sample_rate or block_manifests):
+        raise ValueError("A --where filter cannot be combined with sampling or block manifests")
+    row_filter = RowFilter(where) if where else None
+    if backend is not PANDAS_BACKEND and (match_by == 'key' or sample_rate or block_manifests or normalizer or where):
+        raise ValueError(f"The {backend.name} backend supports positional comparison without sampling, manifests, normalization or filters")
 
+    progress = None
+    if progress_callback or status_file or show_progress:
+        total_bytes = input_size(file1) + input_size(file2)
+        progress = ProgressReporter(total_bytes, progress_callback, status_file, status_interval, show_progress)
+
+    # Without key columns rows are sampled by line index inside the parser, so skipped rows are never
+    # split into fields; with key columns every row must be tokenised to see its key, but unsampled
+    # rows are dropped before any comparison or reporting work
+    sample_by_key = bool(sample_rate and key_cols)
+    sample_by_line = bool(sample_rate and not key_cols)
+    duplicates = [DuplicateKeys(), DuplicateKeys()]
+    surplus = [0, 0]
+    only_in_file1 = only_in_file2 = 0
+    threshold = sample_threshold(sample_rate) if sample_rate else None
+    rows_scanned = 0
+
+    sinks = []
+    executor = None
+    pipeline = None
+    plan = None
     try:
-        with open(output_file, 'w') as f:
-            f.write('''
-            <html>
-            <head>
-            <style>
-                td {padding: 5px;} 
-                .diff {background-color: red;} 
-                .same {background-color: white;} 
-                .match {background-color: green;}
-                table {border-collapse: collapse;}
-                th, td {border: 1px solid black;}
-            </style>
-            </head>
-            <body>
-            ''')
+        if output_file:
+            sinks.append(HtmlReportWriter(output_file, file1, file2, report_type))
+        if db_file:
+            store = SqliteResultStore(db_file, file1, file2, key_cols)
+            sinks.append(store)
+        if xlsx_report:
+            sinks.append(XlsxReportWriter(xlsx_report, file1, file2))
+        # Load the previous set first, so a run may overwrite the file it is diffed against
+        previous = load_fingerprints(previous_fingerprints) if previous_fingerprints else None
+        fingerprints = None
+        if fingerprint_file or previous is not None:
+            fingerprints = FingerprintSink(fingerprint_file, key_cols)
+            sinks.append(fingerprints)
+
+        if sample_by_line:
+            # The parser asks about every physical line in order; remember which ones it keeps
+            kept_lines1, kept_lines2 = deque(), deque()
 
-            f.write('<h2>Comparison Summary</h2>')
-            f.write('<p>File 1: {}</p>'.format(html.escape(file1)))
-            f.write('<p>File 2: {}</p>'.format(html.escape(file2)))
-            f.write('<p id="summary"></p>')
+            def make_skip(kept_lines):
+                def skip(line_index):
+                    if line_index == 0:
+                        return False
+                    if line_index < start_line or not line_is_sampled(line_index, sample_seed, threshold):
+                        return True
+                    kept_lines.append(line_index)
+                    return False
+                return skip
 
-            f.write('<table id="comparisonTable">')
+            skiprows1, skiprows2 = make_skip(kept_lines1), make_skip(kept_lines2)
+        else:
+            skiprows1 = skiprows2 = range(1, start_line)
 
-            chunk_iter1 = pd.read_csv(file1, chunksize=chunk_size, dtype=str, delimiter=delimiter, keep_default_na=False, skiprows=range(1, start_line))
-            chunk_iter2 = pd.read_csv(file2, chunksize=chunk_size, dtype=str, delimiter=delimiter, keep_default_na=False, skiprows=range(1, start_line))
+        json_columns = None
+        if json_input:
+            if compare_cols:
+                json_columns = list(dict.fromkeys(list(key_cols or []) + list(compare_cols) + (row_filter.columns if row_filter else [])))
+            else:
+                json_columns = discover_json_schema([file1, file2], json_schema_sample)
 
-            headers_written = False
+        if plan_needed:
+            plan = plan_comparison(file1, file2, key_cols, match_by, compare_cols, delimiter, threads, pipeline_depth, sheet1=sheet1, sheet2=sheet2,
+                                   header_row=header_row, json_columns=json_columns, fixed_width_layout=fixed_width_layout,
+                                   fixed_width_encoding=fixed_width_encoding, normalizer=normalizer)
+            logger.info(describe_plan(plan))
+            if progress:
+                progress.set_plan(plan)
+            strategy = plan['strategy']
+            match_by = 'position' if strategy == 'position' else 'key'
+            threads, pipeline_depth = plan['threads'], plan['pipeline_depth']
+        # Sampled keys are paired by key whatever match_by says; each input is read to its end on its own
+        keyed = match_by == 'key' or sample_by_key
+        if sample_by_key and strategy not in KEYED_STRATEGIES:
+            strategy = 'partition'
+        if duplicate_keys_report and not keyed:
+            raise ValueError("Duplicate keys are detected while matching by key")
+        key_order = 'text'
+        if keyed and strategy == 'merge':
+            key_order = (plan or {}).get('key_order') or key_order_of(sample_input(file1, delimiter, sheet1, header_row, json_columns, fixed_width_layout,
+                                                                                   fixed_width_encoding, normalizer), key_cols) or 'text'
+        # Row groups can only be pruned when rows are filtered per file, and before normalization changes the values
+        prune_filter = row_filter if keyed and not normalizer else None
+
+        # Read through our own handles so the consumed byte offset is observable
+        with open_input(file1) as handle1, open_input(file2) as handle2:
             current_line = start_line
 
-            for chunk1, chunk2 in zip(chunk_iter1, chunk_iter2):
-                if end_line and current_line + len(chunk1) - 1 > end_line:
-                    chunk1 = chunk1.head(end_line - current_line + 1)
-                    chunk2 = chunk2.head(end_line - current_line + 1)
+            chunk_iter1 = chunk_iter2 = None
+            if block_manifests:
+                chunk_pairs = manifest_chunk_pairs(handle1, handle2, block_manifests[0], block_manifests[1], chunk_size, delimiter,
+                                                   surplus)
+            else:
+                chunk_iter1 = backend.open_reader(file1, handle1, chunk_size, delimiter, skiprows1, sheet=sheet1, header_row=header_row,
+                                                  json_columns=json_columns, fixed_width_layout=fixed_width_layout,
+                                                  fixed_width_encoding=fixed_width_encoding, row_filter=prune_filter)
+                chunk_iter2 = backend.open_reader(file2, handle2, chunk_size, delimiter, skiprows2, sheet=sheet2, header_row=header_row,
+                                                  json_columns=json_columns, fixed_width_layout=fixed_width_layout,
+                                                  fixed_width_encoding=fixed_width_encoding, row_filter=prune_filter)
+                if normalizer:
+                    chunk_iter1, chunk_iter2 = NormalizedReader(chunk_iter1, normalizer), NormalizedReader(chunk_iter2, normalizer)
+                if row_filter and keyed:
+                    chunk_iter1 = FilteredReader(chunk_iter1, row_filter, start_line, end_line)
+                    chunk_iter2 = FilteredReader(chunk_iter2, row_filter, start_line, end_line)
+                if sample_by_key:
+                    key_sample = KeySample(key_cols, sample_seed, threshold)
+                    chunk_iter1 = FilteredReader(chunk_iter1, key_sample, start_line, end_line)
+                    chunk_iter2 = FilteredReader(chunk_iter2, key_sample, start_line, end_line)
+                if keyed:
+                    rows_spilled = [0]
+
+                    def on_spilled(rows):
+                        rows_spilled[0] += rows
+                        if progress:
+                            progress.update(bytes_consumed(handle1, chunk_iter1) + bytes_consumed(handle2, chunk_iter2), rows_spilled[0], 0,
+                                            state="loading" if strategy == 'hash' else "partitioning")
+
+                    if strategy == 'merge':
+                        chunk_pairs = sorted_merge_pairs(chunk_iter1, chunk_iter2, key_cols, chunk_size, start_line, end_line, None, duplicates, key_order)
+                    elif strategy == 'hash':
+                        chunk_pairs = hash_join_pairs(chunk_iter1, chunk_iter2, key_cols, chunk_size, start_line, end_line, on_spilled, duplicates)
+                    else:
+                        if partitions is None:
+                            partitions = key_partitions(input_size(file1) + input_size(file2))
+                        chunk_pairs = keyed_chunk_pairs(chunk_iter1, chunk_iter2, key_cols, chunk_size, partitions, spill_dir,
+                                                        start_line, end_line, on_spilled, duplicates)
+                elif row_filter:
+                    chunk_pairs = ((chunk1, chunk2, None) for chunk1, chunk2
+                                   in filtered_groups([chunk_iter1, chunk_iter2], row_filter, start_line, end_line, surplus, fail_fast))
+                else:
+                    chunk_pairs = ((chunk1, chunk2, None) for chunk1, chunk2
+                                   in positional_groups([chunk_iter1, chunk_iter2], surplus, backend, start_line, end_line,
+                                                        stop_early=fail_fast))
+
+            if pipeline_depth:
+                # Read-ahead and report writing overlap the comparison; wall time tends to the slowest stage
+                chunk_pairs = pipeline = prefetch(chunk_pairs, pipeline_depth)
+                if sinks:
+                    sinks = [PipelinedSinks(sinks, pipeline_depth)]
+
+            for chunk1, chunk2, block in chunk_pairs:
+                if block_manifests:
+                    if chunk1 is None:
+                        # Byte-identical block: every line in it matches
+                        same_count += block[1]
+                        total_count += block[1]
+                        for sink in sinks:
+                            sink.write_skipped(block[0], block[0] + block[1] - 1)
+                        continue
+                    current_line = block
+                    if normalizer:
+                        chunk1, chunk2 = normalizer.apply(chunk1), normalizer.apply(chunk2)
+
+                if keyed or row_filter:
+                    line_numbers = chunk1['line_number'].to_numpy()
+                elif sample_by_line:
+                    line_numbers = np.array([kept_lines1.popleft() for _ in range(len(chunk1))], dtype='int64')
+                    for _ in range(len(chunk2)):
+                        kept_lines2.popleft()
+                    if end_line and len(line_numbers) and line_numbers[-1] > end_line:
+                        keep = int(np.searchsorted(line_numbers, end_line, side='right'))
+                        chunk1, chunk2, line_numbers = chunk1.head(keep), chunk2.head(keep), line_numbers[:keep]
+                        current_line = end_line + 1
+                else:
+                    if end_line and current_line + len(chunk1) - 1 > end_line:
+                        chunk1 = backend.head(chunk1, end_line - current_line + 1)
+                        chunk2 = backend.head(chunk2, end_line - current_line + 1)
+                    line_numbers = range(current_line, current_line + len(chunk1))
 
                 if list(chunk1.columns) != list(chunk2.columns):
                     raise ValueError("CSV files have different columns")
@@ -53,92 +2584,1441 @@ def compare_csv(file1, file2, output_file, key_cols=None, report_type="full", co
                 else:
                     all_columns = chunk1.columns
 
-                if key_cols:
+                if row_filter:
+                    all_columns = [col for col in all_columns if col != 'line_number']
+                if keyed:
+                    # A key present on one side only shows up as a mismatch in the _record column
+                    all_columns = [col for col in all_columns if col != 'line_number']
+                    if RECORD_COLUMN not in all_columns:
+                        all_columns = list(all_columns) + [RECORD_COLUMN]
+                    only_in_file1 += int((chunk2[RECORD_COLUMN].to_numpy() == 'missing').sum())
+                    only_in_file2 += int((chunk1[RECORD_COLUMN].to_numpy() == 'missing').sum())
+                elif key_cols and backend is PANDAS_BACKEND:
                     chunk1.set_index(key_cols, inplace=True)
                     chunk2.set_index(key_cols, inplace=True)
                     chunk1.reset_index(inplace=True)
                     chunk2.reset_index(inplace=True)
 
-                # Add line numbers to the dataframes using .loc to avoid SettingWithCopyWarning
-                chunk1 = chunk1.copy()
-                chunk2 = chunk2.copy()
-                chunk1.loc[:, 'line_number'] = range(current_line, current_line + len(chunk1))
-                chunk2.loc[:, 'line_number'] = range(current_line, current_line + len(chunk2))
-
-                diff_chunk = pd.DataFrame()
-                diff_chunk['line_number'] = chunk1['line_number']
-                for col in all_columns:
-                    diff_chunk[col + '_file1'] = chunk1[col].astype(str)
-                    diff_chunk[col + '_file2'] = chunk2[col].astype(str)
-                    diff_chunk[col + '_diff'] = chunk1.apply(
-                        lambda row, col=col: 'Same' if row[col] == chunk2.at[row.name, col] else 'Different',
-                        axis=1
-                    )
-
-                same_rows = diff_chunk.apply(lambda row: all(row[col + '_diff'] == 'Same' for col in all_columns), axis=1)
-                diff_rows = diff_chunk.apply(lambda row: any(row[col + '_diff'] == 'Different' for col in all_columns), axis=1)
-
-                same_count += same_rows.sum()
+                if not keyed:
+                    chunk1 = backend.with_line_numbers(chunk1, line_numbers)
+                    chunk2 = backend.with_line_numbers(chunk2, line_numbers if sample_by_line or row_filter else range(current_line, current_line + len(chunk2)))
+
+                if executor is None:
+                    threads = resolve_threads(threads, len(all_columns))
+                    if threads > 1:
+                        executor = ThreadPoolExecutor(max_workers=threads)
+
+                comparison = ChunkComparison(chunk1, chunk2, all_columns, executor, threads, backend)
+                diff_rows = comparison.row_diff
+
+                same_count += (~diff_rows).sum()
                 diff_count += diff_rows.sum()
                 total_count += chunk1.shape[0]
 
-                if report_type == "difference":
-                    diff_chunk = diff_chunk[diff_rows]
-                elif report_type == "matched":
-                    diff_chunk = diff_chunk[same_rows]
-
-                if not diff_chunk.empty:
-                    if not headers_written:
-                        headers = ['line_number']
-                        for col in all_columns:
-                            headers.extend([f"{col}_file1", f"{col}_file2", f"{col}_diff"])
-                        f.write('<tr>' + ''.join(f'<th>{html.escape(col)}</th>' for col in headers) + '</tr>')
-                        headers_written = True
-
-                    def highlight_differences(val):
-                        return 'diff' if val == 'Different' else 'match' if val == 'Same' else 'same'
-
-                    for index, row in diff_chunk.iterrows():
-                        row_html = '<tr>'
-                        row_html += f'<td>{row["line_number"]}</td>'
-                        for col in all_columns:
-                            row_html += f'<td class="same">{html.escape(row[col + "_file1"])}</td>'
-                            row_html += f'<td class="same">{html.escape(row[col + "_file2"])}</td>'
-                            row_html += f'<td class="{highlight_differences(row[col + "_diff"])}">{row[col + "_diff"]}</td>'
-                        row_html += '</tr>'
-                        f.write(row_html)
-
-                current_line += len(chunk1)
+                for sink in sinks:
+                    sink.write_comparison(comparison)
+
+                if not sample_by_line and not keyed and not row_filter:
+                    current_line += len(chunk1)
+                if progress:
+                    progress.update(bytes_consumed(handle1, chunk_iter1) + bytes_consumed(handle2, chunk_iter2), total_count, diff_count)
+
+                # Stop reading as soon as the CI question is answered
+                if fail_fast and diff_count > 0:
+                    status = "different"
+                    break
+                if max_mismatches is not None and diff_count > max_mismatches:
+                    status = "budget_exceeded"
+                    break
                 if end_line and current_line > end_line:
                     break
+            if pipeline:
+                pipeline.close()
 
-            f.write('</table>')
+        if sample_by_key:
+            # The population is every record read, however long the other input turned out to be
+            rows_scanned = max(chunk_iter1.rows_read, chunk_iter2.rows_read)
+        if any(surplus) and status == "match":
+            # Records past the end of the shorter file have nothing to pair with
+            only_in_file1 += surplus[0]
+            only_in_file2 += surplus[1]
+            diff_count += sum(surplus)
+            total_count += sum(surplus)
+            if max_mismatches is not None and diff_count > max_mismatches:
+                status = "budget_exceeded"
+        if status == "match" and diff_count > 0:
+            status = "different" if max_mismatches is None else "within_budget"
+
+        summary = {
+            'total': int(total_count),
+            'same': int(same_count),
+            'different': int(diff_count),
+            'status': status,
+            'stopped_early': status in ("different", "budget_exceeded") and (fail_fast or max_mismatches is not None),
+        }
+        if keyed or any(surplus):
+            summary['only_in_file1'] = only_in_file1
+            summary['only_in_file2'] = only_in_file2
+            if fail_fast and any(surplus):
+                # Fail-fast stops at the first unpaired rows instead of reading the longer file to its end
+                summary['only_in_lower_bound'] = True
+            note_duplicate_keys(summary, duplicates, ['file1', 'file2'], key_cols, duplicate_keys_report)
+        unmapped = sorted(set().union(*(getattr(reader, 'unmapped_paths', ()) for reader in (chunk_iter1, chunk_iter2))))
+        if unmapped:
+            summary['unmapped_json_paths'] = unmapped
+            print(f"Warning: {len(unmapped)} JSON paths outside the sampled schema were not compared: {', '.join(unmapped[:10])}")
+
+        if sample_rate:
+            ci_low, ci_high = wilson_interval(summary['different'], summary['total'], confidence)
+            rate = summary['different'] / summary['total'] if summary['total'] else 0.0
+            # Positional sampling never counts the skipped lines, so the population is extrapolated
+            population = rows_scanned if sample_by_key else summary['total'] / sample_rate
+            summary['sample'] = {
+                'rate': sample_rate,
+                'seed': sample_seed,
+                'by': 'key' if sample_by_key else 'line',
+                'sample_size': summary['total'],
+                'estimated_mismatch_rate': rate,
+                'confidence': confidence,
+                'ci_low': ci_low,
+                'ci_high': ci_high,
+                'estimated_population': int(round(population)),
+                'estimated_mismatched_rows': int(round(rate * population)),
+            }
+
+        if executor:
+            executor.shutdown()
+        for sink in sinks:
+            sink.close(summary)
+        if previous is not None:
+            delta = diff_fingerprints(previous, fingerprints.cells)
+            summary['delta'] = {name: len(cells) for name, cells in delta.items()}
+            if delta_report:
+                write_delta_report(delta_report, delta, file1, file2)
+        if progress:
+            progress.update(progress.total_bytes, rows_scanned or total_count, diff_count, state="finished")
+        if output_file:
+            print(f"Comparison report generated: {output_file}")
+        if db_file:
+            print(f"Comparison results stored: {db_file} (run {store.run_id})")
+        if xlsx_report:
+            print(f"Excel report generated: {xlsx_report}")
+        if fingerprint_file:
+            print(f"Mismatch fingerprints saved: {fingerprint_file}")
+        if delta_report:
+            print(f"Delta report generated: {delta_report}")
+        return summary
+    except Exception as e:
+        if pipeline:
+            pipeline.close()
+        if executor:
+            executor.shutdown(wait=False, cancel_futures=True)
+        for sink in sinks:
+            sink.abort()
+        if progress:
+            progress.update(progress.bytes_done, total_count, diff_count, state="failed")
+        if isinstance(e, UnsortedKeysError) and plan:
+            # The sample looked sorted but the rest of the input is not
+            print(f"{e}; comparing again with the partition strategy")
+            return compare_csv(**dict(arguments, strategy='partition'))
+        print(f"An error occurred during the comparison: {e}")
+        return None
+
+
+def compare_layers(files, output_file, key_cols=None, report_type="full", compare_cols=None, delimiter=',', start_line=1, end_line=None,
+                   layer_names=None, match_by=None, partitions=None, spill_dir=None, threads=None, header_row=1,
+                   json_schema_sample=JSON_SCHEMA_SAMPLE, fixed_width_layout=None, fixed_width_encoding='utf-8', normalizer=None,
+                   duplicate_keys_report=None, where=None):
+    # Streams every layer once (rather than comparing source-staging and staging-target separately, which parses
+    # the middle file twice) and records, for each differing value, the first layer where it left the source
+    chunk_size = 100000
+    files = list(files)
+    if len(files) < 2:
+        raise ValueError("At least two layers are needed")
+    layer_names = list(layer_names) if layer_names else (['source', 'staging', 'target'] if len(files) == 3 else
+                                                         ['layer{}'.format(i + 1) for i in range(len(files))])
+    if len(layer_names) != len(files):
+        raise ValueError("One layer name is needed per file")
+    if match_by is None:
+        match_by = 'key' if key_cols else 'position'
+    if match_by == 'key' and not key_cols:
+        raise ValueError("Matching by key requires key columns")
+    if duplicate_keys_report and match_by != 'key':
+        raise ValueError("Duplicate keys are detected while matching by key")
+    row_filter = RowFilter(where) if where else None
+
+    same_count = 0
+    diff_count = 0
+    total_count = 0
+    first_divergence = np.zeros(len(files), dtype=np.int64)
+    column_divergence = {}
+    surplus = [0] * len(files)
+    writer = None
+    executor = None
+    handles = []
+    try:
+        if output_file:
+            writer = LayerReportWriter(output_file, files, layer_names, report_type)
+
+        json_columns = None
+        if any(is_json_file(path) for path in files):
+            if compare_cols:
+                json_columns = list(dict.fromkeys(list(key_cols or []) + list(compare_cols) + (row_filter.columns if row_filter else [])))
+            else:
+                json_columns = discover_json_schema(files, json_schema_sample)
+
+        prune_filter = row_filter if match_by == 'key' and not normalizer else None
+        handles = [open(path, 'rb') for path in files]
+        readers = [open_chunk_reader(path, handle, chunk_size, delimiter, range(1, start_line), header_row=header_row, json_columns=json_columns,
+                                     fixed_width_layout=fixed_width_layout, fixed_width_encoding=fixed_width_encoding, row_filter=prune_filter)
+                   for path, handle in zip(files, handles)]
+        if normalizer:
+            readers = [NormalizedReader(reader, normalizer) for reader in readers]
+        if row_filter and match_by == 'key':
+            readers = [FilteredReader(reader, row_filter, start_line, end_line) for reader in readers]
+        if match_by == 'key':
+            if partitions is None:
+                partitions = key_partitions(sum(os.path.getsize(path) for path in files))
+            duplicates = [DuplicateKeys() for _ in files]
+            chunk_groups = keyed_chunk_groups(readers, key_cols, chunk_size, partitions, spill_dir, start_line, end_line, duplicates=duplicates)
+        elif row_filter:
+            chunk_groups = filtered_groups(readers, row_filter, start_line, end_line, surplus)
+        else:
+            chunk_groups = positional_groups(readers, surplus, None, start_line, end_line)
+
+        current_line = start_line
+        for chunks in chunk_groups:
+            chunks = list(chunks)
+            if any(list(chunk.columns) != list(chunks[0].columns) for chunk in chunks):
+                raise ValueError("CSV files have different columns")
+            all_columns = list(compare_cols) if compare_cols else [col for col in chunks[0].columns if col != 'line_number']
+            if match_by == 'key':
+                if RECORD_COLUMN not in all_columns:
+                    all_columns.append(RECORD_COLUMN)
+            elif not row_filter:
+                # filtered_groups has already numbered the rows and cut them at end_line
+                rows = min(len(chunk) for chunk in chunks)
+                if end_line:
+                    rows = min(rows, end_line - current_line + 1)
+                chunks = [chunk.head(rows).assign(line_number=np.arange(current_line, current_line + rows)) for chunk in chunks]
+                current_line += rows
+
+            if executor is None:
+                threads = resolve_threads(threads, len(all_columns))
+                if threads > 1:
+                    executor = ThreadPoolExecutor(max_workers=threads)
+
+            comparison = LayerComparison(chunks, all_columns, executor, threads)
+            same_count += int((~comparison.row_diff).sum())
+            diff_count += int(comparison.row_diff.sum())
+            total_count += len(chunks[0])
+            first_divergence += np.bincount(comparison.row_divergence(), minlength=len(files))
+            for j, col in enumerate(all_columns):
+                counts = np.bincount(comparison.diverged_at[:, j], minlength=len(files))
+                column_divergence[col] = column_divergence.get(col, 0) + counts
+            if writer:
+                writer.write_comparison(comparison)
+            if match_by != 'key' and not row_filter and end_line and current_line > end_line:
+                break
+
+        summary = {
+            'total': total_count,
+            'same': same_count,
+            'different': diff_count,
+            'status': "different" if diff_count else "match",
+            'stopped_early': False,
+            'layers': dict(zip(layer_names, files)),
+            'first_divergence': {name: int(first_divergence[i]) for i, name in enumerate(layer_names) if i},
+            'column_divergence': {col: {name: int(counts[i]) for i, name in enumerate(layer_names) if i and counts[i]}
+                                  for col, counts in column_divergence.items() if counts[1:].any()},
+        }
+        if any(surplus):
+            # Records past the end of the shortest layer have nothing to pair with
+            summary['unpaired_records'] = {name: count for name, count in zip(layer_names, surplus) if count}
+            summary['status'] = "different"
+        if match_by == 'key':
+            note_duplicate_keys(summary, duplicates, layer_names, key_cols, duplicate_keys_report)
+        if executor:
+            executor.shutdown()
+        if writer:
+            writer.close(summary)
+            print(f"Comparison report generated: {output_file}")
+        return summary
+    except Exception as e:
+        if executor:
+            executor.shutdown(wait=False, cancel_futures=True)
+        if writer:
+            writer.abort()
+        print(f"An error occurred during the comparison: {e}")
+        return None
+    finally:
+        for handle in handles:
+            handle.close()
+
+
+class ByteRangeReader(io.RawIOBase):
+    # Exposes bytes [offset, offset + length) of an open file to pd.read_csv without copying them into memory
+    def __init__(self, handle, offset, length):
+        self.handle = handle
+        self.remaining = length
+        handle.seek(offset)
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        size = min(len(buffer), self.remaining)
+        if size <= 0:
+            return 0
+        data = self.handle.read(size)
+        buffer[:len(data)] = data
+        self.remaining -= len(data)
+        return len(data)
 
-            f.write('<script>document.getElementById("summary").innerHTML = "Total records: {}<br>Same records: {}<br>Mismatched records: {}";</script>'.format(total_count, same_count, diff_count))
-            f.write('</body></html>')
 
-        print(f"Comparison report generated: {output_file}")
+class PartedInput(str):
+    # An input written as several part files. It stands for its first part wherever a path is inspected (format
+    # detection, report headings), while open_input reads the parts one after another as one stream
+    def __new__(cls, parts):
+        value = super().__new__(cls, parts[0])
+        value.parts = list(parts)
+        return value
+
+    def __getnewargs__(self):
+        return (self.parts,)
+
+
+class PartStream(io.RawIOBase):
+    # Chains part files without copying them: every part after the first drops its header line (JSON Lines parts
+    # have none), and a part without a trailing newline gets one so it cannot run into the next part's first record
+    def __init__(self, parts, skip_headers=True):
+        self.parts = list(parts)
+        self.skip_headers = skip_headers
+        self.opened = 0
+        self.current = None
+        self.position = 0
+        self.last_byte = b'\n'
+        self.pending = b''
+
+    def readable(self):
+        return True
+
+    def tell(self):
+        return self.position
+
+    def readinto(self, buffer):
+        while True:
+            if self.pending:
+                data, self.pending = self.pending[:len(buffer)], self.pending[len(buffer):]
+            elif self.current is not None:
+                data = self.current.read(len(buffer))
+                if not data:
+                    self.current.close()
+                    self.current = None
+                    if self.last_byte != b'\n':
+                        self.pending = b'\n'
+                    continue
+            elif self.opened < len(self.parts):
+                self.current = open(self.parts[self.opened], 'rb')
+                if self.skip_headers and self.opened:
+                    self.current.readline()
+                self.opened += 1
+                continue
+            else:
+                return 0
+            buffer[:len(data)] = data
+            self.position += len(data)
+            self.last_byte = data[-1:]
+            return len(data)
+
+    def close(self):
+        if self.current is not None:
+            self.current.close()
+            self.current = None
+        super().close()
+
+
+def open_input(path):
+    if isinstance(path, PartedInput):
+        return io.BufferedReader(PartStream(path.parts, skip_headers=not is_json_file(path)))
+    return open(path, 'rb')
+
+
+def input_size(path):
+    if isinstance(path, PartedInput):
+        return sum(os.path.getsize(part) for part in path.parts)
+    return os.path.getsize(path)
+
+
+def count_records(handle, offset, end, max_records=None):
+    # Complete (newline-terminated) records in [offset, end), one per non-blank line since read_csv drops blank
+    # lines: returns the count and the offset just past the last line counted, stopping early once max_records
+    # have been seen
+    handle.seek(offset)
+    records = 0
+    position = offset
+    line_end = offset
+    line_start = offset
+    last_byte = 0
+    while position < end and (max_records is None or records < max_records):
+        data = handle.read(min(MANIFEST_READ_SIZE, end - position))
+        if not data:
+            break
+        buffer = np.frombuffer(data, dtype=np.uint8)
+        newlines = np.flatnonzero(buffer == ord('\n'))
+        if len(newlines):
+            ends = newlines + position
+            lengths = ends - np.concatenate(([line_start], ends[:-1] + 1))
+            # The byte before each newline, which may be the last byte of the previous read
+            before = np.where(newlines > 0, buffer[np.maximum(newlines - 1, 0)], last_byte)
+            counted = (lengths > 1) | ((lengths == 1) & (before != ord('\r')))
+            if max_records is not None and records + int(counted.sum()) >= max_records:
+                last = int(np.flatnonzero(np.cumsum(counted) == max_records - records)[0])
+                return max_records, int(ends[last]) + 1
+            records += int(counted.sum())
+            line_end = line_start = int(ends[-1]) + 1
+        last_byte = int(buffer[-1])
+        position += len(data)
+    return records, line_end
+
+
+def header_fingerprint(handle):
+    handle.seek(0)
+    header = handle.readline()
+    return len(header), hashlib.blake2b(header, digest_size=16).hexdigest()
+
+
+def load_watch_state(path):
+    if not path or not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+
+def compare_appended(file1, file2, state_file, output_file=None, report_type="full", compare_cols=None, delimiter=',',
+                     db_file=None, threads=None, normalizer=None):
+    # Incremental positional comparison of append-only files. The state file remembers how far both files have
+    # been compared (byte offsets and line number) and the running counters, so each call only parses the
+    # records appended since the previous one. Only lines present in both files are paired; the rest wait
+    chunk_size = 100000
+    if is_excel_file(file1) or is_excel_file(file2) or is_json_file(file1) or is_json_file(file2):
+        raise ValueError("Watch mode is only supported for delimited text files")
+
+    state = load_watch_state(state_file)
+    sinks = []
+    executor = None
+    try:
+        with open(file1, 'rb') as handle1, open(file2, 'rb') as handle2:
+            sizes = (os.fstat(handle1.fileno()).st_size, os.fstat(handle2.fileno()).st_size)
+            headers = (header_fingerprint(handle1), header_fingerprint(handle2))
+            if state is None:
+                state = {
+                    'version': 1,
+                    'file1': {'path': os.path.abspath(file1), 'offset': headers[0][0], 'header': headers[0][1]},
+                    'file2': {'path': os.path.abspath(file2), 'offset': headers[1][0], 'header': headers[1][1]},
+                    'line': 1,
+                    'runs': 0,
+                    'summary': {'total': 0, 'same': 0, 'different': 0},
+                }
+            for side, size, header in zip(('file1', 'file2'), sizes, headers):
+                if header[1] != state[side]['header'] or size < state[side]['offset']:
+                    raise ValueError(f"{side} was truncated or rewritten since the last run; remove {state_file} to start over")
+
+            lines1, end1 = count_records(handle1, state['file1']['offset'], sizes[0])
+            lines2, end2 = count_records(handle2, state['file2']['offset'], sizes[1])
+            new_records = min(lines1, lines2)
+            if lines1 > new_records:
+                end1 = count_records(handle1, state['file1']['offset'], sizes[0], new_records)[1]
+            if lines2 > new_records:
+                end2 = count_records(handle2, state['file2']['offset'], sizes[1], new_records)[1]
+
+            handle1.seek(0)
+            columns = list(pd.read_csv(handle1, delimiter=delimiter, nrows=0).columns)
+            handle2.seek(0)
+            if list(pd.read_csv(handle2, delimiter=delimiter, nrows=0).columns) != columns:
+                raise ValueError("CSV files have different columns")
+
+            summary = dict(state['summary'])
+            if new_records:
+                if output_file:
+                    sinks.append(HtmlReportWriter(output_file, file1, file2, report_type))
+                if db_file:
+                    sinks.append(SqliteResultStore(db_file, file1, file2))
+                read_options = dict(delimiter=delimiter, header=None, names=columns, chunksize=chunk_size, dtype=str, keep_default_na=False)
+                reader1 = pd.read_csv(io.BufferedReader(ByteRangeReader(handle1, state['file1']['offset'], end1 - state['file1']['offset'])), **read_options)
+                reader2 = pd.read_csv(io.BufferedReader(ByteRangeReader(handle2, state['file2']['offset'], end2 - state['file2']['offset'])), **read_options)
+                if normalizer:
+                    reader1, reader2 = NormalizedReader(reader1, normalizer), NormalizedReader(reader2, normalizer)
+                all_columns = compare_cols or columns
+                current_line = state['line']
+                for chunk1, chunk2 in itertools.zip_longest(reader1, reader2):
+                    if chunk1 is None or chunk2 is None or len(chunk1) != len(chunk2):
+                        # Records are paired by line, so a quoted value spanning lines throws the pairing off
+                        raise ValueError("The appended records do not parse to one record per line; watch mode needs "
+                                         "records without line breaks inside quoted values")
+                    chunk1 = chunk1.assign(line_number=np.arange(current_line, current_line + len(chunk1)))
+                    chunk2 = chunk2.assign(line_number=np.arange(current_line, current_line + len(chunk2)))
+                    current_line += len(chunk1)
+                    if executor is None:
+                        threads = resolve_threads(threads, len(all_columns))
+                        if threads > 1:
+                            executor = ThreadPoolExecutor(max_workers=threads)
+                    comparison = ChunkComparison(chunk1, chunk2, all_columns, executor, threads)
+                    different = int(comparison.row_diff.sum())
+                    summary['total'] += len(chunk1)
+                    summary['different'] += different
+                    summary['same'] += len(chunk1) - different
+                    for sink in sinks:
+                        sink.write_comparison(comparison)
+
+            summary['status'] = "different" if summary['different'] else "match"
+            summary['stopped_early'] = False
+            summary['new_records'] = new_records
+            summary['new_mismatches'] = summary['different'] - state['summary']['different']
+            summary['pending_records'] = {'file1': lines1 - new_records, 'file2': lines2 - new_records}
+
+            state['file1'].update(offset=end1, size=sizes[0])
+            state['file2'].update(offset=end2, size=sizes[1])
+            state['line'] += new_records
+            state['runs'] += 1
+            state['summary'] = {key: summary[key] for key in ('total', 'same', 'different')}
+            state['updated'] = datetime.datetime.now().isoformat(timespec='seconds')
+
+        if executor:
+            executor.shutdown()
+        for sink in sinks:
+            sink.close(summary)
+        # Write the new offsets only once the records up to them have been reported
+        if state_file:
+            temp_path = state_file + '.tmp'
+            with open(temp_path, 'w') as f:
+                json.dump(state, f, indent=2)
+            os.replace(temp_path, state_file)
+        return summary
     except Exception as e:
+        if executor:
+            executor.shutdown(wait=False, cancel_futures=True)
+        for sink in sinks:
+            sink.abort()
         print(f"An error occurred during the comparison: {e}")
+        return None
+
+
+def watch_files(file1, file2, state_file, interval=5.0, max_runs=None, **options):
+    # Polls both files and runs an incremental comparison whenever either one has grown
+    runs = 0
+    summary = None
+    last_sizes = None
+    while max_runs is None or runs < max_runs:
+        sizes = (os.path.getsize(file1), os.path.getsize(file2))
+        if sizes != last_sizes:
+            summary = compare_appended(file1, file2, state_file, **options)
+            if summary is None:
+                return None
+            last_sizes = sizes
+            runs += 1
+            if summary['new_records']:
+                print("{time} +{new_records} records, +{new_mismatches} mismatched; total {total}, mismatched {different}".format(
+                    time=datetime.datetime.now().strftime('%H:%M:%S'), **summary))
+        if max_runs is not None and runs >= max_runs:
+            break
+        time.sleep(interval)
+    return summary
+
+
+AGGREGATE_HASH_KEY = '0123456789abcdef'
+
+
+class ColumnAggregates:
+    # Mergeable per-column aggregates of one file: row count, empty (null) count, numeric sum/min/max while every
+    # non-empty value parses as a number, string min/max otherwise, and order-independent checksums (the sum of
+    # 64-bit value hashes, wrapping) per column and over whole rows
+    def __init__(self):
+        self.rows = 0
+        self.row_checksum = 0
+        self.columns = {}
+
+    def update(self, chunk):
+        self.rows += len(chunk)
+        if not len(chunk):
+            return
+        row_hashes = np.zeros(len(chunk), dtype=np.uint64)
+        for col in chunk.columns:
+            values = chunk[col]
+            present = values[values != '']
+            stats = self.columns.setdefault(col, {'nulls': 0, 'checksum': 0, 'numeric': True, 'sum': 0.0,
+                                                  'min': None, 'max': None, 'text_min': None, 'text_max': None})
+            stats['nulls'] += len(values) - len(present)
+            hashes = pd.util.hash_pandas_object(values, index=False, hash_key=AGGREGATE_HASH_KEY).to_numpy()
+            stats['checksum'] = (stats['checksum'] + int(hashes.sum(dtype=np.uint64))) & MASK64
+            # Row hashes mix the column hashes in column order, so the row checksum needs no second hashing pass
+            row_hashes = (row_hashes * np.uint64(1000003)) ^ hashes
+            if not len(present):
+                continue
+            self.merge_range(stats, 'text_min', 'text_max', present.min(), present.max())
+            if stats['numeric']:
+                try:
+                    numbers = present.astype('float64').to_numpy()
+                except (TypeError, ValueError):
+                    stats['numeric'] = False
+                    continue
+                if not np.isfinite(numbers).all():
+                    # 'NaN' and 'inf' parse as floats but would poison the sum; such a column is compared as text
+                    stats['numeric'] = False
+                    continue
+                stats['sum'] += math.fsum(numbers)
+                self.merge_range(stats, 'min', 'max', float(numbers.min()), float(numbers.max()))
+        self.row_checksum = (self.row_checksum + int(row_hashes.sum(dtype=np.uint64))) & MASK64
+
+    @staticmethod
+    def merge_range(stats, low, high, minimum, maximum):
+        stats[low] = minimum if stats[low] is None else min(stats[low], minimum)
+        stats[high] = maximum if stats[high] is None else max(stats[high], maximum)
+
+    def merge(self, other):
+        self.rows += other.rows
+        self.row_checksum = (self.row_checksum + other.row_checksum) & MASK64
+        for col, theirs in other.columns.items():
+            stats = self.columns.get(col)
+            if stats is None:
+                self.columns[col] = dict(theirs)
+                continue
+            stats['nulls'] += theirs['nulls']
+            stats['checksum'] = (stats['checksum'] + theirs['checksum']) & MASK64
+            stats['numeric'] = stats['numeric'] and theirs['numeric']
+            stats['sum'] += theirs['sum']
+            for low, high in (('min', 'max'), ('text_min', 'text_max')):
+                if theirs[low] is not None:
+                    self.merge_range(stats, low, high, theirs[low], theirs[high])
+        return self
+
+    def result(self):
+        columns = {}
+        for col, stats in self.columns.items():
+            summary = {'count': self.rows - stats['nulls'], 'nulls': stats['nulls'], 'checksum': format(stats['checksum'], '016x')}
+            if stats['numeric'] and stats['min'] is not None:
+                summary.update(sum=stats['sum'], min=stats['min'], max=stats['max'])
+            else:
+                summary.update(min=stats['text_min'], max=stats['text_max'])
+            columns[col] = summary
+        return {'rows': self.rows, 'row_checksum': format(self.row_checksum, '016x'), 'columns': columns}
+
+
+def aggregate_file(path, delimiter=',', compare_cols=None, sheet=None, header_row=1, fixed_width_layout=None,
+                   fixed_width_encoding='utf-8', normalizer=None, json_columns=None):
+    # One streaming pass over one file; runs in its own process so both files are parsed at the same time
+    aggregates = ColumnAggregates()
+    with open(path, 'rb') as handle:
+        reader = open_chunk_reader(path, handle, 100000, delimiter, None, sheet, header_row, json_columns, fixed_width_layout, fixed_width_encoding)
+        if normalizer:
+            reader = NormalizedReader(reader, normalizer)
+        for chunk in reader:
+            aggregates.update(chunk[list(compare_cols)] if compare_cols else chunk)
+    return aggregates.result()
+
+
+def aggregates_match(name, value1, value2, tolerance):
+    if name == 'sum':
+        return math.isclose(value1, value2, rel_tol=tolerance, abs_tol=tolerance)
+    return value1 == value2
+
+
+def compare_aggregate_results(result1, result2, tolerance=1e-9):
+    rows = []
+    for col in list(dict.fromkeys(list(result1['columns']) + list(result2['columns']))):
+        stats1, stats2 = result1['columns'].get(col, {}), result2['columns'].get(col, {})
+        for name in ('count', 'nulls', 'sum', 'min', 'max', 'checksum'):
+            if name not in stats1 and name not in stats2:
+                continue
+            value1, value2 = stats1.get(name), stats2.get(name)
+            match = value1 is not None and value2 is not None and aggregates_match(name, value1, value2, tolerance)
+            rows.append((col, name, value1, value2, match or value1 == value2))
+    return rows
+
+
+def write_aggregate_report(path, file1, file2, result1, result2, rows, drill_down=None):
+    with open(path, 'w') as f:
+        write_report_head(f, "Reconciliation Summary", [("File 1", file1), ("File 2", file2)])
+        differing = sorted({col for col, _, _, _, match in rows if not match})
+        write_report_summary(f, ["Rows: {} vs {}".format(result1['rows'], result2['rows']),
+                                 "Row checksum: {}".format('same' if result1['row_checksum'] == result2['row_checksum'] else 'different'),
+                                 "Columns with differing aggregates: {}".format(html.escape(', '.join(differing)) or 'none')])
+        if drill_down:
+            write_report_summary(f, ["Row-level drill-down: {} mismatched of {} records".format(drill_down['different'], drill_down['total'])])
+        f.write('<table><tr><th>column</th><th>aggregate</th><th>file1</th><th>file2</th><th>result</th></tr>')
+        for col, name, value1, value2, match in rows:
+            f.write('<tr><td>{}</td><td>{}</td><td>{}</td><td>{}</td>{}</tr>'.format(
+                html.escape(col), name, html.escape(str(value1)), html.escape(str(value2)),
+                '<td class="match">Same</td>' if match else '<td class="diff">Different</td>'))
+        f.write('</table></body></html>')
+
+
+def reconcile(file1, file2, output_file=None, delimiter=',', compare_cols=None, key_cols=None, sheet1=None, sheet2=None, header_row=1,
+              fixed_width_layout=None, fixed_width_encoding='utf-8', normalizer=None, tolerance=1e-9, drill_down=None, json_schema_sample=JSON_SCHEMA_SAMPLE,
+              **compare_options):
+    # Aggregate reconciliation: one pass per file, both files in parallel, compared as aggregates. Only when an
+    # aggregate disagrees, and drill_down names a report path, are the affected columns compared row by row
+    try:
+        json_columns = None
+        if is_json_file(file1) or is_json_file(file2):
+            json_columns = list(compare_cols) if compare_cols else discover_json_schema([file1, file2], json_schema_sample)
+        options = dict(delimiter=delimiter, compare_cols=compare_cols, header_row=header_row, fixed_width_layout=fixed_width_layout,
+                       fixed_width_encoding=fixed_width_encoding, normalizer=normalizer, json_columns=json_columns)
+        with ProcessPoolExecutor(max_workers=2) as pool:
+            future1 = pool.submit(aggregate_file, file1, sheet=sheet1, **options)
+            future2 = pool.submit(aggregate_file, file2, sheet=sheet2, **options)
+            result1, result2 = future1.result(), future2.result()
+
+        rows = compare_aggregate_results(result1, result2, tolerance)
+        differing = list(dict.fromkeys(col for col, _, _, _, match in rows if not match))
+        rows_match = result1['rows'] == result2['rows'] and result1['row_checksum'] == result2['row_checksum']
+        summary = {
+            'status': "match" if rows_match and not differing else "different",
+            'rows': [result1['rows'], result2['rows']],
+            'differing_columns': differing,
+            'aggregates': [result1, result2],
+        }
+        if drill_down and summary['status'] == "different":
+            # Values can agree column by column yet be combined differently across rows; then every column is checked
+            drill_columns = [col for col in differing if col not in (key_cols or [])] or list(compare_cols or []) or None
+            summary['drill_down'] = compare_csv(file1, file2, drill_down, key_cols=key_cols, compare_cols=drill_columns, delimiter=delimiter,
+                                                sheet1=sheet1, sheet2=sheet2, header_row=header_row, fixed_width_layout=fixed_width_layout,
+                                                fixed_width_encoding=fixed_width_encoding, normalizer=normalizer,
+                                                json_schema_sample=json_schema_sample, **compare_options)
+        if output_file:
+            write_aggregate_report(output_file, file1, file2, result1, result2, rows, summary.get('drill_down'))
+            print(f"Reconciliation report generated: {output_file}")
+        return summary
+    except Exception as e:
+        print(f"An error occurred during the reconciliation: {e}")
+        return None
+
+
+def bit_length64(values):
+    # Exact bit length of uint64 values: each 32-bit half converts to float64 without rounding
+    high = (values >> np.uint64(32)).astype(np.float64)
+    low = (values & np.uint64(0xFFFFFFFF)).astype(np.float64)
+    return np.where(high > 0, 32 + np.frexp(high)[1], np.frexp(low)[1])
+
+
+class HyperLogLog:
+    # Distinct-count sketch: 2**precision one-byte registers (16 KB at the default), merged by element-wise max
+    def __init__(self, precision=14):
+        self.precision = precision
+        self.registers = np.zeros(1 << precision, dtype=np.uint8)
+
+    def add_hashes(self, hashes):
+        if not len(hashes):
+            return
+        p = np.uint64(self.precision)
+        index = (hashes >> (np.uint64(64) - p)).astype(np.intp)
+        rest = hashes & np.uint64((1 << (64 - self.precision)) - 1)
+        rank = (64 - self.precision - bit_length64(rest) + 1).astype(np.uint8)
+        np.maximum.at(self.registers, index, rank)
+
+    def merge(self, other):
+        np.maximum(self.registers, other.registers, out=self.registers)
+        return self
+
+    def estimate(self):
+        m = len(self.registers)
+        alpha = 0.7213 / (1 + 1.079 / m)
+        estimate = alpha * m * m / np.sum(np.ldexp(1.0, -self.registers.astype(np.int64)))
+        zeros = int(np.count_nonzero(self.registers == 0))
+        if estimate <= 2.5 * m and zeros:
+            # Small-range correction (linear counting)
+            estimate = m * math.log(m / zeros)
+        return estimate
+
+
+class QuantileSketch:
+    # DDSketch-style log-bucketed histogram: any quantile is returned within relative_accuracy of the true value,
+    # the bucket count grows with the log of the value range (not the row count), and sketches merge by adding counts
+    def __init__(self, relative_accuracy=0.01):
+        self.relative_accuracy = relative_accuracy
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self.log_gamma = math.log(self.gamma)
+        self.positive = {}
+        self.negative = {}
+        self.zeros = 0
+        self.count = 0
+
+    def add_bins(self, store, values):
+        bins, counts = np.unique(np.ceil(np.log(values) / self.log_gamma).astype(np.int64), return_counts=True)
+        for index, count in zip(bins.tolist(), counts.tolist()):
+            store[index] = store.get(index, 0) + count
+
+    def add(self, values):
+        values = values[np.isfinite(values)]
+        self.count += len(values)
+        self.zeros += int(np.count_nonzero(values == 0))
+        if np.any(values > 0):
+            self.add_bins(self.positive, values[values > 0])
+        if np.any(values < 0):
+            self.add_bins(self.negative, -values[values < 0])
+
+    def merge(self, other):
+        for store, theirs in ((self.positive, other.positive), (self.negative, other.negative)):
+            for index, count in theirs.items():
+                store[index] = store.get(index, 0) + count
+        self.zeros += other.zeros
+        self.count += other.count
+        return self
+
+    def bin_value(self, index):
+        return 2 * self.gamma ** index / (self.gamma + 1)
+
+    def quantile(self, q):
+        if not self.count:
+            return None
+        rank = q * (self.count - 1)
+        seen = 0
+        for index in sorted(self.negative, reverse=True):
+            seen += self.negative[index]
+            if seen > rank:
+                return -self.bin_value(index)
+        seen += self.zeros
+        if seen > rank:
+            return 0.0
+        for index in sorted(self.positive):
+            seen += self.positive[index]
+            if seen > rank:
+                return self.bin_value(index)
+        return self.bin_value(max(self.positive))
+
+
+class TopValues:
+    # Bounded heavy-hitters summary: counts are merged and pruned back to capacity values, SpaceSaving-style
+    def __init__(self, capacity=100):
+        self.capacity = capacity
+        self.counts = pd.Series(dtype='int64')
+
+    def add_counts(self, counts):
+        merged = self.counts.add(counts, fill_value=0) if len(self.counts) else counts
+        self.counts = merged.nlargest(self.capacity).astype('int64')
+
+    def merge(self, other):
+        self.add_counts(other.counts)
+        return self
+
+    def top(self, n=10):
+        return self.counts.nlargest(n)
+
+    def heavy(self, n=10):
+        # The values whose place in the top n does not depend on row order: seen more than once and counted
+        # strictly above the first value left out, so values tied at the cutoff are dropped
+        counts = self.counts.sort_values(ascending=False)
+        cutoff = counts.iloc[n] if len(counts) > n else 0
+        top = counts.iloc[:n]
+        return set(top.index[top.to_numpy() > max(cutoff, 1)])
+
+
+class ColumnSketch:
+    def __init__(self, precision=14, relative_accuracy=0.01, capacity=100):
+        self.rows = 0
+        self.nulls = 0
+        self.distinct = HyperLogLog(precision)
+        self.quantiles = QuantileSketch(relative_accuracy)
+        self.top_values = TopValues(capacity)
+
+    def update(self, values):
+        self.rows += len(values)
+        present = values[values != '']
+        self.nulls += len(values) - len(present)
+        if not len(present):
+            return
+        self.distinct.add_hashes(pd.util.hash_pandas_object(present, index=False, hash_key=AGGREGATE_HASH_KEY).to_numpy())
+        counts = present.value_counts()
+        self.top_values.add_counts(counts.nlargest(self.top_values.capacity * 4))
+        try:
+            numbers = present.astype('float64').to_numpy()
+        except (TypeError, ValueError):
+            numbers = pd.to_numeric(present, errors='coerce').dropna().to_numpy(dtype=float)
+        # 'NaN' and 'inf' are left to the distinct and top-value sketches, as text
+        self.quantiles.add(numbers[np.isfinite(numbers)])
+
+    def merge(self, other):
+        self.rows += other.rows
+        self.nulls += other.nulls
+        self.distinct.merge(other.distinct)
+        self.quantiles.merge(other.quantiles)
+        self.top_values.merge(other.top_values)
+        return self
+
+
+DRIFT_QUANTILES = (0.01, 0.25, 0.5, 0.75, 0.99)
+
+
+def sketch_chunk(chunk, columns):
+    sketches = {}
+    for col in columns:
+        sketches[col] = ColumnSketch()
+        sketches[col].update(chunk[col])
+    return sketches
+
+
+def merge_sketches(total, sketches):
+    for col, sketch in sketches.items():
+        if col in total:
+            total[col].merge(sketch)
+        else:
+            total[col] = sketch
+    return total
+
+
+def sketch_file(path, executor, threads, delimiter=',', compare_cols=None, sheet=None, header_row=1, fixed_width_layout=None,
+                fixed_width_encoding='utf-8', normalizer=None, json_columns=None):
+    # Chunks are sketched concurrently and folded into one set of sketches as they finish; at most 2 x threads
+    # chunks are in flight, so memory is bounded by the chunk size and the sketch sizes, not by the row count
+    totals = {}
+    pending = deque()
+    with open(path, 'rb') as handle:
+        reader = open_chunk_reader(path, handle, 100000, delimiter, None, sheet, header_row, json_columns, fixed_width_layout, fixed_width_encoding)
+        if normalizer:
+            reader = NormalizedReader(reader, normalizer)
+        for chunk in reader:
+            columns = list(compare_cols) if compare_cols else list(chunk.columns)
+            pending.append(executor.submit(sketch_chunk, chunk, columns))
+            while len(pending) >= 2 * threads:
+                merge_sketches(totals, pending.popleft().result())
+        while pending:
+            merge_sketches(totals, pending.popleft().result())
+    return totals
+
+
+def relative_change(value1, value2):
+    if value1 is None or value2 is None:
+        return None
+    if value1 == value2:
+        return 0.0
+    return abs(value2 - value1) / max(abs(value1), abs(value2))
+
+
+def compare_sketches(sketches1, sketches2, threshold=0.1, top_n=10):
+    columns = {}
+    for col in list(dict.fromkeys(list(sketches1) + list(sketches2))):
+        sketch1, sketch2 = sketches1.get(col), sketches2.get(col)
+        if sketch1 is None or sketch2 is None:
+            columns[col] = {'drifted': True, 'reasons': ['column missing from file{}'.format(1 if sketch1 is None else 2)]}
+            continue
+        distinct = (sketch1.distinct.estimate(), sketch2.distinct.estimate())
+        null_rate = (sketch1.nulls / sketch1.rows if sketch1.rows else 0.0, sketch2.nulls / sketch2.rows if sketch2.rows else 0.0)
+        quantiles = {q: (sketch1.quantiles.quantile(q), sketch2.quantiles.quantile(q)) for q in DRIFT_QUANTILES}
+        top1, top2 = sketch1.top_values.top(top_n), sketch2.top_values.top(top_n)
+        heavy1, heavy2 = sketch1.top_values.heavy(top_n), sketch2.top_values.heavy(top_n)
+        overlap = len(heavy1 & heavy2) / max(len(heavy1), len(heavy2)) if heavy1 or heavy2 else 1.0
+        reasons = []
+        if relative_change(*distinct) > threshold:
+            reasons.append('distinct count')
+        if abs(null_rate[1] - null_rate[0]) > threshold:
+            reasons.append('null rate')
+        # Quantiles are only comparable for columns that are mostly numeric in both files
+        numeric = all(sketch.quantiles.count >= 0.5 * max(sketch.rows - sketch.nulls, 1) for sketch in (sketch1, sketch2))
+        if numeric:
+            shifted = [q for q, (value1, value2) in quantiles.items()
+                       if relative_change(value1, value2) is not None and relative_change(value1, value2) > threshold]
+            if shifted:
+                reasons.append('quantiles ' + ', '.join(f'p{round(q * 100)}' for q in shifted))
+        if overlap < 1 - threshold:
+            reasons.append('top values')
+        columns[col] = {
+            'rows': (sketch1.rows, sketch2.rows),
+            'distinct': tuple(int(round(d)) for d in distinct),
+            'null_rate': null_rate,
+            'quantiles': {f'p{round(q * 100)}': values for q, values in quantiles.items()} if numeric else {},
+            'top_values': (top1.to_dict(), top2.to_dict()),
+            'top_overlap': overlap,
+            'drifted': bool(reasons),
+            'reasons': reasons,
+        }
+    return columns
+
+
+def write_drift_report(path, file1, file2, columns):
+    with open(path, 'w') as f:
+        write_report_head(f, "Distribution Drift Summary", [("File 1", file1), ("File 2", file2)])
+        drifted = [col for col, result in columns.items() if result['drifted']]
+        write_report_summary(f, ["Columns compared: {}".format(len(columns)), "Columns drifted: {}".format(html.escape(', '.join(drifted)) or 'none')])
+        f.write('<table><tr><th>column</th><th>distinct (est.)</th><th>null rate</th><th>quantiles</th><th>top values overlap</th><th>result</th></tr>')
+        for col, result in columns.items():
+            if 'distinct' not in result:
+                f.write('<tr><td>{}</td><td colspan="4">{}</td><td class="diff">Drift</td></tr>'.format(html.escape(col), html.escape(result['reasons'][0])))
+                continue
+            quantiles = '<br>'.join('{}: {:.6g} / {:.6g}'.format(name, value1, value2) for name, (value1, value2) in result['quantiles'].items()
+                                    if value1 is not None and value2 is not None)
+            f.write('<tr><td>{}</td><td>{} / {}</td><td>{:.2%} / {:.2%}</td><td>{}</td><td>{:.0%}</td>{}</tr>'.format(
+                html.escape(col), *result['distinct'], *result['null_rate'], quantiles, result['top_overlap'],
+                '<td class="diff">Drift: {}</td>'.format(html.escape(', '.join(result['reasons']))) if result['drifted'] else '<td class="match">Stable</td>'))
+        f.write('</table></body></html>')
+
+
+def compare_drift(file1, file2, output_file=None, delimiter=',', compare_cols=None, threshold=0.1, threads=None, sheet1=None, sheet2=None,
+                  header_row=1, fixed_width_layout=None, fixed_width_encoding='utf-8', normalizer=None, json_schema_sample=JSON_SCHEMA_SAMPLE):
+    # Distribution drift from mergeable sketches: HyperLogLog distinct counts, log-bucketed quantiles and bounded
+    # top values per column, built from chunks in parallel and compared column by column
+    executor = None
+    try:
+        threads = threads or os.cpu_count() or 1
+        executor = ThreadPoolExecutor(max_workers=threads)
+        json_columns = None
+        if is_json_file(file1) or is_json_file(file2):
+            json_columns = list(compare_cols) if compare_cols else discover_json_schema([file1, file2], json_schema_sample)
+        options = dict(delimiter=delimiter, compare_cols=compare_cols, header_row=header_row, fixed_width_layout=fixed_width_layout,
+                       fixed_width_encoding=fixed_width_encoding, normalizer=normalizer, json_columns=json_columns)
+        sketches1 = sketch_file(file1, executor, threads, sheet=sheet1, **options)
+        sketches2 = sketch_file(file2, executor, threads, sheet=sheet2, **options)
+        executor.shutdown()
+        columns = compare_sketches(sketches1, sketches2, threshold)
+        drifted = [col for col, result in columns.items() if result['drifted']]
+        summary = {'status': "drift" if drifted else "stable", 'drifted_columns': drifted, 'columns': columns}
+        if output_file:
+            write_drift_report(output_file, file1, file2, columns)
+            print(f"Drift report generated: {output_file}")
+        return summary
+    except Exception as e:
+        if executor:
+            executor.shutdown(wait=False, cancel_futures=True)
+        print(f"An error occurred during the drift comparison: {e}")
+        return None
+
+
+def discover_partitions(root):
+    # Hive-style layout: every directory holding data files is one partition, named by its path below the root
+    # (e.g. dt=2024-06-01/region=EU); hidden and underscore files such as _SUCCESS or .crc are not data
+    partitions = {}
+    for directory, subdirectories, names in os.walk(root):
+        subdirectories[:] = sorted(d for d in subdirectories if not d.startswith(('.', '_')))
+        files = sorted(os.path.join(directory, name) for name in names if not name.startswith(('.', '_')))
+        if not files:
+            continue
+        relative = os.path.relpath(directory, root)
+        name = '' if relative == os.curdir else relative.replace(os.sep, '/')
+        values = {}
+        for part in name.split('/') if name else []:
+            if '=' in part:
+                column, value = part.split('=', 1)
+                values[unquote(column)] = unquote(value)
+        partitions[name] = {'values': values, 'files': files}
+    return partitions
+
+
+def prune_partitions(names, partitions1, partitions2, partition_filter):
+    # Evaluated on a frame with one row per partition and one text column per partition column
+    rows = [{**partitions2.get(name, {}).get('values', {}), **partitions1.get(name, {}).get('values', {})} for name in names]
+    columns = list(dict.fromkeys(col for row in rows for col in row))
+    frame = pd.DataFrame({col: [row.get(col, '') for row in rows] for col in columns}, dtype=str)
+    frame.index = range(len(names))
+    keep = RowFilter(partition_filter).mask(frame)
+    return [name for name, kept in zip(names, keep) if kept]
+
+
+def file_digest(path):
+    hasher = new_block_hasher()
+    with open(path, 'rb') as fh:
+        for block in iter(lambda: fh.read(MANIFEST_READ_SIZE), b''):
+            hasher.update(block)
+    return hasher.hexdigest()
+
+
+def partitions_identical(files1, files2):
+    # Sizes first, so a digest is only computed when it can still decide
+    if len(files1) != len(files2) or any(os.path.getsize(a) != os.path.getsize(b) for a, b in zip(files1, files2)):
+        return False
+    return all(file_digest(a) == file_digest(b) for a, b in zip(files1, files2))
+
+
+def partition_input(files):
+    # A partition written as several part files is compared as one stream, in part-name order
+    if len(files) == 1:
+        return files[0]
+    if any(is_excel_file(f) or is_parquet_file(f) or (is_json_file(f) and not f.lower().endswith(('.jsonl', '.ndjson'))) for f in files):
+        raise ValueError("Partitions with several parts must be delimited text or JSON Lines")
+    return PartedInput(files)
+
+
+def compare_partition_pair(name, files1, files2, output_file, options):
+    # Runs in a worker process; compare_csv's console output is captured so parallel partitions do not interleave
+    if partitions_identical(files1, files2):
+        return {'partition': name, 'status': "identical"}
+    printed = io.StringIO()
+    try:
+        with contextlib.redirect_stdout(printed):
+            summary = compare_csv(partition_input(files1), partition_input(files2), output_file, **options)
+    except ValueError as e:
+        summary = None
+        printed.write(str(e))
+    if summary is None:
+        return {'partition': name, 'status': "failed", 'error': printed.getvalue().strip()}
+    return {'partition': name, 'status': summary['status'], 'summary': summary, 'report': output_file}
+
+
+def write_directory_report(path, dir1, dir2, results, summary):
+    with open(path, 'w') as f:
+        write_report_head(f, "Partitioned Directory Comparison Summary", [("Directory 1", dir1), ("Directory 2", dir2)])
+        counts = summary['partitions']
+        labels = [("Partitions compared", 'compared'), ("Identical (skipped)", 'identical'), ("Different", 'different'), ("Only in directory 1", 'only_in_dir1'),
+                  ("Only in directory 2", 'only_in_dir2'), ("Pruned", 'pruned'), ("Failed", 'failed')]
+        write_report_summary(f, ["{}: {}".format(label, counts[name]) for label, name in labels] + record_counts(summary))
+        f.write('<table><tr><th>partition</th><th>status</th><th>records</th><th>same</th><th>mismatched</th><th>report</th></tr>')
+        for result in results:
+            status = result['status']
+            counts = result.get('summary') or {}
+            if status == "failed":
+                status = "failed: " + result['error']
+            report = result.get('report')
+            f.write('<tr><td>{}</td><td class="{}">{}</td><td>{}</td><td>{}</td><td>{}</td><td>{}</td></tr>'.format(
+                html.escape(result['partition'] or '(root)'), 'match' if result['status'] in ("match", "identical") else 'diff', html.escape(status),
+                counts.get('total', ''), counts.get('same', ''), counts.get('different', ''),
+                '<a href="{}">report</a>'.format(html.escape(os.path.relpath(report, os.path.dirname(os.path.abspath(path))))) if report else ''))
+        f.write('</table></body></html>')
+
+
+def compare_directories(dir1, dir2, output_file=None, partition_filter=None, workers=None, **compare_options):
+    # Partitions are paired by their k=v path; byte-identical pairs are skipped and the rest are compared by
+    # compare_csv in parallel processes, each writing its own report next to the directory report
+    pool = None
+    try:
+        partitions1, partitions2 = discover_partitions(dir1), discover_partitions(dir2)
+        names = sorted(set(partitions1) | set(partitions2))
+        kept = prune_partitions(names, partitions1, partitions2, partition_filter) if partition_filter else names
+        report_dir = None
+        if output_file:
+            report_dir = os.path.splitext(output_file)[0] + '_partitions'
+            os.makedirs(report_dir, exist_ok=True)
+        results = []
+        futures = {}
+        pool = ProcessPoolExecutor(max_workers=workers or os.cpu_count() or 1)
+        for name in kept:
+            if name not in partitions2:
+                results.append({'partition': name, 'status': "only_in_dir1"})
+            elif name not in partitions1:
+                results.append({'partition': name, 'status': "only_in_dir2"})
+            else:
+                report = os.path.join(report_dir, (name.replace('/', '__') or 'root') + '.html') if report_dir else None
+                futures[name] = pool.submit(compare_partition_pair, name, partitions1[name]['files'], partitions2[name]['files'], report, compare_options)
+        for name, future in futures.items():
+            result = future.result()
+            results.append(result)
+            if compare_options.get('fail_fast') and result['status'] == "different":
+                # The answer is known; partitions not yet started are dropped
+                for pending in futures.values():
+                    pending.cancel()
+                break
+        pool.shutdown()
+        results.sort(key=lambda result: result['partition'])
+
+        statuses = [result['status'] for result in results]
+        summary = {
+            'total': sum(result['summary']['total'] for result in results if 'summary' in result),
+            'same': sum(result['summary']['same'] for result in results if 'summary' in result),
+            'different': sum(result['summary']['different'] for result in results if 'summary' in result),
+            'partitions': {
+                'compared': len(results) - statuses.count("only_in_dir1") - statuses.count("only_in_dir2"),
+                'identical': statuses.count("identical"),
+                'different': sum(status in ("different", "within_budget", "budget_exceeded") for status in statuses),
+                'only_in_dir1': statuses.count("only_in_dir1"),
+                'only_in_dir2': statuses.count("only_in_dir2"),
+                'pruned': len(names) - len(kept),
+                'failed': statuses.count("failed"),
+            },
+            'results': results,
+        }
+        if "failed" in statuses:
+            # A partition that could not be compared leaves the answer unknown, not different
+            summary['status'] = "failed"
+        elif "budget_exceeded" in statuses:
+            summary['status'] = "budget_exceeded"
+        elif any(status not in ("match", "identical") for status in statuses):
+            summary['status'] = "different"
+        else:
+            summary['status'] = "match"
+        summary['stopped_early'] = any(result.get('summary', {}).get('stopped_early') for result in results)
+        for result in results:
+            if result['status'] == "failed":
+                print(f"Partition {result['partition'] or '(root)'} failed: {result['error']}")
+        if output_file:
+            write_directory_report(output_file, dir1, dir2, results, summary)
+            print(f"Directory comparison report generated: {output_file}")
+        return summary
+    except Exception as e:
+        if pool:
+            pool.shutdown(wait=False, cancel_futures=True)
+        print(f"An error occurred during the directory comparison: {e}")
+        return None
+
+
+def exit_code_for(summary, fail_fast=False, max_mismatches=None):
+    if summary is None or summary['status'] == "failed":
+        return EXIT_ERROR
+    if summary['status'] == "budget_exceeded":
+        return EXIT_BUDGET_EXCEEDED
+    if fail_fast and summary['status'] == "different":
+        return EXIT_DIFFERENT
+    return EXIT_MATCH
+
 
 if __name__ == "__main__":
-    parser = argparse.ArgumentParser(description='Compare two CSV/PSV files and generate an HTML report.')
-    parser.add_argument('file1', help='Path to the first CSV/PSV file')
-    parser.add_argument('file2', help='Path to the second CSV/PSV file')
-    parser.add_argument('-o', '--output', required=True, help='Path to the output HTML file')
-    parser.add_argument('-k', '--key_cols', nargs='*', help='Key columns for identifying rows uniquely', default=[])
-    parser.add_argument('-t', '--type', choices=['full', 'difference', 'matched'], default='full', help='Type of report to generate')
+    parser = argparse.ArgumentParser(description='Compare two CSV/PSV/XLSX/JSON files and generate an HTML report.')
+    parser.add_argument('file1', help='Path to the first CSV/PSV/XLSX/JSON/JSONL/Parquet file')
+    parser.add_argument('file2', nargs='?', help='Path to the second CSV/PSV/XLSX/JSON/JSONL/Parquet file')
+    parser.add_argument('-o', '--output', help='Path to the output HTML file (required unless --db, --xlsx_report, --state_file, --fail-fast or --max-mismatches is used)')
+    parser.add_argument('-k', '--key_cols', nargs='*', help='Key columns for identifying rows uniquely (dotted paths such as customer.id for JSON)', default=[])
+    parser.add_argument('-t', '--type', choices=['full', 'difference', 'matched', 'cells'], default='full',
+                        help='Type of report to generate (cells lists only the differing cells, one per row)')
     parser.add_argument('-c', '--compare_cols', help='Comma-separated list of columns to compare')
     parser.add_argument('-d', '--delimiter', default=',', help='Delimiter used in the CSV/PSV files (default is comma)')
     parser.add_argument('-s', '--start_line', type=int, default=1, help='Start line for comparison (default is 1)')
     parser.add_argument('-e', '--end_line', type=int, help='End line for comparison')
+    parser.add_argument('--progress', action='store_true', help='Show a progress line with throughput and ETA on stderr')
+    parser.add_argument('--status_file', help='Path of a JSON status file refreshed while the comparison runs')
+    parser.add_argument('--status_interval', type=float, default=1.0, help='Minimum seconds between status updates (default is 1)')
+    parser.add_argument('--fail-fast', dest='fail_fast', action='store_true',
+                        help='Stop at the first mismatched chunk and exit with status {}'.format(EXIT_DIFFERENT))
+    parser.add_argument('--max-mismatches', dest='max_mismatches', type=int,
+                        help='Stop once more than N rows differ and exit with status {}'.format(EXIT_BUDGET_EXCEEDED))
+    parser.add_argument('--sample_rate', type=float, help='Compare only this fraction of rows (by key hash when key columns are given)')
+    parser.add_argument('--sample_seed', type=int, default=0, help='Seed for sample selection (default is 0)')
+    parser.add_argument('--confidence', type=float, default=0.95, help='Confidence level of the sampled mismatch rate interval (default is 0.95)')
+    parser.add_argument('--sheet1', help='Worksheet name or 0-based index to read from an .xlsx file1 (default is the first sheet)')
+    parser.add_argument('--sheet2', help='Worksheet name or 0-based index to read from an .xlsx file2 (default is the first sheet)')
+    parser.add_argument('--header_row', type=int, default=1, help='Worksheet row holding the column names for .xlsx inputs (default is 1)')
+    parser.add_argument('--db', help='Path of a SQLite file to store mismatch records and per-column stats in')
+    parser.add_argument('--xlsx_report', help='Path of an .xlsx report with a summary sheet and mismatch sheets (e.g. comparison_Summary/Comparison_Result.xlsx)')
+    parser.add_argument('--threads', type=int,
+                        help='Threads for per-column comparison (default is one per core for tables of {}+ columns)'.format(WIDE_TABLE_COLUMNS))
+    parser.add_argument('--block_lines', type=int, default=DEFAULT_BLOCK_LINES,
+                        help='Lines per manifest block (default is {})'.format(DEFAULT_BLOCK_LINES))
+    parser.add_argument('--build_manifest', action='store_true', help='Write the block digest manifest of file1 to the output path')
+    parser.add_argument('--diff_manifests', action='store_true', help='Treat file1 and file2 as manifests and list the blocks that differ')
+    parser.add_argument('--extract_blocks', metavar='OTHER_MANIFEST',
+                        help='Copy the blocks of file1 that differ from OTHER_MANIFEST to the output path, with a matching manifest')
+    parser.add_argument('--manifest1', help='Manifest describing file1; file1 may be a block extract')
+    parser.add_argument('--manifest2', help='Manifest describing file2; file2 may be a block extract')
+    parser.add_argument('--skip_identical_blocks', action='store_true',
+                        help='Hash both files first and only parse and compare blocks whose digests differ')
+    parser.add_argument('--match_by', choices=['position', 'key'],
+                        help='Pair records by position or by key columns (default is key when key columns are given, '
+                             'except with block manifests or the polars backend; else position)')
+    parser.add_argument('--partitions', type=int, help='Hash partitions spilled to disk when matching by key (default scales with input size)')
+    parser.add_argument('--spill_dir', help='Directory for key partition spill files (default is the system temp directory)')
+    parser.add_argument('--where',
+                        help="Compare only rows matching an expression, e.g. \"region == 'EMEA' and as_of_date >= '2024-01-01'\"")
+    parser.add_argument('--partition_filter',
+                        help="With two partitioned directories, compare only partitions matching an expression, e.g. \"dt >= '2024-06-01'\"")
+    parser.add_argument('--partition_workers', type=int, help='Partitions compared in parallel in directory mode (default is the CPU count)')
+    parser.add_argument('--duplicate_keys_report',
+                        help='CSV listing every duplicated key (count and line numbers) found while matching by key')
+    parser.add_argument('--layer', action='append', default=[],
+                        help='Further file compared after file2 as another layer, e.g. source staging --layer target (repeatable)')
+    parser.add_argument('--layer_names', nargs='*', help='Names of the layers in the report (default is source staging target for three files)')
+    parser.add_argument('--reconcile', action='store_true',
+                        help='Compare per-column aggregates (counts, nulls, sums, min/max, checksums) instead of cells; -o receives the aggregate report')
+    parser.add_argument('--drill_down', help='With --reconcile: when an aggregate differs, compare the affected columns row by row into this HTML report')
+    parser.add_argument('--sum_tolerance', type=float, default=1e-9, help='Relative/absolute tolerance for comparing column sums (default is 1e-9)')
+    parser.add_argument('--drift', action='store_true',
+                        help='Compare column distributions (distinct counts, quantiles, top values) from sketches; -o receives the drift report')
+    parser.add_argument('--drift_threshold', type=float, default=0.1, help='Relative change that counts as drift (default is 0.1)')
+    parser.add_argument('--backend', choices=list(BACKENDS), default='pandas',
+                        help='Dataframe engine for reading and comparing chunks (polars is multithreaded; default is pandas)')
+    parser.add_argument('--pipeline_depth', type=int,
+                        help='Chunk pairs read ahead and report blocks queued by background reader/writer threads (default is chosen by the planner)')
+    parser.add_argument('--strategy', choices=list(STRATEGIES), default='auto',
+                        help='How records are paired: auto (planned from a sample of both inputs), position, merge (sorted keys), hash (in memory) '
+                             'or partition (out of core)')
+    parser.add_argument('--fingerprints', help='Path of an .npz file receiving this run\'s mismatch fingerprints')
+    parser.add_argument('--previous_fingerprints', help='Fingerprints of an earlier run to diff this run against (new, resolved, persisting)')
+    parser.add_argument('--delta_report', help='Path of an HTML report listing new and resolved mismatches versus --previous_fingerprints')
+    parser.add_argument('--state_file', help='Incremental mode: compare only the records appended since the run recorded in this JSON state file')
+    parser.add_argument('--watch', action='store_true', help='Keep polling both files and compare appended records as they grow (needs --state_file)')
+    parser.add_argument('--watch_interval', type=float, default=5.0, help='Seconds between polls in --watch mode (default is 5)')
+    parser.add_argument('--normalize', help='JSON normalization spec (trim, lower/upper, strip_leading_zeros, date formats) applied to both inputs while reading')
+    parser.add_argument('--fixed_width_layout', help='Layout file (name,start,length per line, 1-based start) for fixed-width inputs')
+    parser.add_argument('--fixed_width_encoding', default='utf-8', help='Text encoding of fixed-width inputs (default is utf-8)')
+    parser.add_argument('--json_schema_sample', type=int, default=JSON_SCHEMA_SAMPLE,
+                        help='Records read from each JSON file to discover its flattened columns (default is {})'.format(JSON_SCHEMA_SAMPLE))
 
     args = parser.parse_args()
+    logger.addHandler(logging.StreamHandler())
+    logger.setLevel(logging.INFO)
+
+    if args.build_manifest or args.extract_blocks:
+        if not args.output:
+            parser.error('-o/--output is required with --build_manifest and --extract_blocks')
+        if not os.path.exists(args.file1):
+            print("The input file does not exist.")
+            sys.exit(EXIT_ERROR)
+        manifest = load_manifest(args.manifest1) if args.manifest1 else build_manifest(args.file1, args.block_lines)
+        if args.build_manifest:
+            write_manifest(manifest, args.output)
+            print(f"Manifest generated: {args.output} ({len(manifest['blocks'])} blocks)")
+        else:
+            extract_manifest = extract_blocks(args.file1, manifest, load_manifest(args.extract_blocks), args.output)
+            write_manifest(extract_manifest, args.output + '.manifest.json')
+            print(f"Block extract generated: {args.output} ({extract_manifest['size']} of {manifest['size']} bytes), manifest {args.output}.manifest.json")
+        sys.exit(EXIT_MATCH)
+
+    if not args.file2:
+        parser.error('file2 is required for comparisons')
+
+    if args.diff_manifests:
+        diff = diff_manifests(load_manifest(args.file1), load_manifest(args.file2))
+        print("Header: {}".format('same' if diff['header_match'] else 'different'))
+        print("Blocks: {blocks1} vs {blocks2}, {count} differing, {unpaired} unpaired".format(
+            count=len(diff['differing_blocks']), unpaired=len(diff['unpaired_blocks']), **diff))
+        manifest1 = load_manifest(args.file1)
+        for i in diff['differing_blocks']:
+            first_line, line_count = manifest1['blocks'][i][2], manifest1['blocks'][i][3]
+            print(f"  block {i}: lines {first_line}-{first_line + line_count - 1}")
+        identical = diff['header_match'] and not diff['differing_blocks'] and not diff['unpaired_blocks']
+        sys.exit(EXIT_MATCH if identical else EXIT_DIFFERENT)
+
+    if (not args.output and not args.db and not args.xlsx_report and not args.fail_fast and args.max_mismatches is None and not args.state_file
+            and not args.fingerprints and not args.delta_report and not args.drift):
+        parser.error('-o/--output is required unless --db, --xlsx_report, --fingerprints, --delta_report, --state_file, --drift, --fail-fast or --max-mismatches is used')
 
     if not os.path.exists(args.file1) or not os.path.exists(args.file2):
         print("One or both of the input files do not exist.")
-        sys.exit(1)
+        sys.exit(EXIT_ERROR)
+
+    if args.sample_rate is not None and not 0 < args.sample_rate <= 1:
+        parser.error('--sample_rate must be in (0, 1]')
+
+    fixed_width_layout = None
+    if args.fixed_width_layout:
+        if args.manifest1 or args.manifest2 or args.skip_identical_blocks:
+            parser.error('block manifests are only supported for delimited text files')
+        fixed_width_layout = load_fixed_width_layout(args.fixed_width_layout)
+
+    normalizer = None
+    if args.normalize:
+        try:
+            normalizer = load_normalization(args.normalize)
+        except ValueError as e:
+            parser.error(f'--normalize: {e}')
+    if args.where and (args.drift or args.reconcile or args.state_file or args.watch):
+        parser.error('--where filters row-level comparisons and cannot be combined with --drift, --reconcile or --state_file')
+    if args.strategy in KEYED_STRATEGIES and (args.match_by == 'position' or not args.key_cols):
+        parser.error(f'--strategy {args.strategy} pairs records by key and needs -k without --match_by position')
+    if args.strategy == 'position' and args.match_by == 'key':
+        parser.error('--strategy position cannot be combined with --match_by key')
+    for expression in (args.where, args.partition_filter):
+        if expression:
+            try:
+                RowFilter(expression)
+            except ValueError as e:
+                parser.error(str(e))
+
+    if os.path.isdir(args.file1) or os.path.isdir(args.file2):
+        if not (os.path.isdir(args.file1) and os.path.isdir(args.file2)):
+            parser.error('directory mode needs two directories')
+        if (args.drift or args.reconcile or args.state_file or args.watch or args.layer or args.db or args.xlsx_report or args.fingerprints
+                or args.previous_fingerprints or args.delta_report or args.duplicate_keys_report or args.manifest1 or args.manifest2
+                or args.skip_identical_blocks or args.start_line != 1 or args.end_line):
+            parser.error('directory mode writes one report per partition and cannot be combined with --drift, --reconcile, --state_file, '
+                         '--layer, --db, --xlsx_report, fingerprints, --duplicate_keys_report, block manifests or line ranges')
+        summary = compare_directories(args.file1, args.file2, args.output, args.partition_filter, args.partition_workers, key_cols=args.key_cols,
+                                      report_type=args.type, compare_cols=args.compare_cols.split(",") if args.compare_cols else None,
+                                      delimiter=args.delimiter, fail_fast=args.fail_fast, max_mismatches=args.max_mismatches,
+                                      sample_rate=args.sample_rate, sample_seed=args.sample_seed, confidence=args.confidence, threads=args.threads,
+                                      sheet1=args.sheet1, sheet2=args.sheet2, header_row=args.header_row, match_by=args.match_by,
+                                      partitions=args.partitions, spill_dir=args.spill_dir, json_schema_sample=args.json_schema_sample,
+                                      fixed_width_layout=fixed_width_layout, fixed_width_encoding=args.fixed_width_encoding, normalizer=normalizer,
+                                      pipeline_depth=args.pipeline_depth, backend=args.backend, where=args.where, strategy=args.strategy)
+        if summary:
+            print("Partitions: {compared} compared, {identical} identical (skipped), {different} different, {only_in_dir1} only in directory 1, "
+                  "{only_in_dir2} only in directory 2, {pruned} pruned, {failed} failed".format(**summary['partitions']))
+        sys.exit(exit_code_for(summary, args.fail_fast, args.max_mismatches))
+    if args.partition_filter:
+        parser.error('--partition_filter needs two partitioned directories')
+
+    if args.drift:
+        summary = compare_drift(args.file1, args.file2, args.output, args.delimiter, args.compare_cols.split(",") if args.compare_cols else None,
+                                args.drift_threshold, args.threads, args.sheet1, args.sheet2, args.header_row, fixed_width_layout,
+                                args.fixed_width_encoding, normalizer, args.json_schema_sample)
+        if summary:
+            print("Drift: {} (drifted columns: {})".format(summary['status'], ', '.join(summary['drifted_columns']) or 'none'))
+        if summary is None:
+            sys.exit(EXIT_ERROR)
+        sys.exit(EXIT_DIFFERENT if args.fail_fast and summary['status'] == "drift" else EXIT_MATCH)
+
+    if args.reconcile:
+        if args.sample_rate or args.layer or args.state_file or args.manifest1 or args.manifest2 or args.skip_identical_blocks:
+            parser.error('--reconcile cannot be combined with sampling, --layer, --state_file or block manifests')
+        summary = reconcile(args.file1, args.file2, args.output, args.delimiter, args.compare_cols.split(",") if args.compare_cols else None,
+                            args.key_cols, args.sheet1, args.sheet2, args.header_row, fixed_width_layout, args.fixed_width_encoding, normalizer,
+                            args.sum_tolerance, args.drill_down, args.json_schema_sample, report_type=args.type, match_by=args.match_by,
+                            partitions=args.partitions, spill_dir=args.spill_dir, threads=args.threads, db_file=args.db)
+        if summary:
+            print("Reconciliation: {status} ({rows[0]} vs {rows[1]} rows; differing columns: {columns})".format(
+                columns=', '.join(summary['differing_columns']) or 'none', **summary))
+        if summary is None:
+            sys.exit(EXIT_ERROR)
+        sys.exit(EXIT_DIFFERENT if args.fail_fast and summary['status'] == "different" else EXIT_MATCH)
+
+    if args.state_file or args.watch:
+        if not args.state_file:
+            parser.error('--watch requires --state_file')
+        if args.key_cols or args.sample_rate or args.layer or args.xlsx_report or args.start_line != 1 or args.end_line:
+            parser.error('--state_file compares appended records by position and cannot be combined with -k, sampling, ranges, --layer or --xlsx_report')
+        options = dict(output_file=args.output, report_type=args.type, compare_cols=args.compare_cols.split(",") if args.compare_cols else None,
+                       delimiter=args.delimiter, db_file=args.db, threads=args.threads, normalizer=normalizer)
+        try:
+            if args.watch:
+                summary = watch_files(args.file1, args.file2, args.state_file, args.watch_interval, **options)
+            else:
+                summary = compare_appended(args.file1, args.file2, args.state_file, **options)
+        except KeyboardInterrupt:
+            summary = load_watch_state(args.state_file)['summary'] if os.path.exists(args.state_file) else None
+        if summary:
+            print("Compared so far: {total} records, {same} same, {different} mismatched".format(**summary))
+        sys.exit(EXIT_MATCH if summary else EXIT_ERROR)
+
+    if args.layer:
+        if not args.output:
+            parser.error('-o/--output is required with --layer')
+        if any(not os.path.exists(path) for path in args.layer):
+            print("One or more of the layer files do not exist.")
+            sys.exit(EXIT_ERROR)
+        if args.sample_rate or args.db or args.xlsx_report or args.manifest1 or args.manifest2 or args.skip_identical_blocks:
+            parser.error('--layer cannot be combined with sampling, --db, --xlsx_report or block manifests')
+        if args.type == 'cells':
+            parser.error('--type cells is not available with --layer')
+        summary = compare_layers([args.file1, args.file2] + args.layer, args.output, args.key_cols, args.type,
+                                 args.compare_cols.split(",") if args.compare_cols else None, args.delimiter, args.start_line, args.end_line,
+                                 layer_names=args.layer_names, match_by=args.match_by, partitions=args.partitions, spill_dir=args.spill_dir,
+                                 threads=args.threads, header_row=args.header_row, json_schema_sample=args.json_schema_sample,
+                                 fixed_width_layout=fixed_width_layout, fixed_width_encoding=args.fixed_width_encoding, normalizer=normalizer,
+                                 duplicate_keys_report=args.duplicate_keys_report, where=args.where)
+        if summary:
+            for name, count in summary['first_divergence'].items():
+                print(f"First diverged at {name}: {count}")
+        sys.exit(exit_code_for(summary, args.fail_fast, args.max_mismatches))
+
+    block_manifests = None
+    if args.manifest1 or args.manifest2 or args.skip_identical_blocks:
+        if args.sample_rate or args.start_line != 1 or args.end_line or args.where:
+            parser.error('block manifests cannot be combined with --sample_rate, --start_line, --end_line or --where')
+        block_manifests = (load_manifest(args.manifest1) if args.manifest1 else build_manifest(args.file1, args.block_lines),
+                           load_manifest(args.manifest2) if args.manifest2 else build_manifest(args.file2, args.block_lines))
 
     compare_cols = args.compare_cols.split(",") if args.compare_cols else None
 
-    compare_csv(args.file1, args.file2, args.output, args.key_cols, args.type, compare_cols, args.delimiter, args.start_line, args.end_line)
+    summary = compare_csv(args.file1, args.file2, args.output, args.key_cols, args.type, compare_cols, args.delimiter, args.start_line, args.end_line,
+                          status_file=args.status_file, status_interval=args.status_interval, show_progress=args.progress,
+                          fail_fast=args.fail_fast, max_mismatches=args.max_mismatches,
+                          sample_rate=args.sample_rate, sample_seed=args.sample_seed, confidence=args.confidence,
+                          block_manifests=block_manifests, threads=args.threads, db_file=args.db,
+                          sheet1=args.sheet1, sheet2=args.sheet2, header_row=args.header_row, xlsx_report=args.xlsx_report,
+                          match_by=args.match_by, partitions=args.partitions, spill_dir=args.spill_dir,
+                          json_schema_sample=args.json_schema_sample, fixed_width_layout=fixed_width_layout,
+                          fixed_width_encoding=args.fixed_width_encoding, normalizer=normalizer, fingerprint_file=args.fingerprints,
+                          previous_fingerprints=args.previous_fingerprints, delta_report=args.delta_report,
+                          pipeline_depth=args.pipeline_depth, backend=args.backend, duplicate_keys_report=args.duplicate_keys_report,
+                          where=args.where, strategy=args.strategy)
+    if summary and 'delta' in summary:
+        print("Mismatches versus previous run: {new} new, {resolved} resolved, {persisting} persisting".format(**summary['delta']))
+    if summary and 'sample' in summary:
+        print("Estimated mismatch rate: {estimated_mismatch_rate:.4%} ({confidence:.0%} CI {ci_low:.4%} - {ci_high:.4%}) from {sample_size} sampled records".format(**summary['sample']))
+    if summary and (args.fail_fast or args.max_mismatches is not None):
+        print("Result: {status} ({different} mismatched of {total} compared records)".format(**summary))
+    sys.exit(exit_code_for(summary, args.fail_fast, args.max_mismatches))
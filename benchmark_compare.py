@@ -0,0 +1,269 @@
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import queue as queue_module
+import resource
+import subprocess
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+from Compare_data import BACKENDS, compare_csv
+
+SCALES = {
+    '100k': 100_000,
+    '1m': 1_000_000,
+    '10m': 10_000_000,
+    '50m': 50_000_000,
+}
+
+# Each profile varies one dimension of the input shape against the 'narrow' baseline
+PROFILES = {
+    'narrow': {'width': 8, 'mismatch_rate': 0.001, 'key_order': 'sorted', 'delimiter': ','},
+    'wide': {'width': 200, 'mismatch_rate': 0.001, 'key_order': 'sorted', 'delimiter': ','},
+    'dirty': {'width': 8, 'mismatch_rate': 0.10, 'key_order': 'sorted', 'delimiter': ','},
+    'shuffled_psv': {'width': 8, 'mismatch_rate': 0.01, 'key_order': 'shuffled', 'delimiter': '|'},
+}
+
+# compare_csv keyword arguments that define each engine mode being measured
+ENGINE_MODES = {
+    'full': {'report_type': 'full'},
+    'difference': {'report_type': 'difference'},
+    'cells': {'report_type': 'cells'},
+    'threaded': {'report_type': 'difference', 'threads': os.cpu_count() or 1},
+    'pipelined': {'report_type': 'full', 'pipeline_depth': 2},
+    'planned': {'report_type': 'full', 'strategy': 'auto'},
+    # Pairs records by the id column, so the key order of a profile decides the join the planner picks
+    'keyed': {'report_type': 'difference', 'key_cols': ['id'], 'strategy': 'auto'},
+}
+
+BLOCK_ROWS = 250_000
+SEED = 20240601
+CASE_TIMEOUT = 3600
+
+
+def case_name(scale, profile):
+    return f'{scale}-{profile}'
+
+
+def shuffled_keys(start, stop, rows):
+    # Affine permutation of [0, rows): deterministic key shuffling without holding the whole permutation
+    multiplier = 2654435761
+    while np.gcd(multiplier, rows) != 1:
+        multiplier += 2
+    positions = np.arange(start, stop, dtype=np.uint64)
+    return (positions * np.uint64(multiplier) + np.uint64(12345)) % np.uint64(rows)
+
+
+def generate_pair(path1, path2, rows, width, mismatch_rate, key_order, delimiter, seed=SEED):
+    rng = np.random.default_rng(seed)
+    columns = ['id'] + [f'col{i}' for i in range(1, width)]
+    header = True
+    with open(path1, 'w', newline='') as f1, open(path2, 'w', newline='') as f2:
+        for start in range(0, rows, BLOCK_ROWS):
+            stop = min(start + BLOCK_ROWS, rows)
+            count = stop - start
+            if key_order == 'shuffled':
+                keys = shuffled_keys(start, stop, rows)
+            else:
+                keys = np.arange(start, stop, dtype=np.uint64)
+            block = {'id': keys.astype(str)}
+            for i in range(1, width):
+                block[f'col{i}'] = rng.integers(0, 1_000_000, size=count).astype(str)
+            frame1 = pd.DataFrame(block, columns=columns)
+            frame2 = frame1.copy()
+            changed = np.flatnonzero(rng.random(count) < mismatch_rate)
+            if len(changed) and width > 1:
+                changed_cols = rng.integers(1, width, size=len(changed))
+                for col_index in np.unique(changed_cols):
+                    col = f'col{col_index}'
+                    target = changed[changed_cols == col_index]
+                    frame2.loc[frame2.index[target], col] = 'X' + frame2.loc[frame2.index[target], col]
+            frame1.to_csv(f1, sep=delimiter, index=False, header=header)
+            frame2.to_csv(f2, sep=delimiter, index=False, header=header)
+            header = False
+
+
+def ensure_pair(data_dir, scale, profile):
+    spec = PROFILES[profile]
+    base = os.path.join(data_dir, case_name(scale, profile))
+    path1, path2 = base + '_1.csv', base + '_2.csv'
+    marker = base + '.done'
+    if not os.path.exists(marker):
+        print(f'Generating {case_name(scale, profile)} ({SCALES[scale]:,} rows)...')
+        generate_pair(path1, path2, SCALES[scale], spec['width'], spec['mismatch_rate'], spec['key_order'], spec['delimiter'])
+        with open(marker, 'w') as m:
+            json.dump(spec, m)
+    return path1, path2
+
+
+def run_case(path1, path2, report_path, delimiter, mode_kwargs, queue):
+    devnull = open(os.devnull, 'w')
+    sys.stdout = devnull
+    start = time.perf_counter()
+    summary = compare_csv(path1, path2, report_path, delimiter=delimiter, **mode_kwargs)
+    seconds = time.perf_counter() - start
+    if summary is None:
+        # compare_csv reports its own errors and returns None
+        queue.put({'error': 'comparison failed'})
+        return
+    # ru_maxrss is reported in kilobytes on Linux
+    peak_rss_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+    queue.put({'seconds': seconds, 'peak_rss_mb': peak_rss_mb})
+
+
+def measure(path1, path2, report_path, delimiter, mode_kwargs, timeout=CASE_TIMEOUT):
+    # A fresh interpreter per case keeps peak RSS attributable to that case alone. A child that dies without
+    # a result (killed for memory, crashed) or runs past the timeout is reported as an error instead of hanging
+    context = multiprocessing.get_context('spawn')
+    queue = context.Queue()
+    process = context.Process(target=run_case, args=(path1, path2, report_path, delimiter, mode_kwargs, queue))
+    process.start()
+    deadline = time.monotonic() + timeout
+    result = None
+    while result is None:
+        try:
+            result = queue.get(timeout=1)
+        except queue_module.Empty:
+            if not process.is_alive():
+                try:
+                    # The result may have landed between the last poll and the exit
+                    result = queue.get(timeout=1)
+                except queue_module.Empty:
+                    result = {'error': f'worker exited with code {process.exitcode}'}
+            elif time.monotonic() > deadline:
+                process.terminate()
+                result = {'error': f'timed out after {timeout}s'}
+    process.join()
+    return result
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], stderr=subprocess.DEVNULL,
+                                       cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmarks(scales, profiles, modes, data_dir, keep_reports=False, backends=('pandas',), timeout=CASE_TIMEOUT):
+    os.makedirs(data_dir, exist_ok=True)
+    results = []
+    for scale in scales:
+        for profile in profiles:
+            path1, path2 = ensure_pair(data_dir, scale, profile)
+            rows = SCALES[scale]
+            for mode in modes:
+                for backend in backends:
+                    if backend != 'pandas' and 'key_cols' in ENGINE_MODES[mode]:
+                        # The other backends pair records by position only
+                        continue
+                    report_path = os.path.join(data_dir, f'{case_name(scale, profile)}_{mode}_{backend}.html')
+                    # Modes other than 'planned' pin their settings rather than leaving them to the strategy planner
+                    mode_kwargs = dict({'strategy': 'position'}, **ENGINE_MODES[mode], backend=backend)
+                    measured = measure(path1, path2, report_path, PROFILES[profile]['delimiter'], mode_kwargs, timeout)
+                    report_bytes = os.path.getsize(report_path) if os.path.exists(report_path) else 0
+                    if not keep_reports and os.path.exists(report_path):
+                        os.remove(report_path)
+                    if 'error' in measured:
+                        result = {'case': case_name(scale, profile), 'mode': mode, 'backend': backend, 'rows': rows, 'error': measured['error']}
+                        print('{case:<22} {mode:<12} {backend:<8} FAILED: {error}'.format(**result))
+                        results.append(result)
+                        continue
+                    result = {
+                        'case': case_name(scale, profile),
+                        'mode': mode,
+                        'backend': backend,
+                        'rows': rows,
+                        'seconds': round(measured['seconds'], 3),
+                        'rows_per_second': round(rows / measured['seconds'], 1),
+                        'peak_rss_mb': round(measured['peak_rss_mb'], 1),
+                        'report_bytes': report_bytes,
+                    }
+                    print('{case:<22} {mode:<12} {backend:<8} {rows_per_second:>14,.0f} rows/s {peak_rss_mb:>10,.1f} MB RSS '
+                          '{report_bytes:>16,} report bytes'.format(**result))
+                    results.append(result)
+    return {
+        'meta': {
+            'revision': git_revision(),
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'python': platform.python_version(),
+            'pandas': pd.__version__,
+            'host': platform.node(),
+        },
+        'results': results,
+    }
+
+
+def backend_speedups(results):
+    # Throughput of each backend relative to pandas on the same case and mode
+    reference = {(r['case'], r['mode']): r['rows_per_second'] for r in results if r.get('backend', 'pandas') == 'pandas' and 'error' not in r}
+    speedups = []
+    for result in results:
+        base = reference.get((result['case'], result['mode']))
+        if result.get('backend', 'pandas') != 'pandas' and base and 'error' not in result:
+            speedups.append((result['case'], result['mode'], result['backend'], result['rows_per_second'] / base))
+    return speedups
+
+
+def find_regressions(current, baseline, threshold):
+    previous = {(r['case'], r['mode'], r.get('backend', 'pandas')): r for r in baseline['results']}
+    regressions = []
+    for result in current['results']:
+        before = previous.get((result['case'], result['mode'], result.get('backend', 'pandas')))
+        if not before or 'error' in before:
+            continue
+        mode = '{}/{}'.format(result['mode'], result.get('backend', 'pandas'))
+        if 'error' in result:
+            # A case that used to run and now fails is the worst regression of all
+            regressions.append((result['case'], mode, 'error', 'ok', result['error']))
+            continue
+        if result['rows_per_second'] < before['rows_per_second'] * (1 - threshold):
+            regressions.append((result['case'], mode, 'rows_per_second', before['rows_per_second'], result['rows_per_second']))
+        if result['peak_rss_mb'] > before['peak_rss_mb'] * (1 + threshold):
+            regressions.append((result['case'], mode, 'peak_rss_mb', before['peak_rss_mb'], result['peak_rss_mb']))
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmark compare_csv on deterministic synthetic file pairs.')
+    parser.add_argument('--scales', nargs='*', choices=list(SCALES), default=['100k'], help='Data scales to run (default is 100k)')
+    parser.add_argument('--profiles', nargs='*', choices=list(PROFILES), default=list(PROFILES), help='Input shape profiles to run')
+    parser.add_argument('--modes', nargs='*', choices=list(ENGINE_MODES), default=list(ENGINE_MODES), help='Engine modes to measure')
+    parser.add_argument('--backends', nargs='*', choices=list(BACKENDS), default=['pandas'],
+                        help='Dataframe backends to measure; speedups are reported against pandas (default is pandas)')
+    parser.add_argument('--data_dir', default='benchmark_data', help='Directory for generated file pairs (reused across runs)')
+    parser.add_argument('-o', '--output', default='benchmark_results.json', help='Path to the JSON results file')
+    parser.add_argument('--baseline', help='Results JSON from an earlier run to check for regressions')
+    parser.add_argument('--threshold', type=float, default=0.10, help='Allowed relative slowdown/RSS growth versus the baseline (default is 0.10)')
+    parser.add_argument('--keep_reports', action='store_true', help='Keep the generated comparison reports')
+    parser.add_argument('--timeout', type=float, default=CASE_TIMEOUT,
+                        help=f'Seconds one case may run before it is stopped and recorded as failed (default is {CASE_TIMEOUT})')
+
+    args = parser.parse_args()
+
+    current = run_benchmarks(args.scales, args.profiles, args.modes, args.data_dir, args.keep_reports, args.backends, args.timeout)
+    for case, mode, backend, speedup in backend_speedups(current['results']):
+        print(f"{case:<22} {mode:<12} {backend:<8} {speedup:>6.2f}x pandas")
+    with open(args.output, 'w') as out:
+        json.dump(current, out, indent=2)
+    print(f"Benchmark results written: {args.output}")
+    failed = [result for result in current['results'] if 'error' in result]
+    if failed:
+        print(f"{len(failed)} case(s) failed")
+
+    if args.baseline:
+        with open(args.baseline) as b:
+            baseline = json.load(b)
+        regressions = find_regressions(current, baseline, args.threshold)
+        for case, mode, metric, before, after in regressions:
+            print(f"REGRESSION {case} {mode}: {metric} {before} -> {after}")
+        if regressions:
+            sys.exit(1)
+        print(f"No regressions beyond {args.threshold:.0%} against {args.baseline}")
+    if failed:
+        sys.exit(1)
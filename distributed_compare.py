@@ -0,0 +1,442 @@
+import argparse
+import io
+import json
+import math
+import os
+import queue
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+
+import numpy as np
+import pandas as pd
+
+from Compare_data import (JOIN_MEMORY_FACTOR, RECORD_COLUMN, ChunkComparison, HtmlReportWriter, SparseMismatches, align_on_keys,
+                          available_memory, key_partitions, partition_of)
+
+# Protocol: one JSON object per line, optionally followed by payload_bytes of raw data.
+#   worker -> coordinator  {"type": "ready"}
+#   coordinator -> worker  {"type": "split", "file": f, "range": r, "columns": [...], "key_cols": [...], "partitions": n,
+#                           "delimiter": d, "payload_bytes": n}  + header line and a newline-aligned byte range of the input
+#   worker -> coordinator  {"type": "split_result", "file": f, "range": r, "rows": n, "sizes": [...], "payload_bytes": n}
+#                           + the range's rows as headerless CSV, partition after partition
+#   coordinator -> worker  {"type": "task", "partition": i, "columns": [...], "key_cols": [...], "compare_cols": [...],
+#                           "bases": [[...], [...]], "sizes": [n1, n2], "payload_bytes": n1 + n2}
+#                           + the partition's slices of every range of file1, then of file2
+#   worker -> coordinator  {"type": "result", "partition": i, "summary": {...}, "payload_bytes": n}  + mismatch cells CSV
+#   coordinator -> worker  {"type": "done"}
+CHUNK_SIZE = 100000
+MISMATCH_COLUMNS = ['line_number', 'key', 'column', 'value1', 'value2']
+# Split rows carry their range and their line number within it; the range's first line is only known once
+# every earlier range has been counted
+RANGE_COLUMN = '_range'
+SPLIT_BYTES = 64 * 1024 * 1024
+COPY_BYTES = 1024 * 1024
+# Raw partition bytes, the parsed frames of both sides and their joined copy must fit in a worker's memory
+WORKER_MEMORY_FACTOR = 2 + 2 * JOIN_MEMORY_FACTOR
+DEFAULT_WORKER_MEMORY = 2 * 1024 * 1024 * 1024
+
+
+def send_message(stream, header, payload=b''):
+    header = dict(header, payload_bytes=len(payload))
+    stream.write(json.dumps(header).encode() + b'\n')
+    if payload:
+        stream.write(payload)
+    stream.flush()
+
+
+def send_slices(stream, header, slices, prefix=b''):
+    # Like send_message, with the payload streamed from (path, offset, length) slices of files instead of memory
+    header = dict(header, payload_bytes=len(prefix) + sum(length for _, _, length in slices))
+    stream.write(json.dumps(header).encode() + b'\n')
+    stream.write(prefix)
+    for path, offset, length in slices:
+        with open(path, 'rb') as source:
+            source.seek(offset)
+            while length:
+                data = source.read(min(length, COPY_BYTES))
+                if not data:
+                    raise ValueError(f"{path} is shorter than expected")
+                stream.write(data)
+                length -= len(data)
+    stream.flush()
+
+
+def receive_header(stream):
+    line = stream.readline()
+    if not line:
+        raise ConnectionError("Connection closed")
+    return json.loads(line)
+
+
+def receive_payload(stream, size):
+    payload = stream.read(size) if size else b''
+    if len(payload) != size:
+        raise ConnectionError("Connection closed mid-message")
+    return payload
+
+
+def receive_message(stream):
+    header = receive_header(stream)
+    return header, receive_payload(stream, header.get('payload_bytes', 0))
+
+
+def receive_to_file(stream, size, path):
+    with open(path, 'wb') as target:
+        while size:
+            data = stream.read(min(size, COPY_BYTES))
+            if not data:
+                raise ConnectionError("Connection closed mid-message")
+            target.write(data)
+            size -= len(data)
+
+
+def byte_ranges(path, start, split_bytes=SPLIT_BYTES):
+    # Newline-aligned (start, end) ranges of about split_bytes each, found by seeking rather than reading
+    size = os.path.getsize(path)
+    ranges = []
+    with open(path, 'rb') as handle:
+        while start < size:
+            handle.seek(min(start + split_bytes, size))
+            if handle.tell() < size:
+                handle.readline()
+            end = handle.tell()
+            ranges.append((start, end))
+            start = end
+    return ranges
+
+
+def split_range(task, payload):
+    # Worker side: parse one byte range and cut its rows into the key hash partitions, as spill_by_key does
+    partitions = task['partitions']
+    outputs = [io.BytesIO() for _ in range(partitions)]
+    rows = 0
+    reader = pd.read_csv(io.BytesIO(payload), chunksize=CHUNK_SIZE, dtype=str, keep_default_na=False, delimiter=task['delimiter'])
+    for chunk in reader:
+        chunk = chunk.assign(line_number=np.arange(rows + 1, rows + len(chunk) + 1), **{RANGE_COLUMN: task['range']})
+        rows += len(chunk)
+        ids = partition_of(chunk, task['key_cols'], partitions)
+        order = np.argsort(ids, kind='stable')
+        for part in np.split(order, np.flatnonzero(np.diff(ids[order])) + 1):
+            if len(part):
+                chunk.iloc[part].to_csv(outputs[ids[part[0]]], index=False, header=False)
+    blobs = [output.getvalue() for output in outputs]
+    return rows, [len(blob) for blob in blobs], b''.join(blobs)
+
+
+def read_partition(data, columns, bases):
+    names = list(columns) + ['line_number', RANGE_COLUMN]
+    if not data:
+        return pd.DataFrame({col: pd.Series(dtype=str) for col in columns}).assign(line_number=pd.Series(dtype='int64'))
+    frame = pd.read_csv(io.BytesIO(data), header=None, names=names, dtype=str, keep_default_na=False)
+    ranges = frame.pop(RANGE_COLUMN).astype('int64').to_numpy()
+    frame['line_number'] = frame['line_number'].astype('int64').to_numpy() + np.asarray(bases, dtype=np.int64)[ranges]
+    return frame
+
+
+def compare_partition(task, payload):
+    # Worker side: join one partition pair by key and compare it in chunk-sized slices
+    key_cols = task['key_cols']
+    size1 = task['sizes'][0]
+    frame1 = read_partition(payload[:size1], task['columns'], task['bases'][0])
+    frame2 = read_partition(payload[size1:], task['columns'], task['bases'][1])
+    aligned1, aligned2 = align_on_keys(frame1, frame2, key_cols)
+    all_columns = list(task['compare_cols'] or task['columns']) + [RECORD_COLUMN]
+    summary = {'total': 0, 'same': 0, 'different': 0,
+               'only_in_file1': int((aligned2[RECORD_COLUMN] == 'missing').sum()),
+               'only_in_file2': int((aligned1[RECORD_COLUMN] == 'missing').sum())}
+    cells = io.StringIO()
+    for start in range(0, len(aligned1), CHUNK_SIZE):
+        comparison = ChunkComparison(aligned1.iloc[start:start + CHUNK_SIZE], aligned2.iloc[start:start + CHUNK_SIZE], all_columns)
+        different = int(comparison.row_diff.sum())
+        summary['total'] += len(comparison.row_diff)
+        summary['different'] += different
+        summary['same'] += len(comparison.row_diff) - different
+        mismatches = comparison.mismatches()
+        if len(mismatches):
+            keys = comparison.chunk1[key_cols].iloc[mismatches.rows].astype(str)
+            pd.DataFrame({
+                'line_number': mismatches.line_numbers,
+                'key': keys[key_cols[0]].str.cat([keys[col] for col in key_cols[1:]], sep='|').to_numpy(),
+                'column': np.asarray(all_columns)[mismatches.column_ids],
+                'value1': mismatches.values1,
+                'value2': mismatches.values2,
+            }).to_csv(cells, index=False, header=False)
+    return summary, cells.getvalue().encode()
+
+
+def run_worker(host, port):
+    with socket.create_connection((host, port)) as sock, sock.makefile('rwb') as stream:
+        send_message(stream, {'type': 'ready'})
+        partitions = 0
+        while True:
+            task, payload = receive_message(stream)
+            if task['type'] == 'done':
+                return partitions
+            if task['type'] == 'split':
+                rows, sizes, blobs = split_range(task, payload)
+                send_message(stream, {'type': 'split_result', 'file': task['file'], 'range': task['range'], 'rows': rows, 'sizes': sizes}, blobs)
+                continue
+            summary, cells = compare_partition(task, payload)
+            send_message(stream, {'type': 'result', 'partition': task['partition'], 'summary': summary}, cells)
+            partitions += 1
+
+
+def worker_partitions(total_bytes, worker_memory=None):
+    # Enough partitions that one partition pair fits in a worker's memory however large the input, and never
+    # fewer than compare_csv would spill
+    worker_memory = worker_memory or available_memory() or DEFAULT_WORKER_MEMORY
+    return max(math.ceil(total_bytes * WORKER_MEMORY_FACTOR / worker_memory), key_partitions(total_bytes))
+
+
+class Coordinator:
+    # Cuts both inputs into newline-aligned byte ranges and streams them, unparsed, to whichever worker asks next;
+    # workers parse each range and return its rows cut into key hash partitions (the same partitioning as
+    # compare_csv's keyed mode). Once every range is back, partition pairs are streamed to workers from those
+    # range files. A task whose worker disconnects is handed out again
+    def __init__(self, file1, file2, key_cols, output_file=None, compare_cols=None, delimiter=',', partitions=None,
+                 spill_dir=None, host='127.0.0.1', port=0, worker_memory=None, split_bytes=SPLIT_BYTES):
+        self.file1 = file1
+        self.file2 = file2
+        self.key_cols = list(key_cols)
+        self.output_file = output_file
+        self.compare_cols = compare_cols
+        self.delimiter = delimiter
+        self.partitions = partitions or worker_partitions(os.path.getsize(file1) + os.path.getsize(file2), worker_memory)
+        self.spill_dir = spill_dir
+        self.split_bytes = split_bytes
+        self.directory = None
+        self.tasks = queue.Queue()
+        self.pending = 0
+        self.lock = threading.Lock()
+        self.finished = threading.Event()
+        self.error = None
+        self.connections = 0
+        self.summary = {'total': 0, 'same': 0, 'different': 0, 'only_in_file1': 0, 'only_in_file2': 0}
+        self.report = None
+        self.server = socket.create_server((host, port))
+        self.address = self.server.getsockname()[:2]
+
+    def split_inputs(self):
+        self.columns = list(pd.read_csv(self.file1, delimiter=self.delimiter, nrows=0).columns)
+        if list(pd.read_csv(self.file2, delimiter=self.delimiter, nrows=0).columns) != self.columns:
+            raise ValueError("CSV files have different columns")
+        if self.compare_cols:
+            missing = [col for col in self.compare_cols if col not in self.columns]
+            if missing:
+                raise ValueError(f"Unknown columns to compare: {', '.join(missing)}")
+        self.headers, self.ranges = [], []
+        for path in (self.file1, self.file2):
+            with open(path, 'rb') as handle:
+                header = handle.readline()
+            self.headers.append(header if header.endswith(b'\n') else header + b'\n')
+            self.ranges.append(byte_ranges(path, len(header), self.split_bytes))
+        # Per file and range: rows, then the byte sizes of each partition's slice of the range file
+        self.range_rows = [[None] * len(ranges) for ranges in self.ranges]
+        self.range_sizes = [[None] * len(ranges) for ranges in self.ranges]
+        return [('split', i, r) for i, ranges in enumerate(self.ranges) for r in range(len(ranges))]
+
+    def range_path(self, i, r):
+        return os.path.join(self.directory, f'file{i + 1}_range{r}.csv')
+
+    def compare_tasks(self):
+        bases = [np.concatenate(([0], np.cumsum(rows)[:-1])).astype(int).tolist() if rows else [] for rows in self.range_rows]
+        offsets = [[np.concatenate(([0], np.cumsum(sizes)[:-1])).astype(int).tolist() for sizes in file_sizes] for file_sizes in self.range_sizes]
+        tasks = []
+        for p in range(self.partitions):
+            slices = [[(self.range_path(i, r), offsets[i][r][p], self.range_sizes[i][r][p])
+                       for r in range(len(self.ranges[i])) if self.range_sizes[i][r][p]] for i in (0, 1)]
+            tasks.append(('compare', p, slices, bases))
+        return tasks
+
+    def merge_split(self, result, stream):
+        i, r = result['file'], result['range']
+        receive_to_file(stream, result['payload_bytes'], self.range_path(i, r))
+        with self.lock:
+            self.range_rows[i][r] = result['rows']
+            self.range_sizes[i][r] = result['sizes']
+            self.pending -= 1
+            if self.pending == 0:
+                # Every range is partitioned: the partition pairs can be compared
+                tasks = self.compare_tasks()
+                self.pending = len(tasks)
+                for task in tasks:
+                    self.tasks.put(task)
+                if not tasks:
+                    self.finished.set()
+
+    def merge_result(self, result, cells):
+        with self.lock:
+            for name in self.summary:
+                self.summary[name] += result['summary'][name]
+            if self.report and cells:
+                frame = pd.read_csv(io.BytesIO(cells), header=None, names=MISMATCH_COLUMNS, dtype=str, keep_default_na=False)
+                columns = list(dict.fromkeys(frame['column']))
+                column_ids = pd.Categorical(frame['column'], categories=columns).codes.astype(np.int32)
+                self.report.write_mismatches(SparseMismatches(columns, None, frame['line_number'].astype('int64').to_numpy(), column_ids,
+                                                              frame['value1'].to_numpy(), frame['value2'].to_numpy()))
+            self.pending -= 1
+            if self.pending == 0:
+                self.finished.set()
+
+    def send_task(self, stream, task):
+        if task[0] == 'split':
+            _, i, r = task
+            start, end = self.ranges[i][r]
+            send_slices(stream, {'type': 'split', 'file': i, 'range': r, 'columns': self.columns, 'key_cols': self.key_cols,
+                                 'partitions': self.partitions, 'delimiter': self.delimiter},
+                        [((self.file1, self.file2)[i], start, end - start)], self.headers[i])
+            return
+        _, index, slices, bases = task
+        send_slices(stream, {'type': 'task', 'partition': index, 'columns': self.columns, 'key_cols': self.key_cols,
+                             'compare_cols': self.compare_cols, 'bases': bases,
+                             'sizes': [sum(length for _, _, length in side) for side in slices]}, slices[0] + slices[1])
+
+    def serve(self, connection):
+        task = None
+        with self.lock:
+            self.connections += 1
+        try:
+            with connection, connection.makefile('rwb') as stream:
+                receive_message(stream)
+                while True:
+                    try:
+                        task = self.tasks.get(timeout=0.2)
+                    except queue.Empty:
+                        if self.finished.is_set():
+                            send_message(stream, {'type': 'done'})
+                            return
+                        continue
+                    self.send_task(stream, task)
+                    result = receive_header(stream)
+                    if result['type'] == 'split_result':
+                        self.merge_split(result, stream)
+                    else:
+                        self.merge_result(result, receive_payload(stream, result.get('payload_bytes', 0)))
+                    task = None
+        except (OSError, json.JSONDecodeError):
+            if task is not None:
+                self.tasks.put(task)
+        except Exception as e:
+            self.error = e
+            self.finished.set()
+        finally:
+            with self.lock:
+                self.connections -= 1
+
+    def accept(self):
+        while not self.finished.is_set():
+            try:
+                connection, _ = self.server.accept()
+            except OSError:
+                return
+            threading.Thread(target=self.serve, args=(connection,), daemon=True).start()
+
+    def run(self, local_workers=0):
+        self.directory = tempfile.mkdtemp(prefix='compare_partitions_', dir=self.spill_dir)
+        workers = []
+        try:
+            tasks = self.split_inputs()
+            if self.output_file:
+                self.report = HtmlReportWriter(self.output_file, self.file1, self.file2, 'cells')
+            self.pending = len(tasks)
+            if not tasks:
+                self.finished.set()
+            for task in tasks:
+                self.tasks.put(task)
+            threading.Thread(target=self.accept, daemon=True).start()
+            host, port = self.address
+            for _ in range(local_workers):
+                workers.append(subprocess.Popen([sys.executable, os.path.abspath(__file__), 'worker', '--connect', f'{host}:{port}']))
+            while not self.finished.wait(1.0):
+                if workers and all(worker.poll() is not None for worker in workers) and not self.connections:
+                    raise RuntimeError("All local workers exited before the comparison finished")
+            if self.error:
+                raise self.error
+            for worker in workers:
+                worker.wait()
+            self.summary['status'] = "different" if self.summary['different'] else "match"
+            self.summary['stopped_early'] = False
+            self.summary['partitions'] = self.partitions
+            if self.report:
+                self.report.close(self.summary)
+            return self.summary
+        except Exception:
+            if self.report:
+                self.report.abort()
+            for worker in workers:
+                worker.kill()
+            raise
+        finally:
+            self.server.close()
+            shutil.rmtree(self.directory, ignore_errors=True)
+
+
+def compare_distributed(file1, file2, key_cols, output_file=None, compare_cols=None, delimiter=',', partitions=None, spill_dir=None,
+                        host='127.0.0.1', port=0, local_workers=2, worker_memory=None, split_bytes=SPLIT_BYTES):
+    try:
+        if worker_memory is None and local_workers:
+            # Local workers share this host's memory
+            worker_memory = (available_memory() or DEFAULT_WORKER_MEMORY) // local_workers
+        coordinator = Coordinator(file1, file2, key_cols, output_file, compare_cols, delimiter, partitions, spill_dir, host, port,
+                                  worker_memory, split_bytes)
+        print(f"Coordinator listening on {coordinator.address[0]}:{coordinator.address[1]}")
+        summary = coordinator.run(local_workers)
+        if output_file:
+            print(f"Comparison report generated: {output_file}")
+        return summary
+    except Exception as e:
+        print(f"An error occurred during the comparison: {e}")
+        return None
+
+
+def parse_address(value):
+    host, _, port = value.rpartition(':')
+    return host or '127.0.0.1', int(port)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Compare two large CSV/PSV files by key across several worker processes or hosts.')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    coordinator_parser = commands.add_parser('coordinator', help='Partition the inputs by key and hand partition pairs to workers')
+    coordinator_parser.add_argument('file1', help='Path to the first CSV/PSV file')
+    coordinator_parser.add_argument('file2', help='Path to the second CSV/PSV file')
+    coordinator_parser.add_argument('-k', '--key_cols', nargs='+', required=True, help='Key columns for identifying rows uniquely')
+    coordinator_parser.add_argument('-o', '--output', help='Path to the merged HTML report (one row per differing cell)')
+    coordinator_parser.add_argument('-c', '--compare_cols', help='Comma-separated list of columns to compare')
+    coordinator_parser.add_argument('-d', '--delimiter', default=',', help='Delimiter used in the CSV/PSV files (default is comma)')
+    coordinator_parser.add_argument('--partitions', type=int,
+                                    help='Key hash partitions, i.e. units of comparison work (default is sized so one partition pair '
+                                         'fits in a worker\'s memory)')
+    coordinator_parser.add_argument('--worker_memory_mb', type=int,
+                                    help='Memory of one worker in MB, used to size the partitions (default is this host\'s available memory '
+                                         'shared between the local workers)')
+    coordinator_parser.add_argument('--split_mb', type=int, default=SPLIT_BYTES // (1024 * 1024),
+                                    help='Size of the byte ranges each worker parses and partitions (default is 64)')
+    coordinator_parser.add_argument('--spill_dir', help='Directory for the partitioned ranges (default is the system temp directory)')
+    coordinator_parser.add_argument('--listen', default='127.0.0.1:0', help='host:port to accept workers on (default is a free local port)')
+    coordinator_parser.add_argument('--local_workers', type=int, default=os.cpu_count() or 1,
+                                    help='Worker processes to start on this host (default is one per core; 0 to rely on remote workers)')
+
+    worker_parser = commands.add_parser('worker', help='Connect to a coordinator and compare the partitions it sends')
+    worker_parser.add_argument('--connect', required=True, help='host:port of the coordinator')
+
+    args = parser.parse_args()
+
+    if args.command == 'worker':
+        host, port = parse_address(args.connect)
+        run_worker(host, port)
+        sys.exit(0)
+
+    host, port = parse_address(args.listen)
+    summary = compare_distributed(args.file1, args.file2, args.key_cols, args.output, args.compare_cols.split(",") if args.compare_cols else None,
+                                  args.delimiter, args.partitions, args.spill_dir, host, port, args.local_workers,
+                                  args.worker_memory_mb * 1024 * 1024 if args.worker_memory_mb else None, args.split_mb * 1024 * 1024)
+    if summary:
+        print("Result: {status} ({different} mismatched of {total} compared records, {only_in_file1} only in file1, "
+              "{only_in_file2} only in file2)".format(**summary))
+    sys.exit(0 if summary else 1)
@@ -0,0 +1,557 @@
+import io
+import json
+import numpy as np
+import pytest
+import Compare_data
+from Compare_data import DEFAULT_BLOCK_LINES, build_manifest, compare_csv, diff_manifests, extract_blocks
+
+
+def write_csv(path, rows, header='id,name,amount', delimiter=','):
+    with open(path, 'w') as f:
+        f.write(header.replace(',', delimiter) + '\n')
+        for row in rows:
+            f.write(delimiter.join(str(v) for v in row) + '\n')
+    return str(path)
+
+
+@pytest.fixture
+def csv_pair(tmp_path):
+    rows1 = [(i, f'name{i}', i * 10) for i in range(1, 21)]
+    rows2 = [(i, f'name{i}' if i % 5 else f'other{i}', i * 10) for i in range(1, 21)]
+    return write_csv(tmp_path / 'file1.csv', rows1), write_csv(tmp_path / 'file2.csv', rows2)
+
+
+def test_progress_callback_reports_throughput(csv_pair, tmp_path):
+    updates = []
+    status_file = str(tmp_path / 'status.json')
+    compare_csv(csv_pair[0], csv_pair[1], str(tmp_path / 'report.html'),
+                progress_callback=updates.append, status_file=status_file)
+    assert updates[-1]['state'] == 'finished'
+    assert updates[-1]['rows'] == 20
+    assert updates[-1]['mismatches'] == 4
+    assert updates[-1]['percent'] == 100.0
+    assert {'rows_per_second', 'mb_per_second', 'eta_seconds'} <= set(updates[-1])
+    with open(status_file) as sf:
+        assert json.load(sf)['state'] == 'finished'
+
+
+def test_fail_fast_stops_without_report(csv_pair):
+    summary = compare_csv(csv_pair[0], csv_pair[1], None, fail_fast=True)
+    assert summary['status'] == 'different'
+    assert summary['stopped_early']
+
+
+def test_max_mismatches_budget(csv_pair):
+    within = compare_csv(csv_pair[0], csv_pair[1], None, max_mismatches=4)
+    exceeded = compare_csv(csv_pair[0], csv_pair[1], None, max_mismatches=3)
+    assert within['status'] == 'within_budget'
+    assert exceeded['status'] == 'budget_exceeded'
+
+
+def test_sampling_by_key_pairs_reordered_files(tmp_path):
+    rows = [(i, f'name{i}', i * 10) for i in range(1, 2001)]
+    changed = [(i, n if i % 10 else 'changed', a) for i, n, a in rows]
+    file1 = write_csv(tmp_path / 'file1.csv', rows)
+    file2 = write_csv(tmp_path / 'file2.csv', list(reversed(changed)))
+    summary = compare_csv(file1, file2, None, key_cols=['id'], sample_rate=0.5, sample_seed=7)
+    sample = summary['sample']
+    assert 800 < sample['sample_size'] < 1200
+    assert sample['ci_low'] <= 0.1 <= sample['ci_high']
+    assert sample['estimated_population'] == 2000
+
+
+def test_sampling_by_line_is_deterministic(csv_pair):
+    first = compare_csv(csv_pair[0], csv_pair[1], None, sample_rate=0.5, sample_seed=1)
+    second = compare_csv(csv_pair[0], csv_pair[1], None, sample_rate=0.5, sample_seed=1)
+    assert first == second
+    assert first['sample']['by'] == 'line'
+
+
+def test_manifest_blocks_independent_of_read_size(csv_pair, monkeypatch):
+    expected = build_manifest(csv_pair[0], block_lines=3)
+    monkeypatch.setattr(Compare_data, 'MANIFEST_READ_SIZE', 7)
+    assert build_manifest(csv_pair[0], block_lines=3) == expected
+    assert sum(block[3] for block in expected['blocks']) == 20
+
+
+def test_block_manifests_compare_only_differing_blocks(csv_pair, tmp_path):
+    manifest1 = build_manifest(csv_pair[0], block_lines=4)
+    manifest2 = build_manifest(csv_pair[1], block_lines=4)
+    # Rows 5, 10, 15 and 20 differ; block 0 (rows 1-4) is the only byte-identical one
+    assert diff_manifests(manifest1, manifest2)['differing_blocks'] == [1, 2, 3, 4]
+    extract_path = str(tmp_path / 'extract.csv')
+    extract_manifest = extract_blocks(csv_pair[1], manifest2, manifest1, extract_path)
+    summary = compare_csv(csv_pair[0], extract_path, None, block_manifests=(manifest1, extract_manifest))
+    assert summary == compare_csv(csv_pair[0], csv_pair[1], None)
+
+
+def test_threaded_column_comparison_matches_serial(tmp_path):
+    header = ','.join(f'c{i}' for i in range(40))
+    rows1 = [[r * 40 + c for c in range(40)] for r in range(30)]
+    rows2 = [[v if (r + c) % 17 else 'x' for c, v in enumerate(row)] for r, row in enumerate(rows1)]
+    file1 = write_csv(tmp_path / 'wide1.csv', rows1, header=header)
+    file2 = write_csv(tmp_path / 'wide2.csv', rows2, header=header)
+    serial_report, threaded_report = tmp_path / 'serial.html', tmp_path / 'threaded.html'
+    serial = compare_csv(file1, file2, str(serial_report), threads=1)
+    threaded = compare_csv(file1, file2, str(threaded_report), threads=4)
+    assert serial == threaded
+    assert serial_report.read_text() == threaded_report.read_text()
+
+
+def test_sparse_mismatches_hold_only_differing_cells(tmp_path):
+    import pandas as pd
+    from Compare_data import ChunkComparison
+    chunk1 = pd.DataFrame({'a': ['1', '2', '3'], 'b': ['x', 'y', 'z'], 'line_number': [1, 2, 3]})
+    chunk2 = pd.DataFrame({'a': ['1', '9', '3'], 'b': ['x', 'y', 'q'], 'line_number': [1, 2, 3]})
+    mismatches = ChunkComparison(chunk1, chunk2, ['a', 'b']).mismatches()
+    assert list(mismatches.iter_cells()) == [(2, 'a', '2', '9'), (3, 'b', 'z', 'q')]
+
+
+def test_cells_report_lists_differing_cells(csv_pair, tmp_path):
+    report = tmp_path / 'cells.html'
+    compare_csv(csv_pair[0], csv_pair[1], str(report), report_type='cells')
+    content = report.read_text()
+    assert '<td>5</td><td>name</td><td class="diff">name5</td><td class="diff">other5</td>' in content
+    assert content.count('<td class="diff">') == 8
+
+
+def test_sqlite_store_is_queryable(csv_pair, tmp_path):
+    import sqlite3
+    db_file = str(tmp_path / 'results.sqlite')
+    compare_csv(csv_pair[0], csv_pair[1], None, key_cols=['id', 'amount'], db_file=db_file)
+    compare_csv(csv_pair[0], csv_pair[0], None, db_file=db_file)
+    conn = sqlite3.connect(db_file)
+    assert conn.execute('SELECT run_id, total, different, status FROM runs').fetchall() == [(1, 20, 4, 'different'), (2, 20, 0, 'match')]
+    assert conn.execute('SELECT column_name, mismatches FROM column_stats WHERE run_id = 1').fetchall() == [('name', 4)]
+    rows = conn.execute("SELECT line_number, key, value1, value2 FROM mismatches WHERE column_name = 'name' AND key GLOB '1*'").fetchall()
+    assert rows == [(10, '10|100', 'name10', 'other10'), (15, '15|150', 'name15', 'other15')]
+
+
+def test_xlsx_inputs_stream_through_the_same_pipeline(tmp_path):
+    openpyxl = pytest.importorskip('openpyxl')
+    paths = []
+    for name, changed in (('book1.xlsx', False), ('book2.xlsx', True)):
+        workbook = openpyxl.Workbook()
+        sheet = workbook.active
+        sheet.title = 'Extract'
+        sheet.append(['Report generated for testing'])
+        sheet.append(['id', 'name', 'amount'])
+        for i in range(1, 21):
+            sheet.append([i, 'other' if changed and i % 5 == 0 else f'name{i}', i * 10.0])
+        workbook.save(tmp_path / name)
+        paths.append(str(tmp_path / name))
+    csv_path = write_csv(tmp_path / 'file1.csv', [(i, f'name{i}', i * 10) for i in range(1, 21)])
+    assert compare_csv(paths[0], paths[1], None, sheet1='Extract', sheet2='0', header_row=2)['different'] == 4
+    assert compare_csv(csv_path, paths[0], None, header_row=2)['status'] == 'match'
+    # A sheet named like a number is found by name before the number is taken as an index
+    workbook = openpyxl.load_workbook(paths[1])
+    workbook.create_sheet('Notes', 0)
+    workbook['Extract'].title = '0'
+    workbook.save(tmp_path / 'named.xlsx')
+    assert compare_csv(paths[0], str(tmp_path / 'named.xlsx'), None, sheet2='0', header_row=2)['different'] == 4
+
+
+def test_xlsx_report_rolls_over_full_sheets(csv_pair, tmp_path, monkeypatch):
+    openpyxl = pytest.importorskip('openpyxl')
+    monkeypatch.setattr(Compare_data, 'EXCEL_MAX_ROWS', 3)
+    report = str(tmp_path / 'Comparison_Result.xlsx')
+    compare_csv(csv_pair[0], csv_pair[1], None, xlsx_report=report)
+    workbook = openpyxl.load_workbook(report, read_only=True)
+    assert workbook.sheetnames == ['Summary', 'removed', 'added', 'changed', 'changed 2']
+    changed = list(workbook['changed'].values)
+    assert changed[0] == ('line_number', 'id', 'name', 'amount')
+    assert changed[1] == (5, '5', 'name5 ---> other5', '50')
+    summary = dict(row[:2] for row in workbook['Summary'].values if len(row) >= 2)
+    assert summary['Mismatched records'] == 4
+    assert summary['name'] == 4
+
+
+def test_xlsx_report_splits_added_removed_and_changed(tmp_path):
+    openpyxl = pytest.importorskip('openpyxl')
+    file1 = write_csv(tmp_path / 'k1.csv', [(1, 'a', 10), (2, 'b', 20), (3, 'c', 30)])
+    file2 = write_csv(tmp_path / 'k2.csv', [(2, 'B', 20), (3, 'c', 30), (4, 'd', 40)])
+    report = str(tmp_path / 'keyed.xlsx')
+    compare_csv(file1, file2, None, key_cols=['id'], match_by='key', xlsx_report=report)
+    workbook = openpyxl.load_workbook(report, read_only=True)
+    sheets = {name: list(workbook[name].values) for name in ('removed', 'added', 'changed')}
+    assert sheets['removed'] == [('line_number', 'id', 'name', 'amount'), (1, '1', 'a', '10')]
+    assert sheets['added'] == [('line_number', 'id', 'name', 'amount'), (3, '4', 'd', '40')]
+    assert sheets['changed'] == [('line_number', 'id', 'name', 'amount'), (2, '2', 'b ---> B', '20')]
+    summary = dict(row[:2] for row in workbook['Summary'].values if len(row) >= 2)
+    assert (summary['Only in file 1'], summary['Only in file 2'], summary['name']) == (1, 1, 1)
+
+
+def test_json_array_and_jsonl_paired_by_key_path(tmp_path):
+    records = [{'customer': {'id': i, 'name': f'name{i}'}, 'amount': i * 1.5, 'tags': ['a', 'b']} for i in range(1, 51)]
+    changed = [dict(r, amount=0) if r['customer']['id'] % 10 == 0 else r for r in records]
+    file1 = tmp_path / 'orders.json'
+    file1.write_text(json.dumps(records, indent=2))
+    file2 = tmp_path / 'orders.jsonl'
+    file2.write_text('\n'.join(json.dumps(r) for r in reversed(changed[1:])) + '\n')
+    summary = compare_csv(str(file1), str(file2), str(tmp_path / 'report.html'), key_cols=['customer.id'], partitions=3)
+    # Five changed amounts plus customer 1, which is missing from file2
+    assert summary['different'] == 6
+    assert summary['only_in_file1'] == 1 and summary['only_in_file2'] == 0
+    assert 'customer.name' in (tmp_path / 'report.html').read_text()
+
+
+def test_json_records_stream_across_read_boundaries(monkeypatch):
+    monkeypatch.setattr(Compare_data, 'JSON_READ_SIZE', 5)
+    handle = io.BytesIO('﻿[{"a": {"b": "é"}}, {"a": 2}]'.encode('utf-8'))
+    records = list(Compare_data.iter_json_records(handle))
+    assert records == [{'a': {'b': 'é'}}, {'a': 2}]
+    assert Compare_data.JsonFlattener().flatten(records[0]) == {'a.b': 'é'}
+
+
+def test_three_layers_report_first_divergence(tmp_path):
+    rows = [(i, f'name{i}', i * 10) for i in range(1, 11)]
+    staging = [(i, 'renamed' if i == 3 else n, a) for i, n, a in rows if i != 7]
+    target = [(i, n, 0 if i == 5 else a) for i, n, a in reversed(staging)]
+    files = [write_csv(tmp_path / f'{name}.csv', data) for name, data in (('source', rows), ('staging', staging), ('target', target))]
+    report = tmp_path / 'layers.html'
+    summary = Compare_data.compare_layers(files, str(report), key_cols=['id'], report_type='difference', partitions=2)
+    # Row 3 changed in staging (and stayed changed), row 7 was dropped in staging, row 5 changed in target
+    assert summary['different'] == 3
+    assert summary['first_divergence'] == {'staging': 2, 'target': 1}
+    assert summary['column_divergence']['_record'] == {'staging': 1}
+    assert summary['column_divergence']['amount'] == {'staging': 1, 'target': 1}
+    assert 'diverged at target' in report.read_text()
+
+
+def test_fixed_width_inputs_sliced_by_layout(tmp_path):
+    layout_path = tmp_path / 'layout.csv'
+    layout_path.write_text('name,start,length\nid,1,5\nname,6,10\namount,16,8\n')
+    layout = Compare_data.load_fixed_width_layout(str(layout_path))
+    rows = [f'{i:05d}{"name" + str(i):<10}{i * 10:>8}' for i in range(1, 31)]
+    file1 = tmp_path / 'feed1.dat'
+    file1.write_text('\n'.join(rows) + '\n')
+    # Ragged second file: CRLF endings, trailing spaces trimmed and no final newline
+    rows[9] = rows[9][:5] + 'changed   ' + rows[9][15:]
+    file2 = tmp_path / 'feed2.dat'
+    file2.write_bytes('\r\n'.join(row.rstrip() for row in rows).encode())
+    summary = compare_csv(str(file1), str(file2), str(tmp_path / 'report.html'), report_type='cells', fixed_width_layout=layout)
+    assert summary['total'] == 30 and summary['different'] == 1
+    assert '<td class="diff">name10</td><td class="diff">changed</td>' in (tmp_path / 'report.html').read_text()
+
+
+def test_normalization_spec_applied_while_reading(tmp_path):
+    header = 'id,name,opened'
+    file1 = write_csv(tmp_path / 'n1.csv', [('007', ' Alice ', '31/01/2024'), ('8', 'bob', '2024-02-01'), ('9', 'Carl', '20240301')], header=header)
+    file2 = write_csv(tmp_path / 'n2.csv', [('7', 'ALICE', '2024-01-31'), ('0008', 'BOB', '01/02/2024'), ('9', 'CARL', 'not a date')], header=header)
+    normalizer = Compare_data.Normalizer({
+        '*': ['trim'],
+        'id': ['strip_leading_zeros'],
+        'name': ['upper'],
+        'opened': [{'date': {'formats': ['%Y-%m-%d', '%d/%m/%Y', '%Y%m%d']}}],
+    })
+    summary = compare_csv(file1, file2, None, normalizer=normalizer)
+    # Only the unparseable date is left to differ
+    assert (summary['total'], summary['different']) == (3, 1)
+    with pytest.raises(ValueError):
+        Compare_data.Normalizer({'name': ['reverse']})
+    with pytest.raises(ValueError, match='"date" needs "formats"'):
+        Compare_data.Normalizer({'opened': ['date']})
+    with pytest.raises(ValueError, match='"date" needs "formats"'):
+        Compare_data.Normalizer({'opened': [{'date': {'output': '%Y'}}]})
+
+
+def test_appended_records_compared_incrementally(tmp_path):
+    file1 = tmp_path / 'log1.csv'
+    file2 = tmp_path / 'log2.csv'
+    state_file = str(tmp_path / 'state.json')
+    file1.write_text('id,value\n1,a\n2,b\n')
+    file2.write_text('id,value\n1,a\n2,x\n3,c\n')
+    first = Compare_data.compare_appended(str(file1), str(file2), state_file)
+    assert (first['new_records'], first['total'], first['different']) == (2, 2, 1)
+    assert first['pending_records'] == {'file1': 0, 'file2': 1}
+    with open(file1, 'a') as f:
+        f.write('3,c\n4,d\n')
+    with open(file2, 'a') as f:
+        f.write('4,y\n5,')
+    report = tmp_path / 'delta.html'
+    second = Compare_data.compare_appended(str(file1), str(file2), state_file, output_file=str(report))
+    # Only lines 3 and 4 are new on both sides; the partial line 5 waits for its newline
+    assert (second['new_records'], second['new_mismatches'], second['total'], second['different']) == (2, 1, 4, 2)
+    assert '<td>1</td>' not in report.read_text() and '<td>4</td>' in report.read_text()
+    file1.write_text('id,value\n1,a\n')
+    assert Compare_data.compare_appended(str(file1), str(file2), state_file) is None
+
+
+def test_fingerprint_delta_between_runs(csv_pair, tmp_path):
+    day1 = str(tmp_path / 'day1.npz')
+    compare_csv(csv_pair[0], csv_pair[1], None, key_cols=['id'], fingerprint_file=day1)
+    # Day 2: row 5 is fixed, row 10 keeps its mismatch, row 7 breaks
+    rows = [(i, f'other{i}' if i in (7, 10, 15, 20) else f'name{i}', i * 10) for i in range(1, 21)]
+    file2 = write_csv(tmp_path / 'day2.csv', rows)
+    report = tmp_path / 'delta.html'
+    summary = compare_csv(csv_pair[0], file2, None, key_cols=['id'], previous_fingerprints=day1, delta_report=str(report))
+    assert summary['delta'] == {'new': 1, 'resolved': 1, 'persisting': 3}
+    assert '<td>7</td><td>name</td>' in report.read_text()
+
+
+def test_pipelined_run_matches_serial(csv_pair, tmp_path, monkeypatch):
+    serial_report, pipelined_report = tmp_path / 'serial.html', tmp_path / 'pipelined.html'
+    serial = compare_csv(csv_pair[0], csv_pair[1], str(serial_report))
+    pipelined = compare_csv(csv_pair[0], csv_pair[1], str(pipelined_report), pipeline_depth=2)
+    assert pipelined == serial
+    assert pipelined_report.read_text() == serial_report.read_text()
+    assert compare_csv(csv_pair[0], csv_pair[1], None, fail_fast=True, pipeline_depth=2)['status'] == 'different'
+
+    def broken_write(self, comparison):
+        raise OSError('disk full')
+
+    monkeypatch.setattr(Compare_data.HtmlReportWriter, 'write_comparison', broken_write)
+    assert compare_csv(csv_pair[0], csv_pair[1], str(pipelined_report), pipeline_depth=2) is None
+
+
+def test_polars_backend_matches_pandas(csv_pair, tmp_path):
+    pytest.importorskip('polars')
+    pandas_report, polars_report = tmp_path / 'pandas.html', tmp_path / 'polars.html'
+    expected = compare_csv(csv_pair[0], csv_pair[1], str(pandas_report), start_line=3, end_line=17)
+    assert compare_csv(csv_pair[0], csv_pair[1], str(polars_report), start_line=3, end_line=17, backend='polars') == expected
+    assert polars_report.read_text() == pandas_report.read_text()
+
+
+def test_reconcile_aggregates_and_drill_down(csv_pair, tmp_path):
+    rows = [(i, f'name{i}', i * 10) for i in range(1, 21)]
+    reordered = write_csv(tmp_path / 'reordered.csv', list(reversed(rows)))
+    assert Compare_data.reconcile(csv_pair[0], reordered)['status'] == 'match'
+    report, drill_down = tmp_path / 'aggregates.html', tmp_path / 'drill_down.html'
+    summary = Compare_data.reconcile(csv_pair[0], csv_pair[1], str(report), key_cols=['id'], drill_down=str(drill_down), report_type='cells')
+    assert summary['differing_columns'] == ['name']
+    assert summary['aggregates'][0]['columns']['amount']['sum'] == 2100
+    # Only the disagreeing column is compared row by row
+    assert summary['drill_down']['different'] == 4
+    assert drill_down.read_text().count('<td class="diff">') == 8
+
+
+def test_sketches_estimate_and_detect_drift(tmp_path):
+    rng = np.random.default_rng(5)
+    header = 'id,amount,region'
+    rows1 = [(i, round(v, 2), r) for i, v, r in zip(range(20000), rng.lognormal(3, 1, 20000), rng.choice(['N', 'S', 'E', 'W'], 20000))]
+    rows2 = [(i, round(v * 1.5, 2), r) for i, v, r in rows1]
+    file1 = write_csv(tmp_path / 'd1.csv', rows1, header=header)
+    file2 = write_csv(tmp_path / 'd2.csv', rows2, header=header)
+    summary = Compare_data.compare_drift(file1, file2, str(tmp_path / 'drift.html'), threads=2)
+    assert summary['drifted_columns'] == ['amount']
+    id_stats = summary['columns']['id']
+    assert abs(id_stats['distinct'][0] - 20000) < 20000 * 0.03
+    median = np.median([v for _, v, _ in rows1])
+    assert abs(id_stats['quantiles']['p50'][0] - 10000) < 10000 * 0.02
+    assert abs(summary['columns']['amount']['quantiles']['p50'][0] - median) < median * 0.02
+    assert Compare_data.compare_drift(file1, file1)['status'] == 'stable'
+
+
+def test_duplicate_keys_reported_while_pairing(tmp_path):
+    file1 = write_csv(tmp_path / 'k1.csv', [(1, 'a', 10), (2, 'b', 20), (1, 'c', 30), (3, 'd', 40), (1, 'e', 50)])
+    file2 = write_csv(tmp_path / 'k2.csv', [(3, 'd', 40), (2, 'b', 20), (1, 'a', 10), (2, 'x', 25)])
+    report = tmp_path / 'dups.csv'
+    summary = compare_csv(file1, file2, str(tmp_path / 'r.html'), key_cols=['id'], match_by='key', partitions=4,
+                          duplicate_keys_report=str(report))
+    assert summary['duplicate_keys'] == {'file1': {'keys': 1, 'rows': 3}, 'file2': {'keys': 1, 'rows': 2}}
+    assert report.read_text().splitlines() == ['file,id,count,line_numbers', 'file1,1,3,1;3;5', 'file2,2,2,2;4']
+
+
+def test_where_filters_rows_and_prunes_parquet_row_groups(tmp_path):
+    file1 = write_csv(tmp_path / 'w1.csv', [(1, 'EMEA', 10), (2, 'APAC', 20), (3, 'EMEA', 30), (4, 'APAC', 40)], header='id,region,amount')
+    file2 = write_csv(tmp_path / 'w2.csv', [(1, 'EMEA', 10), (2, 'APAC', 99), (3, 'EMEA', 31), (4, 'EMEA', 40)], header='id,region,amount')
+    summary = compare_csv(file1, file2, str(tmp_path / 'r.html'), report_type='difference', where="region == 'EMEA'")
+    # Row 4 moved into EMEA in file2 only, so it is kept and differs; row 2 is APAC on both sides
+    assert (summary['total'], summary['different']) == (3, 2)
+    assert '<td>2</td>' not in (tmp_path / 'r.html').read_text()
+
+    pq = pytest.importorskip('pyarrow.parquet')
+    import pyarrow as pa
+    table = pa.table({'id': list(range(100)), 'amount': [float(i) for i in range(100)]})
+    pq.write_table(table, tmp_path / 'p1.parquet', row_group_size=10)
+    pq.write_table(table.set_column(1, 'amount', pa.array([float(i) + (i == 95) for i in range(100)])), tmp_path / 'p2.parquet', row_group_size=10)
+    summary = compare_csv(str(tmp_path / 'p1.parquet'), str(tmp_path / 'p2.parquet'), str(tmp_path / 'p.html'), key_cols=['id'],
+                          match_by='key', report_type='cells', where='amount >= 90')
+    assert (summary['total'], summary['different']) == (10, 1)
+    assert '<td>96</td><td>amount</td>' in (tmp_path / 'p.html').read_text()
+    reader = Compare_data.ParquetChunkReader(str(tmp_path / 'p1.parquet'), 1000, row_filter=Compare_data.RowFilter('amount >= 90 or id in (5,)'))
+    assert sum(len(chunk) for chunk in reader) == 20 and reader.row_groups_pruned == 8
+
+
+def test_partitioned_directories_paired_skipped_and_pruned(tmp_path):
+    def partition(side, name, text):
+        directory = tmp_path / side / name
+        directory.mkdir(parents=True)
+        (directory / 'part-0.csv').write_text(text)
+
+    partition('a', 'dt=2024-06-01', 'id,v\n1,a\n')
+    partition('b', 'dt=2024-06-01', 'id,v\n1,a\n')
+    partition('a', 'dt=2024-06-02', 'id,v\n1,a\n2,b\n')
+    partition('b', 'dt=2024-06-02', 'id,v\n2,X\n1,a\n')
+    partition('a', 'dt=2024-06-03', 'id,v\n1,a\n')
+    partition('b', 'dt=2024-05-31', 'id,v\n1,a\n')
+    summary = Compare_data.compare_directories(str(tmp_path / 'a'), str(tmp_path / 'b'), str(tmp_path / 'dirs.html'),
+                                               partition_filter="dt >= '2024-06-01'", workers=2, key_cols=['id'], match_by='key')
+    assert summary['partitions'] == {'compared': 2, 'identical': 1, 'different': 1, 'only_in_dir1': 1, 'only_in_dir2': 0,
+                                     'pruned': 1, 'failed': 0}
+    assert (summary['status'], summary['total'], summary['different']) == ('different', 2, 1)
+    assert (tmp_path / 'dirs_partitions' / 'dt=2024-06-02.html').exists()
+
+
+def test_partition_parts_are_streamed_in_order(tmp_path, monkeypatch):
+    for side, parts in (('a', ['id,v\n1,a\n2,b', 'id,v\n3,c\n']), ('b', ['id,v\n1,a\n', 'id,v\n2,b\n3,X\n'])):
+        directory = tmp_path / side / 'dt=2024-06-01'
+        directory.mkdir(parents=True)
+        for i, text in enumerate(parts):
+            (directory / f'part-{i}.csv').write_text(text)
+    monkeypatch.setattr(Compare_data.tempfile, 'mkdtemp', None)
+    summary = Compare_data.compare_directories(str(tmp_path / 'a'), str(tmp_path / 'b'), workers=1)
+    assert (summary['status'], summary['total'], summary['different']) == ('different', 3, 1)
+    parts = [tmp_path / 'p0.jsonl', tmp_path / 'p1.jsonl']
+    parts[0].write_text('{"id": 1}')
+    parts[1].write_text('{"id": 2}\n')
+    with Compare_data.open_input(Compare_data.partition_input([str(p) for p in parts])) as handle:
+        assert handle.read() == b'{"id": 1}\n{"id": 2}\n'
+
+
+def test_strategy_planner_choices_agree(tmp_path):
+    rows1 = [(i, f'n{i}', i) for i in range(1, 300)]
+    rows2 = [(i, f'n{i}' if i % 40 else 'x', i) for i in range(2, 310)]
+    sorted1, sorted2 = write_csv(tmp_path / 's1.csv', rows1), write_csv(tmp_path / 's2.csv', rows2)
+    shuffled1 = write_csv(tmp_path / 'u1.csv', rows1[::2] + rows1[1::2])
+    assert Compare_data.plan_comparison(sorted1, sorted1, ['id'])['strategy'] == 'merge'
+    assert Compare_data.plan_comparison(sorted1, sorted1, ['id'], match_by='position')['strategy'] == 'position'
+    plan = Compare_data.plan_comparison(sorted1, sorted2, ['id'])
+    assert (plan['strategy'], plan['key_order']) == ('merge', 'numeric')
+    assert Compare_data.plan_comparison(shuffled1, sorted2, ['id'])['strategy'] == 'hash'
+    assert Compare_data.plan_comparison(shuffled1, sorted2, ['id'], memory=1000)['strategy'] == 'partition'
+    expected = compare_csv(sorted1, sorted2, str(tmp_path / 'p.html'), key_cols=['id'], strategy='partition', report_type='cells')
+    for strategy in ('auto', 'merge', 'hash'):
+        assert compare_csv(sorted1, sorted2, str(tmp_path / 'r.html'), key_cols=['id'], strategy=strategy, report_type='cells') == expected
+        assert (tmp_path / 'r.html').read_text() == (tmp_path / 'p.html').read_text()
+
+
+def test_positional_files_of_different_lengths(tmp_path):
+    rows = [(i, f'n{i}', i) for i in range(1, 251)]
+    file1 = write_csv(tmp_path / 'long.csv', rows)
+    file2 = write_csv(tmp_path / 'short.csv', rows[:200])
+    summary = compare_csv(file1, file2, str(tmp_path / 'r.html'), fail_fast=True)
+    assert summary['status'] == 'different'
+    assert (summary['total'], summary['same'], summary['only_in_file1'], summary['only_in_file2']) == (250, 200, 50, 0)
+    assert summary['only_in_lower_bound'] and 'Only in file 1: at least 50' in (tmp_path / 'r.html').read_text()
+    assert Compare_data.exit_code_for(summary, fail_fast=True) == Compare_data.EXIT_DIFFERENT
+    # Fail-fast does not read the longer file to its end: rows past the first chunk are not counted
+    longer = write_csv(tmp_path / 'longer.csv', rows[:200] + [(i, 'x', i) for i in range(200000)])
+    summary = compare_csv(file2, longer, None, fail_fast=True)
+    assert summary['status'] == 'different' and 0 < summary['only_in_file2'] < 200000
+    assert compare_csv(file2, longer, None)['only_in_file2'] == 200000
+    summary = compare_csv(file2, file1, None, max_mismatches=10)
+    assert (summary['status'], summary['only_in_file2']) == ('budget_exceeded', 50)
+    summary = compare_csv(file1, file2, None, end_line=220, where="name != 'n3'")
+    assert (summary['total'], summary['different'], summary['only_in_file1']) == (219, 20, 20)
+    summary = Compare_data.compare_layers([file1, file2, file1], str(tmp_path / 'l.html'))
+    assert summary['unpaired_records'] == {'source': 50, 'target': 50}
+
+
+def test_sampling_by_key_reads_each_file_to_its_end(tmp_path):
+    rows = [(i, f'name{i}', i) for i in range(50000)]
+    file1 = write_csv(tmp_path / 'file1.csv', rows)
+    file2 = write_csv(tmp_path / 'file2.csv', [(i, 'extra', i) for i in range(100000, 200000)] + rows)
+    summary = compare_csv(file1, file2, None, key_cols=['id'], sample_rate=0.1, sample_seed=3)
+    assert summary['only_in_file1'] == 0
+    assert 9000 < summary['only_in_file2'] < 11000
+    assert summary['different'] == summary['only_in_file2']
+    assert 4500 < summary['same'] < 5500
+    assert summary['sample']['estimated_population'] == 150000
+
+
+def test_identical_files_with_nan_text_reconcile(tmp_path):
+    rows = [(i, f'name{i}', 'NaN' if i % 4 == 0 else ('inf' if i % 9 == 0 else i * 1.5)) for i in range(1, 101)]
+    file1 = write_csv(tmp_path / 'nan1.csv', rows)
+    file2 = write_csv(tmp_path / 'nan2.csv', list(reversed(rows)))
+    summary = Compare_data.reconcile(file1, file2)
+    assert summary['status'] == 'match'
+    assert summary['aggregates'][0]['columns']['amount']['max'] == 'inf'
+    assert Compare_data.compare_drift(file1, file2)['columns']['amount']['drifted'] is False
+
+
+def test_failed_partition_is_an_error_not_a_difference(tmp_path):
+    for side, text in (('a', 'id,v\n1,a\n'), ('b', 'id,w\n1,a\n')):
+        directory = tmp_path / side / 'dt=2024-06-01'
+        directory.mkdir(parents=True)
+        (directory / 'part-0.csv').write_text(text)
+    summary = Compare_data.compare_directories(str(tmp_path / 'a'), str(tmp_path / 'b'), workers=1)
+    assert summary['partitions']['failed'] == 1 and summary['partitions']['different'] == 0
+    assert summary['status'] == 'failed'
+    assert Compare_data.exit_code_for(summary) == Compare_data.EXIT_ERROR
+
+
+def test_planner_pairs_by_key_when_a_record_moves_past_the_sample(tmp_path, caplog):
+    rows = [(i, f'n{i}', i) for i in range(1, 12001)]
+    file1 = write_csv(tmp_path / 'm1.csv', rows)
+    file2 = write_csv(tmp_path / 'm2.csv', rows[:10500] + rows[10501:] + [rows[10500]])
+    updates = []
+    summary = compare_csv(file1, file2, None, key_cols=['id'], progress_callback=updates.append)
+    assert (summary['status'], summary['different']) == ('match', 0)
+    assert any(update.get('plan', '').startswith('Strategy: merge') for update in updates)
+    with caplog.at_level('INFO', logger='Compare_data'):
+        compare_csv(file1, file1, None, key_cols=['id'])
+    assert caplog.messages[0].startswith('Strategy: merge')
+
+
+def test_block_manifests_of_different_lengths_and_headers(tmp_path):
+    rows = [(i, f'name{i}', i * 10) for i in range(1, 16)]
+    for short, long_, block_lines, extra in ((10, 15, DEFAULT_BLOCK_LINES, 5), (8, 12, 5, 4)):
+        file1 = write_csv(tmp_path / f'm{short}.csv', rows[:short])
+        file2 = write_csv(tmp_path / f'm{long_}.csv', rows[:long_])
+        manifests = (build_manifest(file1, block_lines), build_manifest(file2, block_lines))
+        summary = compare_csv(file1, file2, None, block_manifests=manifests)
+        assert (summary['status'], summary['only_in_file1'], summary['only_in_file2']) == ('different', 0, extra)
+        assert summary['total'] == long_ and summary['same'] == short
+    renamed = write_csv(tmp_path / 'renamed.csv', rows[:8], header='id,label,amount')
+    file1 = str(tmp_path / 'm8.csv')
+    assert compare_csv(file1, renamed, None, block_manifests=(build_manifest(file1, 5), build_manifest(renamed, 5))) is None
+
+
+def test_sqlite_store_flushes_batches_from_the_writer_thread(csv_pair, tmp_path, monkeypatch):
+    import sqlite3
+    monkeypatch.setattr(Compare_data.SqliteResultStore.__init__, '__defaults__', (None, 2))
+    db_file = str(tmp_path / 'pipelined.sqlite')
+    summary = compare_csv(csv_pair[0], csv_pair[1], None, db_file=db_file, pipeline_depth=2)
+    assert summary['different'] == 4
+    conn = sqlite3.connect(db_file)
+    assert conn.execute('SELECT COUNT(*) FROM mismatches').fetchone() == (4,)
+
+
+def test_reordered_rows_do_not_drift(tmp_path):
+    rng = np.random.default_rng(9)
+    rows = [(i, r, v) for i, r, v in zip(range(5000), rng.choice(['N', 'S', 'E', 'W', 'C'], 5000), rng.integers(0, 40, 5000))]
+    file1 = write_csv(tmp_path / 'o1.csv', rows, header='id,region,amount')
+    file2 = write_csv(tmp_path / 'o2.csv', rows[::-1], header='id,region,amount')
+    summary = Compare_data.compare_drift(file1, file2)
+    assert summary['status'] == 'stable', summary['drifted_columns']
+    assert summary['columns']['id']['top_overlap'] == 1.0
+
+
+def test_progress_throttles_loading_states(tmp_path, monkeypatch):
+    rows = [(i, f'n{i}', i) for i in range(150000)]
+    file1 = write_csv(tmp_path / 'p1.csv', rows)
+    file2 = write_csv(tmp_path / 'p2.csv', rows[::-1])
+    writes, updates = [], []
+    monkeypatch.setattr(Compare_data, 'write_status_file', lambda path, status: writes.append(status['state']))
+    compare_csv(file1, file2, None, key_cols=['id'], strategy='partition', status_file=str(tmp_path / 's.json'), status_interval=60,
+                progress_callback=updates.append)
+    assert writes == ['partitioning', 'finished']
+    assert updates[0]['state'] == 'partitioning' and updates[0]['eta_seconds'] > 0
+    assert all(a['rows'] <= b['rows'] for a, b in zip(updates, updates[1:]))
+
+
+def test_appended_blank_lines_and_multiline_records(tmp_path, monkeypatch):
+    file1, file2 = tmp_path / 'a1.csv', tmp_path / 'a2.csv'
+    state_file = str(tmp_path / 'a.json')
+    file1.write_text('id,value\n1,a\n\n2,b\n\r\n3,c\n')
+    file2.write_text('id,value\n1,a\n2,b\n3,x\n4,d\n')
+    # Small reads put blank lines and CRLF pairs across read boundaries
+    monkeypatch.setattr(Compare_data, 'MANIFEST_READ_SIZE', 3)
+    summary = Compare_data.compare_appended(str(file1), str(file2), state_file)
+    assert (summary['new_records'], summary['different'], summary['pending_records']) == (3, 1, {'file1': 0, 'file2': 1})
+    with open(file1, 'a') as f:
+        f.write('4,"d\ne"\n')
+    with open(file2, 'a') as f:
+        f.write('5,e\n')
+    assert Compare_data.compare_appended(str(file1), str(file2), state_file) is None
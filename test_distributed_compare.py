@@ -0,0 +1,36 @@
+import re
+from Compare_data import compare_csv
+from distributed_compare import compare_distributed
+
+
+def write_csv(path, rows):
+    path.write_text('id,name,amount\n' + ''.join(f'{i},{n},{a}\n' for i, n, a in rows))
+    return str(path)
+
+
+def test_local_workers_match_single_process(tmp_path):
+    rows = [(i, f'name{i}', i * 10) for i in range(1, 501)]
+    changed = [(i, 'other' if i % 50 == 0 else n, a) for i, n, a in rows if i != 7] + [(501, 'extra', 0)]
+    file1 = write_csv(tmp_path / 'file1.csv', rows)
+    file2 = write_csv(tmp_path / 'file2.csv', list(reversed(changed)))
+    report = tmp_path / 'distributed.html'
+    summary = compare_distributed(file1, file2, ['id'], str(report), partitions=6, local_workers=2)
+    expected = compare_csv(file1, file2, None, key_cols=['id'], match_by='key')
+    assert summary['partitions'] == 6
+    assert {name: summary[name] for name in expected} == expected
+    # Ten changed names plus id 7 and id 501, which are on one side only
+    assert report.read_text().count('<tr><td>') == 10 + 2 * 3
+
+
+def test_workers_split_byte_ranges_and_keep_line_numbers(tmp_path):
+    rows = [(i, f'name{i}', i * 10) for i in range(1, 801)]
+    changed = [(i, 'other' if i % 70 == 0 else n, a) for i, n, a in rows]
+    file1 = write_csv(tmp_path / 'file1.csv', rows)
+    file2 = write_csv(tmp_path / 'file2.csv', changed[::-1])
+    report, expected_report = tmp_path / 'distributed.html', tmp_path / 'single.html'
+    summary = compare_distributed(file1, file2, ['id'], str(report), local_workers=2, split_bytes=500)
+    expected = compare_csv(file1, file2, str(expected_report), key_cols=['id'], match_by='key', report_type='cells')
+    assert {name: summary[name] for name in expected} == expected
+    cells = re.compile(r'<tr><td>(\d+)</td><td>name</td>')
+    assert sorted(cells.findall(report.read_text())) == sorted(cells.findall(expected_report.read_text()))
+    assert len(cells.findall(report.read_text())) == 11